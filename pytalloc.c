@@ -18,6 +18,7 @@
 */
 
 #include <Python.h>
+#include "replace.h"
 #include <talloc.h>
 #include <pytalloc.h>
 #include "pytalloc_private.h"
@@ -68,6 +69,293 @@ static PyObject *pytalloc_total_blocks(PyObject *self, PyObject *args)
 	return PyLong_FromLong(talloc_total_blocks(pytalloc_get_mem_ctx(py_obj)));
 }
 
+/* return the total size of talloc memory */
+static PyObject *pytalloc_total_size(PyObject *self, PyObject *args)
+{
+	PyObject *py_obj = Py_None;
+	TALLOC_CTX *mem_ctx = NULL;
+
+	if (!PyArg_ParseTuple(args, "|O", &py_obj))
+		return NULL;
+
+	if (py_obj != Py_None) {
+		mem_ctx = pytalloc_get_mem_ctx(py_obj);
+		if (mem_ctx == NULL) {
+			PyErr_Format(PyExc_TypeError,
+				     "expected a talloc object, got %s",
+				     Py_TYPE(py_obj)->tp_name);
+			return NULL;
+		}
+	}
+
+	return PyLong_FromSize_t(talloc_total_size(mem_ctx));
+}
+
+struct pytalloc_report_entry {
+	int depth;
+	size_t name_ofs;
+	size_t size;
+	size_t blocks;
+	size_t refs;
+};
+
+struct pytalloc_report_state {
+	struct pytalloc_report_entry *entries;
+	size_t num_entries;
+	size_t max_entries;
+	char *names;
+	size_t names_len;
+	size_t names_size;
+	int max_depth;
+	bool failed;
+};
+
+static bool pytalloc_report_grow(void **p, size_t *size, size_t el_size,
+				 size_t needed)
+{
+	size_t new_size = *size;
+	void *new_p;
+
+	if (needed <= *size) {
+		return true;
+	}
+	while (new_size < needed) {
+		new_size = new_size ? new_size * 2 : 256;
+	}
+	new_p = PyMem_Realloc(*p, new_size * el_size);
+	if (new_p == NULL) {
+		return false;
+	}
+	*p = new_p;
+	*size = new_size;
+	return true;
+}
+
+/*
+ * Copy out what is needed of every chunk: building the Python objects
+ * can run destructors that free talloc memory, so that has to wait
+ * until the walk is done.
+ */
+static void pytalloc_report_helper(const void *ptr, int depth, int max_depth,
+				   int is_ref, void *private_data)
+{
+	struct pytalloc_report_state *state =
+		(struct pytalloc_report_state *)private_data;
+	struct pytalloc_report_entry *e;
+	const char *prefix = is_ref ? "reference to: " : "";
+	const char *name = talloc_get_name(ptr);
+	size_t prefix_len = strlen(prefix);
+	size_t name_len = strlen(name);
+
+	if (state->failed) {
+		return;
+	}
+	if (!pytalloc_report_grow((void **)&state->entries,
+				  &state->max_entries, sizeof(*e),
+				  state->num_entries + 1) ||
+	    !pytalloc_report_grow((void **)&state->names,
+				  &state->names_size, 1,
+				  state->names_len + prefix_len +
+				  name_len + 1)) {
+		state->failed = true;
+		return;
+	}
+
+	e = &state->entries[state->num_entries++];
+	e->depth = depth;
+	e->name_ofs = state->names_len;
+	memcpy(state->names + state->names_len, prefix, prefix_len);
+	memcpy(state->names + state->names_len + prefix_len, name,
+	       name_len + 1);
+	state->names_len += prefix_len + name_len + 1;
+
+	if (depth > state->max_depth) {
+		state->max_depth = depth;
+	}
+
+	if (is_ref) {
+		/* the reference handle, which has no size */
+		e->size = 0;
+		e->blocks = 1;
+		e->refs = 0;
+		return;
+	}
+
+	e->refs = talloc_reference_count(ptr);
+	if (max_depth >= 0 && depth >= max_depth) {
+		/* the children are not reported */
+		e->size = talloc_total_size(ptr);
+		e->blocks = talloc_total_blocks(ptr);
+	} else {
+		e->size = talloc_get_size(ptr);
+		e->blocks = 1;
+	}
+}
+
+/* return a talloc tree report as a list of tuples */
+static PyObject *pytalloc_report(PyObject *self, PyObject *args)
+{
+	PyObject *py_obj = Py_None;
+	TALLOC_CTX *mem_ctx = NULL;
+	int max_depth = -1;
+	struct pytalloc_report_state state = { .max_depth = 0 };
+	size_t *sizes = NULL, *blocks = NULL;
+	PyObject *ret = NULL;
+	size_t i;
+
+	if (!PyArg_ParseTuple(args, "|Oi", &py_obj, &max_depth))
+		return NULL;
+
+	if (py_obj != Py_None) {
+		mem_ctx = pytalloc_get_mem_ctx(py_obj);
+		if (mem_ctx == NULL) {
+			PyErr_Format(PyExc_TypeError,
+				     "expected a talloc object, got %s",
+				     Py_TYPE(py_obj)->tp_name);
+			return NULL;
+		}
+	}
+
+	talloc_report_depth_cb(mem_ctx, 0, max_depth, pytalloc_report_helper,
+			       &state);
+	if (state.failed) {
+		PyErr_NoMemory();
+		goto done;
+	}
+
+	/*
+	 * The chunks come parents first, so walking backwards all
+	 * children of a chunk are summed up by the time it is reached.
+	 */
+	sizes = PyMem_New(size_t, state.max_depth + 2);
+	blocks = PyMem_New(size_t, state.max_depth + 2);
+	if (sizes == NULL || blocks == NULL) {
+		PyErr_NoMemory();
+		goto done;
+	}
+	memset(sizes, 0, (state.max_depth + 2) * sizeof(size_t));
+	memset(blocks, 0, (state.max_depth + 2) * sizeof(size_t));
+
+	for (i = state.num_entries; i > 0; i--) {
+		struct pytalloc_report_entry *e = &state.entries[i - 1];
+
+		e->size += sizes[e->depth + 1];
+		e->blocks += blocks[e->depth + 1];
+		sizes[e->depth + 1] = 0;
+		blocks[e->depth + 1] = 0;
+		sizes[e->depth] += e->size;
+		blocks[e->depth] += e->blocks;
+	}
+
+	ret = PyList_New(state.num_entries);
+	if (ret == NULL) {
+		goto done;
+	}
+	for (i = 0; i < state.num_entries; i++) {
+		struct pytalloc_report_entry *e = &state.entries[i];
+		const char *name = state.names + e->name_ofs;
+		PyObject *item;
+
+#if PY_MAJOR_VERSION >= 3
+		item = Py_BuildValue("(iNnnn)", e->depth,
+				     PyUnicode_DecodeUTF8(name, strlen(name),
+							  "replace"),
+				     (Py_ssize_t)e->size,
+				     (Py_ssize_t)e->blocks,
+				     (Py_ssize_t)e->refs);
+#else
+		item = Py_BuildValue("(isnnn)", e->depth, name,
+				     (Py_ssize_t)e->size,
+				     (Py_ssize_t)e->blocks,
+				     (Py_ssize_t)e->refs);
+#endif
+		if (item == NULL) {
+			Py_CLEAR(ret);
+			goto done;
+		}
+		PyList_SET_ITEM(ret, i, item);
+	}
+
+done:
+	PyMem_Free(sizes);
+	PyMem_Free(blocks);
+	PyMem_Free(state.entries);
+	PyMem_Free(state.names);
+	return ret;
+}
+
+/* start sampling allocations */
+static PyObject *pytalloc_enable_sampling(PyObject *self, PyObject *args)
+{
+	Py_ssize_t interval;
+
+	if (!PyArg_ParseTuple(args, "n", &interval))
+		return NULL;
+
+	if (interval <= 0) {
+		PyErr_SetString(PyExc_ValueError,
+				"interval must be positive");
+		return NULL;
+	}
+
+	talloc_enable_sampling(interval);
+	Py_RETURN_NONE;
+}
+
+/* stop sampling allocations */
+static PyObject *pytalloc_disable_sampling(PyObject *self)
+{
+	talloc_disable_sampling();
+	Py_RETURN_NONE;
+}
+
+/* return the allocation sites seen by the sampling profiler */
+static PyObject *pytalloc_sample_report(PyObject *self)
+{
+	struct talloc_sample *samples = NULL;
+	size_t i, n, num_samples = 0;
+	PyObject *ret;
+
+	/* sites may show up between the two calls */
+	do {
+		num_samples = talloc_sample_report(NULL, 0) + 16;
+		PyMem_Free(samples);
+		samples = PyMem_New(struct talloc_sample, num_samples);
+		if (samples == NULL) {
+			return PyErr_NoMemory();
+		}
+		n = talloc_sample_report(samples, num_samples);
+	} while (n > num_samples);
+
+	ret = PyList_New(n);
+	if (ret == NULL) {
+		PyMem_Free(samples);
+		return NULL;
+	}
+	for (i = 0; i < n; i++) {
+		PyObject *item = Py_BuildValue("(snnn)",
+					       samples[i].location,
+					       (Py_ssize_t)samples[i].samples,
+					       (Py_ssize_t)samples[i].count,
+					       (Py_ssize_t)samples[i].bytes);
+		if (item == NULL) {
+			Py_DECREF(ret);
+			PyMem_Free(samples);
+			return NULL;
+		}
+		PyList_SET_ITEM(ret, i, item);
+	}
+	PyMem_Free(samples);
+	return ret;
+}
+
+/* throw away the samples taken so far */
+static PyObject *pytalloc_sample_reset(PyObject *self)
+{
+	talloc_sample_reset();
+	Py_RETURN_NONE;
+}
+
 static PyMethodDef talloc_methods[] = {
 	{ "report_full", (PyCFunction)pytalloc_report_full, METH_VARARGS,
 		"show a talloc tree for an object"},
@@ -75,6 +363,21 @@ static PyMethodDef talloc_methods[] = {
 		"enable tracking of the NULL object"},
 	{ "total_blocks", (PyCFunction)pytalloc_total_blocks, METH_VARARGS,
 		"return talloc block count"},
+	{ "total_size", (PyCFunction)pytalloc_total_size, METH_VARARGS,
+		"return the total size of talloc memory"},
+	{ "report", (PyCFunction)pytalloc_report, METH_VARARGS,
+		"return a talloc tree for an object as a list of "
+		"(depth, name, size, blocks, refcount), size and blocks "
+		"including the children"},
+	{ "enable_sampling", (PyCFunction)pytalloc_enable_sampling, METH_VARARGS,
+		"sample one allocation per interval bytes on average"},
+	{ "disable_sampling", (PyCFunction)pytalloc_disable_sampling, METH_NOARGS,
+		"stop sampling allocations"},
+	{ "sample_report", (PyCFunction)pytalloc_sample_report, METH_NOARGS,
+		"return (location, samples, count, bytes) for every sampled "
+		"allocation site, the site allocating most first"},
+	{ "sample_reset", (PyCFunction)pytalloc_sample_reset, METH_NOARGS,
+		"throw away the samples taken so far"},
 	{ NULL }
 };
 
@@ -224,6 +527,40 @@ static int pytalloc_base_default_cmp(PyObject *_obj1, PyObject *_obj2)
 }
 #endif
 
+/**
+ * Export the memory of the talloc chunk a talloc.BufferObject points
+ * to, the object itself keeps it alive while the buffer is in use.
+ */
+static int pytalloc_buffer_getbuffer(PyObject *self, Py_buffer *view,
+				     int flags)
+{
+	pytalloc_BaseObject *obj = (pytalloc_BaseObject *)self;
+
+	/* the first element of an array points at the whole chunk */
+	if (obj->ptr == NULL || obj->array_element ||
+	    obj->ptr != obj->talloc_ptr_ctx) {
+		PyErr_Format(PyExc_BufferError,
+			     "%s object does not point to a talloc chunk",
+			     Py_TYPE(self)->tp_name);
+		view->obj = NULL;
+		return -1;
+	}
+
+	return PyBuffer_FillInfo(view, self, obj->ptr,
+				 (Py_ssize_t)talloc_get_size(obj->ptr),
+				 !obj->buffer_writable, flags);
+}
+
+static PyBufferProcs TallocBufferObject_as_buffer = {
+	.bf_getbuffer = pytalloc_buffer_getbuffer,
+};
+
+#if PY_MAJOR_VERSION >= 3
+#define PYTALLOC_TPFLAGS_BUFFER 0
+#else
+#define PYTALLOC_TPFLAGS_BUFFER Py_TPFLAGS_HAVE_NEWBUFFER
+#endif
+
 static PyTypeObject TallocBaseObject_Type = {
 	.tp_name = "talloc.BaseObject",
 	.tp_doc = "Python wrapper for a talloc-maintained object.",
@@ -246,6 +583,178 @@ static PyTypeObject TallocGenericObject_Type = {
 	.tp_basicsize = sizeof(pytalloc_BaseObject),
 };
 
+static PyTypeObject TallocBufferObject_Type = {
+	.tp_name = "talloc.BufferObject",
+	.tp_doc = "Python wrapper for a talloc-maintained object, exporting\n"
+		  "its memory with the buffer protocol.",
+	.tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE |
+		    PYTALLOC_TPFLAGS_BUFFER,
+	.tp_base = &TallocBaseObject_Type,
+	.tp_basicsize = sizeof(pytalloc_BaseObject),
+	.tp_as_buffer = &TallocBufferObject_as_buffer,
+};
+
+static PyObject *pytalloc_array_repr(PyObject *obj)
+{
+	pytalloc_Array *talloc_array = (pytalloc_Array *)obj;
+
+	return PyStr_FromFormat("<talloc.Array of %zd %s at %p>",
+				(Py_ssize_t)talloc_array->count,
+				talloc_array->item_type->tp_name,
+				talloc_array->array);
+}
+
+static void pytalloc_array_dealloc(PyObject *self)
+{
+	pytalloc_Array *obj = (pytalloc_Array *)self;
+	assert(talloc_unlink(NULL, obj->talloc_ctx) != -1);
+	obj->talloc_ctx = NULL;
+	Py_CLEAR(obj->item_type);
+	self->ob_type->tp_free(self);
+}
+
+static Py_ssize_t pytalloc_array_length(PyObject *self)
+{
+	pytalloc_Array *obj = (pytalloc_Array *)self;
+	return (Py_ssize_t)obj->count;
+}
+
+/**
+ * Wrap an element only when it is asked for, the element keeps the
+ * memory of the whole array alive with a reference of its own.
+ */
+static PyObject *pytalloc_array_item(PyObject *self, Py_ssize_t i)
+{
+	pytalloc_Array *obj = (pytalloc_Array *)self;
+	PyObject *ret;
+
+	if (i < 0 || (size_t)i >= obj->count) {
+		PyErr_SetString(PyExc_IndexError,
+				"talloc.Array index out of range");
+		return NULL;
+	}
+
+	ret = pytalloc_reference_direct_ex(obj->item_type, obj->talloc_ctx,
+					   obj->array + i * obj->el_size);
+	if (ret != NULL) {
+		((pytalloc_BaseObject *)ret)->array_element = true;
+	}
+	return ret;
+}
+
+static PySequenceMethods TallocArray_as_sequence = {
+	.sq_length = pytalloc_array_length,
+	.sq_item = pytalloc_array_item,
+};
+
+static PyTypeObject TallocArray_Type = {
+	.tp_name = "talloc.Array",
+	.tp_doc = "Python sequence wrapping a talloc array.",
+	.tp_basicsize = sizeof(pytalloc_Array),
+	.tp_dealloc = (destructor)pytalloc_array_dealloc,
+	.tp_flags = Py_TPFLAGS_DEFAULT,
+	.tp_repr = pytalloc_array_repr,
+	.tp_as_sequence = &TallocArray_as_sequence,
+};
+
+typedef struct {
+	pytalloc_BaseObject base;
+	TALLOC_CTX *prev_pool;
+	bool entered;
+} pytalloc_Pool;
+
+static PyObject *pytalloc_pool_new(PyTypeObject *type, PyObject *args,
+				   PyObject *kwargs)
+{
+	const char * const kwnames[] = { "size", NULL };
+	Py_ssize_t size;
+	TALLOC_CTX *pool;
+	PyObject *ret;
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwargs, "n",
+					 discard_const_p(char *, kwnames),
+					 &size)) {
+		return NULL;
+	}
+	if (size < 0) {
+		PyErr_SetString(PyExc_ValueError,
+				"talloc.Pool size must not be negative");
+		return NULL;
+	}
+
+	pool = talloc_pool(NULL, size);
+	if (pool == NULL) {
+		return PyErr_NoMemory();
+	}
+	talloc_set_name_const(pool, type->tp_name);
+
+	ret = pytalloc_steal_direct(type, pool);
+	if (ret == NULL) {
+		talloc_free(pool);
+	}
+	return ret;
+}
+
+static PyObject *pytalloc_pool_enter(PyObject *self)
+{
+	pytalloc_Pool *obj = (pytalloc_Pool *)self;
+
+	if (obj->entered) {
+		PyErr_SetString(PyExc_RuntimeError,
+				"talloc.Pool is already in use");
+		return NULL;
+	}
+
+	/* the pool must not go away while it hands out memory */
+	Py_INCREF(self);
+	obj->prev_pool = _pytalloc_set_pool(obj->base.talloc_ctx);
+	obj->entered = true;
+
+	Py_INCREF(self);
+	return self;
+}
+
+static PyObject *pytalloc_pool_exit(PyObject *self, PyObject *args)
+{
+	pytalloc_Pool *obj = (pytalloc_Pool *)self;
+
+	if (!obj->entered || pytalloc_get_pool() != obj->base.talloc_ctx) {
+		PyErr_SetString(PyExc_RuntimeError,
+				"talloc.Pool is not the innermost pool in use");
+		return NULL;
+	}
+
+	_pytalloc_set_pool(obj->prev_pool);
+	obj->prev_pool = NULL;
+	obj->entered = false;
+	Py_DECREF(self);
+
+	Py_RETURN_NONE;
+}
+
+static PyMethodDef TallocPool_methods[] = {
+	{ "__enter__", (PyCFunction)pytalloc_pool_enter, METH_NOARGS,
+		"Allocate the talloc objects of new Python objects from the pool" },
+	{ "__exit__", (PyCFunction)pytalloc_pool_exit, METH_VARARGS,
+		"Stop allocating from the pool" },
+	{ NULL }
+};
+
+static PyTypeObject TallocPool_Type = {
+	.tp_name = "talloc.Pool",
+	.tp_doc = "Pool(size)\n"
+		  "Context manager for a talloc pool of size bytes, the talloc\n"
+		  "memory of Python objects created within comes from it.\n"
+		  "The objects are not children of the pool, they may outlive\n"
+		  "it. The pool memory is only freed once the Pool and all of\n"
+		  "these objects are gone.",
+	.tp_flags = Py_TPFLAGS_DEFAULT,
+	.tp_base = &TallocBaseObject_Type,
+	.tp_basicsize = sizeof(pytalloc_Pool),
+	.tp_new = pytalloc_pool_new,
+	.tp_methods = TallocPool_methods,
+};
+
 #define MODULE_DOC PyDoc_STR("Python wrapping of talloc-maintained objects.")
 
 #if PY_MAJOR_VERSION >= 3
@@ -272,6 +781,15 @@ static PyObject *module_init(void)
 	if (PyType_Ready(&TallocGenericObject_Type) < 0)
 		return NULL;
 
+	if (PyType_Ready(&TallocBufferObject_Type) < 0)
+		return NULL;
+
+	if (PyType_Ready(&TallocArray_Type) < 0)
+		return NULL;
+
+	if (PyType_Ready(&TallocPool_Type) < 0)
+		return NULL;
+
 #if PY_MAJOR_VERSION >= 3
 	m = PyModule_Create(&moduledef);
 #else
@@ -286,6 +804,12 @@ static PyObject *module_init(void)
 	PyModule_AddObject(m, "BaseObject", (PyObject *)&TallocBaseObject_Type);
 	Py_INCREF(&TallocGenericObject_Type);
 	PyModule_AddObject(m, "GenericObject", (PyObject *)&TallocGenericObject_Type);
+	Py_INCREF(&TallocBufferObject_Type);
+	PyModule_AddObject(m, "BufferObject", (PyObject *)&TallocBufferObject_Type);
+	Py_INCREF(&TallocArray_Type);
+	PyModule_AddObject(m, "Array", (PyObject *)&TallocArray_Type);
+	Py_INCREF(&TallocPool_Type);
+	PyModule_AddObject(m, "Pool", (PyObject *)&TallocPool_Type);
 	return m;
 }
 
@@ -35,6 +35,12 @@ PyTypeObject *pytalloc_GetObjectType(void);
 /* Return the PyTypeObject for pytalloc_BaseObject. Returns a new reference. */
 PyTypeObject *pytalloc_GetBaseObjectType(void);
 
+/*
+ * Return the PyTypeObject for talloc.BufferObject, the subtype of
+ * talloc.BaseObject that exports its memory with the buffer protocol.
+ */
+PyTypeObject *pytalloc_GetBufferObjectType(void);
+
 /* Check whether a specific object is a talloc Object. */
 int pytalloc_Check(PyObject *);
 
@@ -59,7 +65,39 @@ PyObject *pytalloc_steal(PyTypeObject *py_type, void *ptr);
 PyObject *pytalloc_reference_ex(PyTypeObject *py_type, TALLOC_CTX *mem_ctx, void *ptr);
 #define pytalloc_reference(py_type, talloc_ptr) pytalloc_reference_ex(py_type, talloc_ptr, talloc_ptr)
 
-#define pytalloc_new(type, typeobj) pytalloc_steal(typeobj, talloc_zero(NULL, type))
+/*
+ * The talloc pool of the innermost talloc.Pool "with" block of the
+ * calling thread, or NULL.
+ * pytalloc_steal_ex() and pytalloc_reference_ex() take the talloc
+ * contexts of new Python objects from it.
+ */
+TALLOC_CTX *pytalloc_get_pool(void);
+
+#define pytalloc_new(type, typeobj) pytalloc_steal(typeobj, talloc_zero(pytalloc_get_pool(), type))
+
+/*
+ * Like pytalloc_steal_ex() and pytalloc_reference_ex(), but without a
+ * talloc context for every Python object, for talloc.BaseObject types
+ * only. Don't steal the same pointer into two Python objects.
+ */
+PyObject *pytalloc_steal_direct_ex(PyTypeObject *py_type, TALLOC_CTX *mem_ctx, void *ptr);
+#define pytalloc_steal_direct(py_type, talloc_ptr) \
+	pytalloc_steal_direct_ex(py_type, talloc_ptr, talloc_ptr)
+PyObject *pytalloc_reference_direct_ex(PyTypeObject *py_type, TALLOC_CTX *mem_ctx, void *ptr);
+#define pytalloc_reference_direct(py_type, talloc_ptr) \
+	pytalloc_reference_direct_ex(py_type, talloc_ptr, talloc_ptr)
+
+/*
+ * Wrap a talloc array into a talloc.Array sequence holding a single
+ * reference to mem_ctx. The elements are wrapped into py_type objects
+ * (based on talloc.BaseObject) when they are accessed.
+ */
+PyObject *pytalloc_Array_reference_ex(PyTypeObject *py_type, TALLOC_CTX *mem_ctx,
+				      void *array, size_t el_size, size_t count);
+#define pytalloc_Array_reference(py_type, talloc_array) \
+	pytalloc_Array_reference_ex(py_type, talloc_array, talloc_array, \
+				    sizeof(*(talloc_array)), \
+				    talloc_array_length(talloc_array))
 
 #if PY_MAJOR_VERSION < 3
 /*
@@ -89,6 +127,12 @@ PyObject *pytalloc_GenericObject_reference_ex(TALLOC_CTX *mem_ctx, void *ptr);
 
 size_t pytalloc_BaseObject_size(void);
 
+/*
+ * talloc.BufferObject exports the talloc chunk it points to with the
+ * buffer protocol, read-only unless this is called with writable != 0.
+ */
+int pytalloc_BaseObject_set_buffer_writable(PyObject *py_obj, int writable);
+
 int pytalloc_BaseObject_PyType_Ready(PyTypeObject *type);
 
 #endif /* _PYTALLOC_H_ */
@@ -23,4 +23,18 @@ typedef struct {
 	TALLOC_CTX *talloc_ctx;
 	TALLOC_CTX *talloc_ptr_ctx; /* eg the start of the array */
 	void *ptr; /* eg the array element */
+	bool buffer_writable; /* whether the buffer export is writable */
+	bool array_element; /* part of a talloc.Array, exports no buffer */
 } pytalloc_BaseObject;
+
+typedef struct {
+	PyObject_HEAD
+	TALLOC_CTX *talloc_ctx;
+	PyTypeObject *item_type;
+	char *array;
+	size_t el_size;
+	size_t count;
+} pytalloc_Array;
+
+/* Make pool the parent of new objects, returns the previous one. */
+TALLOC_CTX *_pytalloc_set_pool(TALLOC_CTX *pool);
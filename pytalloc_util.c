@@ -64,6 +64,26 @@ _PUBLIC_ PyTypeObject *pytalloc_GetBaseObjectType(void)
 	return type;
 }
 
+_PUBLIC_ PyTypeObject *pytalloc_GetBufferObjectType(void)
+{
+	static PyTypeObject *type = NULL;
+	PyObject *mod;
+
+	if (type != NULL) {
+		return type;
+	}
+
+	mod = PyImport_ImportModule("talloc");
+	if (mod == NULL) {
+		return NULL;
+	}
+
+	type = (PyTypeObject *)PyObject_GetAttrString(mod, "BufferObject");
+	Py_DECREF(mod);
+
+	return type;
+}
+
 static PyTypeObject *pytalloc_GetGenericObjectType(void)
 {
 	static PyTypeObject *type = NULL;
@@ -84,6 +104,114 @@ static PyTypeObject *pytalloc_GetGenericObjectType(void)
 	return type;
 }
 
+static PyTypeObject *pytalloc_GetArrayType(void)
+{
+	static PyTypeObject *type = NULL;
+	PyObject *mod;
+
+	if (type != NULL) {
+		return type;
+	}
+
+	mod = PyImport_ImportModule("talloc");
+	if (mod == NULL) {
+		return NULL;
+	}
+
+	type = (PyTypeObject *)PyObject_GetAttrString(mod, "Array");
+	Py_DECREF(mod);
+
+	return type;
+}
+
+/*
+ * The pool of the innermost talloc.Pool "with" block. Each thread has
+ * blocks of its own, so this is kept per thread.
+ */
+#ifdef HAVE___THREAD
+
+static __thread TALLOC_CTX *pytalloc_pool;
+
+_PUBLIC_ TALLOC_CTX *pytalloc_get_pool(void)
+{
+	return pytalloc_pool;
+}
+
+_PUBLIC_ TALLOC_CTX *_pytalloc_set_pool(TALLOC_CTX *pool)
+{
+	TALLOC_CTX *prev = pytalloc_pool;
+	pytalloc_pool = pool;
+	return prev;
+}
+
+#else
+
+#define PYTALLOC_POOL_KEY "talloc.pool"
+
+_PUBLIC_ TALLOC_CTX *pytalloc_get_pool(void)
+{
+	PyObject *dict = PyThreadState_GetDict();
+	PyObject *pool;
+
+	if (dict == NULL) {
+		return NULL;
+	}
+	pool = PyDict_GetItemString(dict, PYTALLOC_POOL_KEY);
+	if (pool == NULL) {
+		return NULL;
+	}
+	return PyLong_AsVoidPtr(pool);
+}
+
+_PUBLIC_ TALLOC_CTX *_pytalloc_set_pool(TALLOC_CTX *pool)
+{
+	TALLOC_CTX *prev = pytalloc_get_pool();
+	PyObject *dict = PyThreadState_GetDict();
+	PyObject *value;
+
+	if (dict == NULL) {
+		return prev;
+	}
+	if (pool == NULL) {
+		if (PyDict_DelItemString(dict, PYTALLOC_POOL_KEY) == -1) {
+			PyErr_Clear();
+		}
+		return prev;
+	}
+	value = PyLong_FromVoidPtr(pool);
+	if (value == NULL ||
+	    PyDict_SetItemString(dict, PYTALLOC_POOL_KEY, value) == -1) {
+		PyErr_Clear();
+	}
+	Py_XDECREF(value);
+	return prev;
+}
+
+#endif
+
+/**
+ * The talloc context of a new Python object. Inside a talloc.Pool it
+ * is carved from the pool, but moved to the NULL context right away:
+ * the object must not be freed with the pool, the pool memory just
+ * stays around until the last of its objects is gone.
+ */
+static TALLOC_CTX *pytalloc_new_ctx(void)
+{
+	TALLOC_CTX *pool = pytalloc_get_pool();
+	TALLOC_CTX *ctx;
+
+	if (pool == NULL) {
+		return talloc_new(NULL);
+	}
+
+	ctx = talloc_new(pool);
+	if (ctx == NULL) {
+		return NULL;
+	}
+	talloc_steal(NULL, ctx);
+	return ctx;
+}
+
 /**
  * Import an existing talloc pointer into a Python object.
  */
@@ -101,7 +229,7 @@ _PUBLIC_ PyObject *pytalloc_steal_ex(PyTypeObject *py_type, TALLOC_CTX *mem_ctx,
 		pytalloc_BaseObject *ret
 			= (pytalloc_BaseObject *)py_type->tp_alloc(py_type, 0);
 
-		ret->talloc_ctx = talloc_new(NULL);
+		ret->talloc_ctx = pytalloc_new_ctx();
 		if (ret->talloc_ctx == NULL) {
 			return NULL;
 		}
@@ -123,7 +251,7 @@ _PUBLIC_ PyObject *pytalloc_steal_ex(PyTypeObject *py_type, TALLOC_CTX *mem_ctx,
 		pytalloc_Object *ret
 			= (pytalloc_Object *)py_type->tp_alloc(py_type, 0);
 
-		ret->talloc_ctx = talloc_new(NULL);
+		ret->talloc_ctx = pytalloc_new_ctx();
 		if (ret->talloc_ctx == NULL) {
 			return NULL;
 		}
@@ -175,7 +303,7 @@ _PUBLIC_ PyObject *pytalloc_reference_ex(PyTypeObject *py_type,
 	if (PyType_IsSubtype(py_type, BaseObjectType)) {
 		pytalloc_BaseObject *ret
 			= (pytalloc_BaseObject *)py_type->tp_alloc(py_type, 0);
-		ret->talloc_ctx = talloc_new(NULL);
+		ret->talloc_ctx = pytalloc_new_ctx();
 		if (ret->talloc_ctx == NULL) {
 			return NULL;
 		}
@@ -189,7 +317,7 @@ _PUBLIC_ PyObject *pytalloc_reference_ex(PyTypeObject *py_type,
 	} else if (PyType_IsSubtype(py_type, ObjectType)) {
 		pytalloc_Object *ret
 			= (pytalloc_Object *)py_type->tp_alloc(py_type, 0);
-		ret->talloc_ctx = talloc_new(NULL);
+		ret->talloc_ctx = pytalloc_new_ctx();
 		if (ret->talloc_ctx == NULL) {
 			return NULL;
 		}
@@ -207,6 +335,150 @@ _PUBLIC_ PyObject *pytalloc_reference_ex(PyTypeObject *py_type,
 	}
 }
 
+/**
+ * Import an existing talloc pointer into a Python object that owns it
+ * directly.
+ *
+ * Unlike pytalloc_steal_ex(), no talloc context is created for the
+ * Python object: mem_ctx becomes a top-level chunk and is itself the
+ * context of the object, which talloc_unlink()s it from NULL when it
+ * goes away. Further Python objects for the same mem_ctx have to come
+ * from pytalloc_reference_direct_ex(), a second steal would free it
+ * under the first one.
+ */
+_PUBLIC_ PyObject *pytalloc_steal_direct_ex(PyTypeObject *py_type,
+					    TALLOC_CTX *mem_ctx, void *ptr)
+{
+	PyTypeObject *BaseObjectType = pytalloc_GetBaseObjectType();
+	pytalloc_BaseObject *ret;
+
+	if (mem_ctx == NULL) {
+		return PyErr_NoMemory();
+	}
+
+	if (!PyType_IsSubtype(py_type, BaseObjectType)) {
+		PyErr_SetString(PyExc_RuntimeError,
+				"pytalloc_steal_direct_ex() called for object "
+				"type not based on talloc.BaseObject");
+		return NULL;
+	}
+
+	ret = (pytalloc_BaseObject *)py_type->tp_alloc(py_type, 0);
+	if (ret == NULL) {
+		return NULL;
+	}
+
+	talloc_steal(NULL, mem_ctx);
+	ret->talloc_ctx = mem_ctx;
+	ret->talloc_ptr_ctx = mem_ctx;
+	ret->ptr = ptr;
+	return (PyObject *)ret;
+}
+
+/**
+ * Import an existing talloc pointer into a Python object, leaving the
+ * original parent, and adding a reference from NULL to it.
+ *
+ * This is pytalloc_reference_ex() without a talloc context for the
+ * Python object: the reference is held by the NULL context, and
+ * talloc_unlink(NULL) drops one of those references again when the
+ * object goes away.
+ */
+_PUBLIC_ PyObject *pytalloc_reference_direct_ex(PyTypeObject *py_type,
+						TALLOC_CTX *mem_ctx, void *ptr)
+{
+	PyTypeObject *BaseObjectType = pytalloc_GetBaseObjectType();
+	pytalloc_BaseObject *ret;
+
+	if (mem_ctx == NULL) {
+		return PyErr_NoMemory();
+	}
+
+	if (!PyType_IsSubtype(py_type, BaseObjectType)) {
+		PyErr_SetString(PyExc_RuntimeError,
+				"pytalloc_reference_direct_ex() called for "
+				"object type not based on talloc.BaseObject");
+		return NULL;
+	}
+
+	/*
+	 * Take the reference first, the object must never be
+	 * deallocated without one.
+	 */
+	if (talloc_reference(NULL, mem_ctx) == NULL) {
+		return PyErr_NoMemory();
+	}
+
+	ret = (pytalloc_BaseObject *)py_type->tp_alloc(py_type, 0);
+	if (ret == NULL) {
+		talloc_unlink(NULL, mem_ctx);
+		return NULL;
+	}
+
+	ret->talloc_ctx = mem_ctx;
+	ret->talloc_ptr_ctx = mem_ctx;
+	ret->ptr = ptr;
+	return (PyObject *)ret;
+}
+
+/**
+ * Wrap a whole talloc array of count elements of el_size bytes into a
+ * talloc.Array sequence, adding a single reference from NULL to
+ * mem_ctx.
+ *
+ * The elements are only wrapped when they are looked up, as
+ * item_type objects taken with pytalloc_reference_direct_ex(), so
+ * they keep mem_ctx alive on their own.
+ */
+_PUBLIC_ PyObject *pytalloc_Array_reference_ex(PyTypeObject *item_type,
+					       TALLOC_CTX *mem_ctx, void *array,
+					       size_t el_size, size_t count)
+{
+	PyTypeObject *BaseObjectType = pytalloc_GetBaseObjectType();
+	PyTypeObject *ArrayType = pytalloc_GetArrayType();
+	pytalloc_Array *ret;
+
+	if (mem_ctx == NULL) {
+		return PyErr_NoMemory();
+	}
+
+	if (ArrayType == NULL) {
+		return NULL;
+	}
+
+	if (!PyType_IsSubtype(item_type, BaseObjectType)) {
+		PyErr_SetString(PyExc_RuntimeError,
+				"pytalloc_Array_reference_ex() called for item "
+				"type not based on talloc.BaseObject");
+		return NULL;
+	}
+
+	if (count > (size_t)PY_SSIZE_T_MAX) {
+		PyErr_SetString(PyExc_OverflowError,
+				"talloc array too long for a sequence");
+		return NULL;
+	}
+
+	/* as in pytalloc_reference_direct_ex(), reference first */
+	if (talloc_reference(NULL, mem_ctx) == NULL) {
+		return PyErr_NoMemory();
+	}
+
+	ret = (pytalloc_Array *)ArrayType->tp_alloc(ArrayType, 0);
+	if (ret == NULL) {
+		talloc_unlink(NULL, mem_ctx);
+		return NULL;
+	}
+
+	Py_INCREF(item_type);
+	ret->talloc_ctx = mem_ctx;
+	ret->item_type = item_type;
+	ret->array = (char *)array;
+	ret->el_size = el_size;
+	ret->count = count;
+	return (PyObject *)ret;
+}
+
 #if PY_MAJOR_VERSION < 3
 
 static void py_cobject_talloc_free(void *ptr)
@@ -345,6 +617,27 @@ _PUBLIC_ TALLOC_CTX *_pytalloc_get_mem_ctx(PyObject *py_obj)
 	return NULL;
 }
 
+_PUBLIC_ int pytalloc_BaseObject_set_buffer_writable(PyObject *py_obj,
+						     int writable)
+{
+	PyTypeObject *type = pytalloc_GetBufferObjectType();
+
+	if (type == NULL) {
+		return -1;
+	}
+
+	if (!PyObject_TypeCheck(py_obj, type)) {
+		PyErr_Format(PyExc_TypeError,
+			     "pytalloc_BaseObject_set_buffer_writable: "
+			     "expected a talloc.BufferObject, got %s",
+			     Py_TYPE(py_obj)->tp_name);
+		return -1;
+	}
+
+	((pytalloc_BaseObject *)py_obj)->buffer_writable = (writable != 0);
+	return 0;
+}
+
 _PUBLIC_ int pytalloc_BaseObject_PyType_Ready(PyTypeObject *type)
 {
 	PyTypeObject *talloc_type = pytalloc_GetBaseObjectType();
@@ -37,6 +37,21 @@
 #include <sys/auxv.h>
 #endif
 
+#if defined(HAVE_MMAP) && defined(HAVE_SYS_MMAN_H)
+#include <sys/mman.h>
+#if defined(MAP_ANONYMOUS)
+#define TALLOC_MMAP 1
+#endif
+#endif
+
+#ifdef HAVE_PTHREAD
+#include <pthread.h>
+#define TALLOC_THREADSAFE 1
+#ifdef HAVE___THREAD
+#define TALLOC_CHUNK_CACHE 1
+#endif
+#endif
+
 #if (TALLOC_VERSION_MAJOR != TALLOC_BUILD_VERSION_MAJOR)
 #error "TALLOC_VERSION_MAJOR != TALLOC_BUILD_VERSION_MAJOR"
 #endif
@@ -72,6 +87,18 @@
  */
 #define TALLOC_FLAG_MASK 0x0F
 
+/* These live in the xflags of a chunk, which is not part of the magic */
+#define TALLOC_XFLAG_PARENT_LINKS 0x01	/* All children point to this chunk */
+#define TALLOC_XFLAG_MMAP 0x02		/* Chunk is an anonymous mapping */
+#define TALLOC_XFLAG_POOLGAP 0x04	/* Pool member shrunk in place */
+#define TALLOC_XFLAG_DEFERRED 0x08	/* Destructor runs from the queue */
+#define TALLOC_XFLAG_REF_OWNER 0x10	/* Parent of indexed reference handles */
+#define TALLOC_XFLAG_SLOWFREE 0x20	/* Subtree needs the full free path */
+#define TALLOC_XFLAG_UNLINKED 0x40	/* Arena child not in the child list */
+#define TALLOC_XFLAG_THREADSAFE 0x80	/* This is a thread-safe context */
+#define TALLOC_XFLAG_STRBUF 0x100	/* String with spare capacity */
+#define TALLOC_XFLAG_CURSOR 0x200	/* Maybe on the path of a report cursor */
+
 #define TALLOC_MAGIC_REFERENCE ((const char *)1)
 
 #define TALLOC_MAGIC_BASE 0xe814ec70
@@ -239,13 +266,58 @@ struct talloc_reference_handle {
 	struct talloc_reference_handle *next, *prev;
 	void *ptr;
 	const char *location;
+	/* the parent of the handle, as far as the index knows */
+	struct talloc_chunk *owner;
+	struct talloc_reference_index *index;
+	struct talloc_reference_handle *hash_next, *hash_prev;
+};
+
+/*
+  Once a pointer has TALLOC_REFERENCE_INDEX_MIN references, its
+  reference handles are also hashed by their parent, so that
+  talloc_unlink() and talloc_reparent() find the handle hanging off a
+  given context without walking all of them. The index is shared by
+  all handles of the pointer and freed with the last one.
+
+  The owner of a handle is updated when the handle is stolen. A chunk
+  that is the owner of an indexed handle carries TALLOC_XFLAG_REF_OWNER,
+  and when it moves in talloc_realloc(), or the null_context goes
+  away, the handles among its children are hashed again with their
+  new owner, see tc_ref_rekey_children(). Handles that were not in an
+  index yet get their owner checked when the index is built.
+*/
+#define TALLOC_REFERENCE_INDEX_MIN 16
+
+struct talloc_reference_index {
+	size_t count;
+	size_t num_buckets;
+	struct talloc_reference_handle *buckets[];
 };
 
+/*
+  A memory limit also keeps track of the talloc_total_size() and
+  talloc_total_blocks() of the context that owns it, so that those are
+  available without walking the whole tree. cur_size instead counts the
+  memory really taken from malloc(3), including the talloc headers and
+  whole pools instead of their members.
+
+  Like the memory itself, the totals of a nested limit are passed to
+  the limits above it in batches, see talloc_memlimit_account().
+*/
 struct talloc_memlimit {
 	struct talloc_chunk *parent;
 	struct talloc_memlimit *upper;
+	/* the limits right below that hold credit, see talloc_memlimit_check() */
+	struct talloc_memlimit *lower;
+	struct talloc_memlimit *prev, *next;
 	size_t max_size;
 	size_t cur_size;
+	size_t credit;
+	size_t total_size;
+	size_t total_blocks;
+	/* the change of the totals not passed to 'upper' yet, modulo SIZE_MAX + 1 */
+	size_t pending_size;
+	size_t pending_blocks;
 };
 
 static inline bool talloc_memlimit_check(struct talloc_memlimit *limit, size_t size);
@@ -253,7 +325,15 @@ static inline void talloc_memlimit_grow(struct talloc_memlimit *limit,
 				size_t size);
 static inline void talloc_memlimit_shrink(struct talloc_memlimit *limit,
 				size_t size);
+static inline void talloc_memlimit_account(struct talloc_memlimit *limit,
+				size_t size, size_t blocks);
+static inline void talloc_memlimit_unaccount(struct talloc_memlimit *limit,
+				size_t size, size_t blocks);
 static inline void tc_memlimit_update_on_free(struct talloc_chunk *tc);
+static inline void tc_memlimit_unaccount_chunk(struct talloc_chunk *tc);
+static void tc_memlimit_reclaim(struct talloc_memlimit *limit);
+static void tc_memlimit_release_credit(struct talloc_memlimit *limit);
+static void tc_memlimit_release_all(struct talloc_memlimit *limit);
 
 static inline void _tc_set_name_const(struct talloc_chunk *tc,
 				const char *name);
@@ -272,6 +352,13 @@ struct talloc_chunk {
 	 */
 	unsigned flags;
 
+	/*
+	 * TALLOC_XFLAG_*, for which there is no room left next to the
+	 * magic. On 64 bit systems this only fills the padding before
+	 * the pointers, and TC_HDR_SIZE stays the same everywhere.
+	 */
+	unsigned xflags;
+
 	/*
 	 * If you have a logical tree like:
 	 *
@@ -322,6 +409,14 @@ struct talloc_chunk {
 #define TC_HDR_SIZE TC_ALIGN16(sizeof(struct talloc_chunk))
 #define TC_PTR_FROM_CHUNK(tc) ((void *)(TC_HDR_SIZE + (char*)tc))
 
+/*
+ * Chunks that come from malloc(3) are always rounded up to a 16 byte
+ * size class. This allows the chunk cache below to recycle a block
+ * for any chunk of the same size class, no matter whether the block
+ * was originally allocated, realloc'ed or shrunk in place.
+ */
+#define TC_MALLOC_SIZE(size) TC_ALIGN16(TC_HDR_SIZE + (size))
+
 _PUBLIC_ int talloc_version_major(void)
 {
 	return TALLOC_VERSION_MAJOR;
@@ -572,11 +667,29 @@ static inline struct talloc_chunk *talloc_parent_chunk(const void *ptr)
 	}
 
 	tc = talloc_chunk_from_ptr(ptr);
-	while (tc->prev) tc=tc->prev;
+	while (tc->parent == NULL && tc->prev) tc=tc->prev;
 
 	return tc->parent;
 }
 
+/*
+  mark a chunk and all its parents as needing the full free path.
+
+  A chunk without TALLOC_XFLAG_SLOWFREE is guaranteed to have no
+  destructors, references, pools or memory limits anywhere in its
+  subtree, so its children can be released with a simple linear
+  sweep, see _tc_free_children_fast(). The flag is never cleared,
+  and if a chunk has it, all of its parents have it as well.
+*/
+static inline void tc_set_slowfree(struct talloc_chunk *tc)
+{
+	while (tc != NULL && !(tc->xflags & TALLOC_XFLAG_SLOWFREE)) {
+		tc->xflags |= TALLOC_XFLAG_SLOWFREE;
+		while (tc->parent == NULL && tc->prev) tc = tc->prev;
+		tc = tc->parent;
+	}
+}
+
 _PUBLIC_ void *talloc_parent(const void *ptr)
 {
 	struct talloc_chunk *tc = talloc_parent_chunk(ptr);
@@ -605,14 +718,81 @@ _PUBLIC_ const char *talloc_parent_name(const void *ptr)
   memory footprint of each talloc chunk by those 16 bytes.
 */
 
+struct talloc_pool_chain;
+
 struct talloc_pool_hdr {
 	void *end;
 	unsigned int object_count;
 	size_t poolsize;
+	struct talloc_pool_chain *chain;
 };
 
 #define TP_HDR_SIZE TC_ALIGN16(sizeof(struct talloc_pool_hdr))
 
+/*
+  A growable pool created with talloc_growable_pool() does not fall
+  back to malloc(3) once it is full. Instead it chains additional
+  slabs, each twice the size of the previous one, until the pool as a
+  whole reaches its maximum size.
+
+  Every slab looks like a pool of its own: it has a pool header, a
+  talloc_chunk with TALLOC_FLAG_POOL set that is not linked into any
+  talloc hierarchy, and it counts the chunks allocated from it in
+  object_count. The slabs are linked through the 'next' pointer of
+  their chunk, and the pool header of the pool itself and of all
+  slabs points to the shared talloc_pool_chain.
+
+  When the pool is freed, the slabs are released exactly like pools
+  whose talloc_chunk got freed: memory that is still in use by chunks
+  stolen out of the pool is only given back when the last of them is
+  freed.
+
+  talloc_pool_enable_reuse() also attaches a talloc_pool_chain to a
+  pool, with max_size limiting it to its initial memory if it is not
+  growable, and sets up 'bins'. A pool member that is freed in the
+  middle of its slab then stays in the bin for its 16 byte size class,
+  and the next chunk of exactly that size takes its place. The freed
+  talloc_chunk itself is the bin entry: it keeps its size, its pool
+  pointer and its free magic, and is linked through 'next'. Entries
+  of a slab are dropped from the bins when the slab is reset.
+
+  An arena created with talloc_arena() is a growable pool with 'arena'
+  set. Its direct children are bump allocated with tc_alloc_arena()
+  and carry TALLOC_XFLAG_UNLINKED: they point to the arena as their
+  parent, but are not put into its list of children and are not counted
+  in the object_count of their slab. They simply go away together with
+  the arena. As soon as such a chunk needs to be found when the arena
+  is freed, because it gets a destructor, a reference, a child or a
+  memory limit, or is stolen or reallocated, tc_arena_link() puts it
+  into the list and counts it like any other pool member. Slabs of an
+  arena are never reset while the arena is alive, as their
+  object_count does not tell whether unlinked chunks are still in use.
+*/
+
+#define TC_POOL_BIN_MAX_SIZE 1024
+#define TC_POOL_NUM_BINS ((TC_POOL_BIN_MAX_SIZE / 16) + 1)
+
+struct talloc_pool_chain {
+	struct talloc_pool_hdr *pool;
+	struct talloc_pool_hdr *current;
+	struct talloc_chunk *slabs;
+	size_t num_slabs;
+	size_t slab_bytes;
+	size_t total_size;
+	size_t next_size;
+	size_t max_size;
+	size_t fallbacks;
+	struct talloc_chunk **bins;
+	size_t num_binned;
+	size_t reused;
+	bool arena;
+};
+
+static inline bool tc_pool_is_arena(struct talloc_pool_hdr *pool_hdr)
+{
+	return pool_hdr->chain != NULL && pool_hdr->chain->arena;
+}
+
 static inline struct talloc_pool_hdr *talloc_pool_from_chunk(struct talloc_chunk *c)
 {
 	return (struct talloc_pool_hdr *)((char *)c - TP_HDR_SIZE);
@@ -660,6 +840,295 @@ static inline void tc_invalidate_pool(struct talloc_pool_hdr *pool_hdr)
 #endif
 }
 
+/*
+  Pools backed by transparent hugepages.
+
+  With talloc_set_pool_hugepage_threshold(), the memory of pools and
+  pool slabs of at least the threshold size comes from an anonymous
+  mapping aligned to a hugepage and advised with MADV_HUGEPAGE, instead
+  of from malloc(3). The pool header starts the mapping, and its length
+  always follows from the poolsize, rounded up to whole hugepages so
+  that the kernel can back all of the pool with them. The pool chunk
+  carries TALLOC_XFLAG_MMAP; pools are never reallocated, so the flag
+  only matters when the pool memory is released.
+*/
+
+#define TC_HUGEPAGE_SIZE ((size_t)2 * 1024 * 1024)
+
+#define TC_HUGEPAGE_LEN(poolsize) \
+	((TP_HDR_SIZE + TC_HDR_SIZE + (poolsize) + TC_HUGEPAGE_SIZE - 1) & \
+	 ~(TC_HUGEPAGE_SIZE - 1))
+
+#if defined(TALLOC_MMAP) && defined(MADV_HUGEPAGE)
+#define TALLOC_HUGEPAGES 1
+#endif
+
+static size_t tc_hugepage_threshold;
+
+#ifdef TALLOC_HUGEPAGES
+
+static inline bool tc_hugepages_wanted(size_t poolsize)
+{
+	return tc_hugepage_threshold != 0 && poolsize >= tc_hugepage_threshold;
+}
+
+static struct talloc_pool_hdr *tc_hugepage_map(size_t poolsize)
+{
+	size_t len = TC_HUGEPAGE_LEN(poolsize);
+	char *p, *aligned;
+	size_t head;
+
+	if (len < poolsize) {
+		return NULL;
+	}
+
+	/* map one hugepage more and cut the mapping down to an aligned one */
+	p = mmap(NULL, len + TC_HUGEPAGE_SIZE, PROT_READ | PROT_WRITE,
+		 MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+	if (p == MAP_FAILED) {
+		return NULL;
+	}
+
+	aligned = (char *)(((uintptr_t)p + TC_HUGEPAGE_SIZE - 1) &
+			   ~(uintptr_t)(TC_HUGEPAGE_SIZE - 1));
+	head = aligned - p;
+	if (head != 0) {
+		munmap(p, head);
+	}
+	munmap(aligned + len, TC_HUGEPAGE_SIZE - head);
+
+	/* only a hint, without hugepages this is still a working pool */
+	madvise(aligned, len, MADV_HUGEPAGE);
+
+	return (struct talloc_pool_hdr *)aligned;
+}
+
+static inline void tc_hugepage_unmap(struct talloc_pool_hdr *pool_hdr)
+{
+	munmap(pool_hdr, TC_HUGEPAGE_LEN(pool_hdr->poolsize));
+}
+
+#else
+
+static inline bool tc_hugepages_wanted(size_t poolsize)
+{
+	return false;
+}
+
+static inline struct talloc_pool_hdr *tc_hugepage_map(size_t poolsize)
+{
+	return NULL;
+}
+
+static inline void tc_hugepage_unmap(struct talloc_pool_hdr *pool_hdr)
+{
+}
+
+#endif
+
+/*
+  Release the memory of a pool or pool slab, xflags are those of its
+  pool chunk from before it was invalidated.
+*/
+static inline void tc_pool_block_free(struct talloc_pool_hdr *pool_hdr,
+				      unsigned xflags)
+{
+	if (unlikely(xflags & TALLOC_XFLAG_MMAP)) {
+		tc_hugepage_unmap(pool_hdr);
+		return;
+	}
+	free(pool_hdr);
+}
+
+_PUBLIC_ int talloc_set_pool_hugepage_threshold(size_t threshold)
+{
+#ifdef TALLOC_HUGEPAGES
+	if (threshold != 0 && threshold < TC_HUGEPAGE_SIZE) {
+		threshold = TC_HUGEPAGE_SIZE;
+	}
+	tc_hugepage_threshold = threshold;
+	return 0;
+#else
+	if (threshold == 0) {
+		return 0;
+	}
+	errno = ENOSYS;
+	return -1;
+#endif
+}
+
+/*
+  Add a slab with room for at least chunk_size bytes to a growable pool
+  and make it the one new chunks are allocated from.
+*/
+static struct talloc_pool_hdr *tc_pool_chain_grow(struct talloc_pool_chain *chain,
+						  size_t chunk_size)
+{
+	struct talloc_chunk *pool_tc = talloc_chunk_from_pool(chain->pool);
+	struct talloc_pool_hdr *slab_hdr;
+	struct talloc_chunk *slab;
+	size_t slab_size = MAX(chain->next_size, chunk_size);
+	size_t slab_len;
+	unsigned slab_xflags = 0;
+
+	if (chain->max_size != 0) {
+		size_t room = 0;
+
+		if (chain->max_size > chain->total_size) {
+			room = chain->max_size - chain->total_size;
+		}
+		if (room < chunk_size) {
+			chain->fallbacks++;
+			return NULL;
+		}
+		slab_size = MIN(slab_size, room);
+	}
+
+	slab_len = TP_HDR_SIZE + TC_HDR_SIZE + slab_size;
+	if (slab_len < slab_size) {
+		chain->fallbacks++;
+		return NULL;
+	}
+
+	if (!talloc_memlimit_check(pool_tc->limit, slab_len)) {
+		chain->fallbacks++;
+		return NULL;
+	}
+
+	slab_hdr = NULL;
+	if (unlikely(tc_hugepages_wanted(slab_size))) {
+		slab_hdr = tc_hugepage_map(slab_size);
+		if (slab_hdr != NULL) {
+			slab_xflags |= TALLOC_XFLAG_MMAP;
+		}
+	}
+	if (slab_hdr == NULL) {
+		slab_hdr = malloc(slab_len);
+	}
+	if (slab_hdr == NULL) {
+		chain->fallbacks++;
+		return NULL;
+	}
+
+	talloc_memlimit_grow(pool_tc->limit, slab_len);
+
+	slab = talloc_chunk_from_pool(slab_hdr);
+	slab->flags = talloc_magic | TALLOC_FLAG_POOL;
+	slab->xflags = slab_xflags;
+	slab->parent = slab->child = slab->prev = NULL;
+	slab->refs = NULL;
+	slab->destructor = NULL;
+	slab->name = "talloc_pool_slab";
+	slab->size = 0;
+	slab->limit = NULL;
+	slab->pool = NULL;
+
+	slab->next = chain->slabs;
+	chain->slabs = slab;
+
+	slab_hdr->object_count = 1;
+	slab_hdr->end = tc_pool_first_chunk(slab_hdr);
+	slab_hdr->poolsize = slab_size;
+	slab_hdr->chain = chain;
+
+	tc_invalidate_pool(slab_hdr);
+
+	chain->current = slab_hdr;
+	chain->num_slabs++;
+	chain->slab_bytes += slab_len;
+	chain->total_size += slab_size;
+	if (slab_size * 2 > slab_size) {
+		chain->next_size = slab_size * 2;
+	}
+
+	return slab_hdr;
+}
+
+/*
+  Take a freed chunk of exactly chunk_size bytes out of the bins of a
+  pool and turn it into a new pool member.
+*/
+static inline struct talloc_chunk *tc_pool_bins_get(struct talloc_pool_chain *chain,
+						    size_t chunk_size)
+{
+	size_t idx = chunk_size / 16;
+	struct talloc_chunk *result = chain->bins[idx];
+
+	if (result == NULL) {
+		return NULL;
+	}
+
+	chain->bins[idx] = result->next;
+	chain->num_binned--;
+	chain->reused++;
+
+#if defined(DEVELOPER) && defined(VALGRIND_MAKE_MEM_UNDEFINED)
+	VALGRIND_MAKE_MEM_UNDEFINED(result, chunk_size);
+#endif
+
+	result->flags = talloc_magic | TALLOC_FLAG_POOLMEM;
+	result->xflags = 0;
+	result->pool->object_count++;
+
+	return result;
+}
+
+/*
+  Keep the freed pool member tc in the bins of its pool.
+*/
+static inline bool tc_pool_bins_put(struct talloc_pool_chain *chain,
+				    struct talloc_chunk *tc)
+{
+	size_t chunk_size = TC_ALIGN16(TC_HDR_SIZE + tc->size);
+	size_t idx = chunk_size / 16;
+
+	if (chain->bins == NULL || chunk_size > TC_POOL_BIN_MAX_SIZE) {
+		return false;
+	}
+
+	if (tc->flags & TALLOC_FLAG_POOL) {
+		/* a nested pool spans more than its talloc_chunk */
+		return false;
+	}
+
+#if defined(DEVELOPER) && defined(VALGRIND_MAKE_MEM_DEFINED)
+	VALGRIND_MAKE_MEM_DEFINED(tc, TC_HDR_SIZE);
+#endif
+
+	tc->next = chain->bins[idx];
+	chain->bins[idx] = tc;
+	chain->num_binned++;
+
+	return true;
+}
+
+/*
+  Drop all bin entries inside the given slab of a pool, because the
+  slab is about to be reset or its memory is reused otherwise.
+*/
+static void tc_pool_bins_purge(struct talloc_pool_chain *chain,
+			       struct talloc_pool_hdr *pool_hdr)
+{
+	size_t i;
+
+	if (chain->bins == NULL || chain->num_binned == 0) {
+		return;
+	}
+
+	for (i = 0; i < TC_POOL_NUM_BINS; i++) {
+		struct talloc_chunk **pp = &chain->bins[i];
+
+		while (*pp != NULL) {
+			if ((*pp)->pool == pool_hdr) {
+				*pp = (*pp)->next;
+				chain->num_binned--;
+			} else {
+				pp = &(*pp)->next;
+			}
+		}
+	}
+}
+
 /*
   Allocate from a pool
 */
@@ -676,6 +1145,11 @@ static inline struct talloc_chunk *tc_alloc_pool(struct talloc_chunk *parent,
 		return NULL;
 	}
 
+	if (parent->xflags & TALLOC_XFLAG_THREADSAFE) {
+		/* pools are not thread-safe */
+		return NULL;
+	}
+
 	if (parent->flags & TALLOC_FLAG_POOL) {
 		pool_hdr = talloc_pool_from_chunk(parent);
 	}
@@ -687,15 +1161,35 @@ static inline struct talloc_chunk *tc_alloc_pool(struct talloc_chunk *parent,
 		return NULL;
 	}
 
-	space_left = tc_pool_space_left(pool_hdr);
-
 	/*
 	 * Align size to 16 bytes
 	 */
 	chunk_size = TC_ALIGN16(size + prefix_len);
 
+	if (pool_hdr->chain != NULL) {
+		struct talloc_pool_chain *chain = pool_hdr->chain;
+
+		if (chain->bins != NULL && prefix_len == 0 &&
+		    chunk_size <= TC_POOL_BIN_MAX_SIZE) {
+			result = tc_pool_bins_get(chain, chunk_size);
+			if (result != NULL) {
+				return result;
+			}
+		}
+
+		pool_hdr = chain->current;
+	}
+
+	space_left = tc_pool_space_left(pool_hdr);
+
 	if (space_left < chunk_size) {
-		return NULL;
+		if (pool_hdr->chain == NULL) {
+			return NULL;
+		}
+		pool_hdr = tc_pool_chain_grow(pool_hdr->chain, chunk_size);
+		if (pool_hdr == NULL) {
+			return NULL;
+		}
 	}
 
 	result = (struct talloc_chunk *)((char *)pool_hdr->end + prefix_len);
@@ -707,6 +1201,7 @@ static inline struct talloc_chunk *tc_alloc_pool(struct talloc_chunk *parent,
 	pool_hdr->end = (void *)((char *)pool_hdr->end + chunk_size);
 
 	result->flags = talloc_magic | TALLOC_FLAG_POOLMEM;
+	result->xflags = 0;
 	result->pool = pool_hdr;
 
 	pool_hdr->object_count++;
@@ -715,128 +1210,1316 @@ static inline struct talloc_chunk *tc_alloc_pool(struct talloc_chunk *parent,
 }
 
 /*
-   Allocate a bit of memory as a child of an existing pointer
+  The largest child of parent that can be carved out of the current
+  pool space without growing the pool, or 0 if parent does not
+  allocate from a pool. Children under a memory limit are not
+  included, an oversized allocation could fail the limit check.
 */
-static inline void *__talloc_with_prefix(const void *context,
-					size_t size,
-					size_t prefix_len,
-					struct talloc_chunk **tc_ret)
+static inline size_t tc_pool_room(struct talloc_chunk *parent)
 {
-	struct talloc_chunk *tc = NULL;
-	struct talloc_memlimit *limit = NULL;
-	size_t total_len = TC_HDR_SIZE + size + prefix_len;
-	struct talloc_chunk *parent = NULL;
+	struct talloc_pool_hdr *pool_hdr = NULL;
+	size_t space_left;
 
-	if (unlikely(context == NULL)) {
-		context = null_context;
+	if (parent->limit != NULL ||
+	    (parent->xflags & TALLOC_XFLAG_THREADSAFE)) {
+		return 0;
 	}
 
-	if (unlikely(size >= MAX_TALLOC_SIZE)) {
-		return NULL;
+	if (parent->flags & TALLOC_FLAG_POOL) {
+		pool_hdr = talloc_pool_from_chunk(parent);
+	}
+	else if (parent->flags & TALLOC_FLAG_POOLMEM) {
+		pool_hdr = parent->pool;
 	}
 
-	if (unlikely(total_len < TC_HDR_SIZE)) {
-		return NULL;
+	if (pool_hdr == NULL) {
+		return 0;
 	}
 
-	if (likely(context != NULL)) {
-		parent = talloc_chunk_from_ptr(context);
+	/*
+	 * Shrinking a direct child of an arena links it, which costs
+	 * more than the stack buffer saves.
+	 */
+	if (tc_pool_is_arena(pool_hdr)) {
+		return 0;
+	}
 
-		if (parent->limit != NULL) {
-			limit = parent->limit;
-		}
+	if (pool_hdr->chain != NULL) {
+		pool_hdr = pool_hdr->chain->current;
+	}
 
-		tc = tc_alloc_pool(parent, TC_HDR_SIZE+size, prefix_len);
+	space_left = tc_pool_space_left(pool_hdr) & ~(size_t)15;
+	if (space_left <= TC_HDR_SIZE) {
+		return 0;
 	}
 
-	if (tc == NULL) {
-		char *ptr;
+	return space_left - TC_HDR_SIZE;
+}
 
-		/*
-		 * Only do the memlimit check/update on actual allocation.
-		 */
-		if (!talloc_memlimit_check(limit, total_len)) {
-			errno = ENOMEM;
-			return NULL;
+/*
+  Grow the pool member tc to new_chunk_size bytes without moving it.
+  The chunks following tc are taken over as long as they are freed,
+  and once they reach the end of the used part of the pool, the space
+  left in the pool. A freed pool member keeps its header, see
+  _tc_free_poolmem(), only a member shrunk in place is followed by a
+  gap instead of a header and carries TALLOC_XFLAG_POOLGAP. Freed
+  members of a pool with bins may still sit in a bin, so those pools
+  only grow into the space left.
+*/
+static inline bool tc_pool_grow_in_place(struct talloc_chunk *tc,
+					 struct talloc_pool_hdr *pool_hdr,
+					 size_t new_chunk_size)
+{
+	const unsigned free_mask = ~TALLOC_FLAG_MASK | TALLOC_FLAG_FREE |
+		TALLOC_FLAG_POOL | TALLOC_FLAG_POOLMEM;
+	const unsigned free_flags = TALLOC_MAGIC_NON_RANDOM |
+		TALLOC_FLAG_FREE | TALLOC_FLAG_POOLMEM;
+	char *end = (char *)pool_hdr->end;
+	char *want = (char *)tc + new_chunk_size;
+	char *next = (char *)tc_next_chunk(tc);
+	bool binned = pool_hdr->chain != NULL &&
+		pool_hdr->chain->bins != NULL;
+
+	if (tc->xflags & TALLOC_XFLAG_POOLGAP) {
+		return false;
+	}
+
+	while (next < want) {
+		struct talloc_chunk *n = (struct talloc_chunk *)next;
+
+		if (next == end) {
+			if (want > (char *)tc_pool_end(pool_hdr)) {
+				return false;
+			}
+			pool_hdr->end = want;
+			return true;
 		}
-
-		ptr = malloc(total_len);
-		if (unlikely(ptr == NULL)) {
-			return NULL;
+		if (binned || next > end ||
+		    (n->flags & free_mask) != free_flags ||
+		    (n->xflags & (TALLOC_XFLAG_POOLGAP |
+				  TALLOC_XFLAG_UNLINKED)) ||
+		    n->pool != pool_hdr) {
+			return false;
 		}
-		tc = (struct talloc_chunk *)(ptr + prefix_len);
-		tc->flags = talloc_magic;
-		tc->pool  = NULL;
-
-		talloc_memlimit_grow(limit, total_len);
+		next = (char *)tc_next_chunk(n);
 	}
 
-	tc->limit = limit;
-	tc->size = size;
-	tc->destructor = NULL;
-	tc->child = NULL;
-	tc->name = NULL;
-	tc->refs = NULL;
+	if ((size_t)(next - want) >= TC_HDR_SIZE) {
+		/* keep the rest of the last freed chunk as a freed chunk */
+		struct talloc_chunk *rest = (struct talloc_chunk *)want;
 
-	if (likely(context != NULL)) {
-		if (parent->child) {
-			parent->child->parent = NULL;
-			tc->next = parent->child;
-			tc->next->prev = tc;
-		} else {
-			tc->next = NULL;
+#if defined(DEVELOPER) && defined(VALGRIND_MAKE_MEM_UNDEFINED)
+		VALGRIND_MAKE_MEM_UNDEFINED(rest, TC_HDR_SIZE);
+#endif
+		memset(rest, 0, TC_HDR_SIZE);
+		rest->flags = free_flags;
+		rest->size = next - want - TC_HDR_SIZE;
+		rest->pool = pool_hdr;
+	} else if (next > want) {
+		tc->xflags |= TALLOC_XFLAG_POOLGAP;
+	}
+
+	return true;
+}
+
+/*
+  Allocate a direct child of an arena, without linking it to the arena.
+  Returns NULL if parent is not an arena or its current slab is full.
+*/
+static inline struct talloc_chunk *tc_alloc_arena(struct talloc_chunk *parent,
+						  size_t size)
+{
+	struct talloc_pool_hdr *pool_hdr = talloc_pool_from_chunk(parent);
+	struct talloc_chunk *tc;
+	size_t chunk_size = TC_ALIGN16(TC_HDR_SIZE + size);
+
+	if (!tc_pool_is_arena(pool_hdr)) {
+		return NULL;
+	}
+
+	pool_hdr = pool_hdr->chain->current;
+
+	if (tc_pool_space_left(pool_hdr) < chunk_size) {
+		return NULL;
+	}
+
+	tc = (struct talloc_chunk *)pool_hdr->end;
+
+#if defined(DEVELOPER) && defined(VALGRIND_MAKE_MEM_UNDEFINED)
+	VALGRIND_MAKE_MEM_UNDEFINED(tc, chunk_size);
+#endif
+
+	pool_hdr->end = (void *)((char *)tc + chunk_size);
+
+	tc->flags = talloc_magic | TALLOC_FLAG_POOLMEM;
+	tc->xflags = TALLOC_XFLAG_UNLINKED;
+	tc->pool = pool_hdr;
+	tc->limit = parent->limit;
+	tc->size = size;
+	tc->destructor = NULL;
+	tc->child = NULL;
+	tc->name = NULL;
+	tc->refs = NULL;
+	tc->parent = parent;
+	tc->next = tc->prev = NULL;
+
+	return tc;
+}
+
+/*
+  Put an unlinked arena child into the list of children of the arena.
+*/
+static inline void tc_arena_link(struct talloc_chunk *tc)
+{
+	struct talloc_chunk *parent = tc->parent;
+
+	tc->xflags &= ~TALLOC_XFLAG_UNLINKED;
+	tc->pool->object_count++;
+
+	/* only linked chunks are counted in the memory limits */
+	tc->limit = parent->limit;
+	talloc_memlimit_account(tc->limit, tc->size, 1);
+
+	if (parent->child) {
+		if (!(parent->xflags & TALLOC_XFLAG_PARENT_LINKS)) {
+			parent->child->parent = NULL;
 		}
-		tc->parent = parent;
-		tc->prev = NULL;
-		parent->child = tc;
+		tc->next = parent->child;
+		tc->next->prev = tc;
+	} else {
+		tc->next = NULL;
+	}
+	tc->prev = NULL;
+	parent->child = tc;
+}
+
+/*
+  Per-thread cache of small free chunks.
+
+  When enabled with talloc_enable_chunk_cache(), small chunks that
+  came from malloc(3) are not handed back to free(3) when they are
+  released. Instead they are kept on a per-thread free list for their
+  16 byte size class, and the next allocation of the same size class
+  in the same thread takes them from there. The number of chunks
+  kept per size class is bounded by the depth given to
+  talloc_enable_chunk_cache(). Disabling the cache flushes the cache
+  of the calling thread only, the cache of every other thread is
+  flushed when that thread exits.
+*/
+
+#define TC_CACHE_MAX_SIZE 256
+#define TC_CACHE_NUM_CLASSES ((TC_CACHE_MAX_SIZE / 16) + 1)
+
+#ifdef TALLOC_CHUNK_CACHE
+
+struct talloc_chunk_cache {
+	bool registered;
+	unsigned int count[TC_CACHE_NUM_CLASSES];
+	struct talloc_chunk *list[TC_CACHE_NUM_CLASSES];
+};
+
+static __thread struct talloc_chunk_cache tc_cache;
+static unsigned int tc_cache_depth;
+static pthread_once_t tc_cache_once = PTHREAD_ONCE_INIT;
+static pthread_key_t tc_cache_key;
+static bool tc_cache_key_valid;
+
+static void tc_cache_flush(struct talloc_chunk_cache *cache)
+{
+	size_t i;
+
+	for (i = 0; i < TC_CACHE_NUM_CLASSES; i++) {
+		while (cache->list[i] != NULL) {
+			struct talloc_chunk *tc = cache->list[i];
+			cache->list[i] = tc->next;
+			free(tc);
+		}
+		cache->count[i] = 0;
+	}
+}
+
+static void tc_cache_thread_exit(void *ptr)
+{
+	struct talloc_chunk_cache *cache = (struct talloc_chunk_cache *)ptr;
+
+	tc_cache_flush(cache);
+	cache->registered = false;
+}
+
+static void tc_cache_key_init(void)
+{
+	if (pthread_key_create(&tc_cache_key, tc_cache_thread_exit) == 0) {
+		tc_cache_key_valid = true;
+	}
+}
+
+/*
+  Take a block for a chunk of the given size from the cache of the
+  calling thread. Returns NULL if there is none.
+*/
+static inline struct talloc_chunk *tc_cache_get(size_t size)
+{
+	struct talloc_chunk_cache *cache;
+	struct talloc_chunk *tc;
+	size_t idx;
+
+	if (likely(tc_cache_depth == 0) || size > TC_CACHE_MAX_SIZE) {
+		return NULL;
+	}
+
+	cache = &tc_cache;
+	idx = TC_ALIGN16(size) / 16;
+
+	tc = cache->list[idx];
+	if (tc == NULL) {
+		return NULL;
+	}
+	cache->list[idx] = tc->next;
+	cache->count[idx]--;
+
+#if defined(DEVELOPER) && defined(VALGRIND_MAKE_MEM_UNDEFINED)
+	VALGRIND_MAKE_MEM_UNDEFINED(tc, TC_MALLOC_SIZE(size));
+#endif
+
+	return tc;
+}
+
+/*
+  Put the block of an already freed chunk into the cache of the
+  calling thread. Returns false if the block has to go back to
+  free(3) instead.
+*/
+static inline bool tc_cache_put(struct talloc_chunk *tc)
+{
+	struct talloc_chunk_cache *cache;
+	size_t idx;
+
+	if (likely(tc_cache_depth == 0) || tc->size > TC_CACHE_MAX_SIZE) {
+		return false;
+	}
+
+	cache = &tc_cache;
+	idx = TC_ALIGN16(tc->size) / 16;
+
+	if (cache->count[idx] >= tc_cache_depth) {
+		return false;
+	}
+
+	if (unlikely(!cache->registered)) {
+		/*
+		 * Make sure the cache is flushed when this
+		 * thread exits.
+		 */
+		if (pthread_setspecific(tc_cache_key, cache) != 0) {
+			return false;
+		}
+		cache->registered = true;
+	}
+
+#if defined(DEVELOPER) && defined(VALGRIND_MAKE_MEM_UNDEFINED)
+	VALGRIND_MAKE_MEM_UNDEFINED(&tc->next, sizeof(tc->next));
+#endif
+
+	tc->next = cache->list[idx];
+	cache->list[idx] = tc;
+	cache->count[idx]++;
+
+	return true;
+}
+
+#else
+
+static inline struct talloc_chunk *tc_cache_get(size_t size)
+{
+	return NULL;
+}
+
+static inline bool tc_cache_put(struct talloc_chunk *tc)
+{
+	return false;
+}
+
+#endif
+
+_PUBLIC_ int talloc_enable_chunk_cache(unsigned int depth)
+{
+#ifdef TALLOC_CHUNK_CACHE
+	if (depth == 0) {
+		talloc_disable_chunk_cache();
+		return 0;
+	}
+	if (pthread_once(&tc_cache_once, tc_cache_key_init) != 0 ||
+	    !tc_cache_key_valid) {
+		errno = ENOMEM;
+		return -1;
+	}
+	tc_cache_depth = depth;
+	return 0;
+#else
+	errno = ENOSYS;
+	return -1;
+#endif
+}
+
+_PUBLIC_ void talloc_disable_chunk_cache(void)
+{
+#ifdef TALLOC_CHUNK_CACHE
+	tc_cache_depth = 0;
+	tc_cache_flush(&tc_cache);
+#endif
+}
+
+/*
+  Chunks backed by anonymous memory mappings.
+
+  With talloc_set_mmap_threshold(), chunks of at least the threshold
+  size that would come from malloc(3) get a mapping of their own
+  instead, and carry TALLOC_XFLAG_MMAP. Growing or shrinking such a
+  chunk with talloc_realloc() moves the pages with mremap(2) rather
+  than copying the contents, and a chunk from malloc(3) that grows
+  beyond the threshold is moved into a mapping once. The length of
+  the mapping always follows from tc->size, so every size change of
+  such a chunk goes through tc_mmap_realloc().
+*/
+
+static size_t tc_mmap_threshold;
+static size_t tc_page_size;
+
+#define TC_MMAP_LEN(size) \
+	((TC_HDR_SIZE + (size) + tc_page_size - 1) & ~(tc_page_size - 1))
+
+#ifdef TALLOC_MMAP
+
+static inline bool tc_mmap_wanted(size_t size)
+{
+	return tc_mmap_threshold != 0 && size >= tc_mmap_threshold;
+}
+
+static struct talloc_chunk *tc_mmap_alloc(size_t size)
+{
+	void *p = mmap(NULL, TC_MMAP_LEN(size), PROT_READ | PROT_WRITE,
+		       MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+
+	if (p == MAP_FAILED) {
+		return NULL;
+	}
+	return (struct talloc_chunk *)p;
+}
+
+static struct talloc_chunk *tc_mmap_realloc(struct talloc_chunk *tc,
+					    size_t size)
+{
+	size_t old_len = TC_MMAP_LEN(tc->size);
+	size_t new_len = TC_MMAP_LEN(size);
+	void *p;
+
+#ifdef HAVE_MREMAP
+	p = mremap(tc, old_len, new_len, MREMAP_MAYMOVE);
+	if (p == MAP_FAILED) {
+		return NULL;
+	}
+#else
+	p = tc_mmap_alloc(size);
+	if (p == NULL) {
+		return NULL;
+	}
+	memcpy(p, tc, MIN(old_len, new_len));
+	munmap(tc, old_len);
+#endif
+	return (struct talloc_chunk *)p;
+}
+
+static inline void tc_mmap_free(struct talloc_chunk *tc)
+{
+	munmap(tc, TC_MMAP_LEN(tc->size));
+}
+
+#else
+
+static inline bool tc_mmap_wanted(size_t size)
+{
+	return false;
+}
+
+static inline struct talloc_chunk *tc_mmap_alloc(size_t size)
+{
+	return NULL;
+}
+
+static inline struct talloc_chunk *tc_mmap_realloc(struct talloc_chunk *tc,
+						   size_t size)
+{
+	return NULL;
+}
+
+static inline void tc_mmap_free(struct talloc_chunk *tc)
+{
+}
+
+#endif
+
+_PUBLIC_ int talloc_set_mmap_threshold(size_t threshold)
+{
+#ifdef TALLOC_MMAP
+	if (tc_page_size == 0) {
+		long page_size = sysconf(_SC_PAGESIZE);
+
+		if (page_size <= 0) {
+			errno = ENOSYS;
+			return -1;
+		}
+		tc_page_size = page_size;
+	}
+	if (threshold != 0 && threshold < tc_page_size) {
+		threshold = tc_page_size;
+	}
+	tc_mmap_threshold = threshold;
+	return 0;
+#else
+	if (threshold == 0) {
+		return 0;
+	}
+	errno = ENOSYS;
+	return -1;
+#endif
+}
+
+/*
+  Sampling allocation profiler.
+
+  With talloc_enable_sampling(), every thread counts down the bytes of
+  its allocations with a constant name, like those of talloc(),
+  talloc_size(), talloc_array() and talloc_realloc(). The distance
+  between two sample points is drawn from an exponential distribution
+  with the sampling interval as its mean, so every byte is equally
+  likely to be sampled, as in a Poisson process. An allocation that
+  contains a sample point is recorded under its name, usually its
+  location in the source, in a fixed-size table. A recorded allocation
+  of size bytes stands for 1 / (1 - e^(-size / interval)) allocations,
+  which is how talloc_sample_report() estimates the real numbers.
+
+  Only the table is shared between threads. Sites beyond the capacity
+  of the table are recorded together under tc_sample_other.
+*/
+
+#define TC_SAMPLE_TABLE_SIZE 1024
+#define TC_SAMPLE_MAX_SITES (TC_SAMPLE_TABLE_SIZE * 3 / 4)
+
+struct tc_sample_site {
+	const char *location;
+	size_t samples;
+	double count;
+	double bytes;
+};
+
+struct tc_sampler {
+	unsigned generation;
+	uint64_t random;
+	size_t bytes_left;
+};
+
+static size_t tc_sample_interval;
+static unsigned tc_sample_generation;
+static struct tc_sample_site tc_sample_table[TC_SAMPLE_TABLE_SIZE];
+static size_t tc_sample_num_sites;
+static const char tc_sample_other[] = "other sites";
+static const char tc_sample_reference[] = "talloc_reference()";
+
+#ifdef HAVE___THREAD
+static __thread struct tc_sampler tc_sampler;
+#else
+static struct tc_sampler tc_sampler;
+#endif
+
+#ifdef TALLOC_THREADSAFE
+static pthread_mutex_t tc_sample_mutex = PTHREAD_MUTEX_INITIALIZER;
+#define TC_SAMPLE_LOCK() pthread_mutex_lock(&tc_sample_mutex)
+#define TC_SAMPLE_UNLOCK() pthread_mutex_unlock(&tc_sample_mutex)
+#else
+#define TC_SAMPLE_LOCK() do { } while (0)
+#define TC_SAMPLE_UNLOCK() do { } while (0)
+#endif
+
+/* ln(x) for 0 < x <= 1, without depending on libm */
+static double tc_sample_log(double x)
+{
+	double t, t2;
+	int k = 0;
+
+	while (x < 0.5) {
+		x *= 2;
+		k++;
+	}
+	t = (x - 1) / (x + 1);
+	t2 = t * t;
+	return 2 * t * (1 + t2 * (1.0 / 3 + t2 * (1.0 / 5 +
+		t2 * (1.0 / 7 + t2 / 9)))) - k * 0.6931471805599453;
+}
+
+/* e^(-x) for x >= 0, without depending on libm */
+static double tc_sample_exp_neg(double x)
+{
+	double r = 1, term = 1;
+	int i, k = 0;
+
+	if (x > 40) {
+		return 0;
+	}
+	while (x > 0.5) {
+		x /= 2;
+		k++;
+	}
+	for (i = 1; i <= 10; i++) {
+		term *= -x / i;
+		r += term;
+	}
+	while (k-- > 0) {
+		r *= r;
+	}
+	return r;
+}
+
+/* the distance in bytes to the next sample point */
+static size_t tc_sample_distance(struct tc_sampler *s, size_t interval)
+{
+	double u;
+
+	if (s->random == 0) {
+		s->random = ((uint64_t)(uintptr_t)s << 16) ^
+			((uint64_t)talloc_magic << 32) ^ 0x9e3779b97f4a7c15ULL;
+	}
+	/* xorshift64* */
+	s->random ^= s->random >> 12;
+	s->random ^= s->random << 25;
+	s->random ^= s->random >> 27;
+	u = ((s->random * 0x2545f4914f6cdd1dULL) >> 11) *
+		(1.0 / 9007199254740992.0);
+
+	return (size_t)(-tc_sample_log(1 - u) * interval) + 1;
+}
+
+static void tc_sample_record(const char *location, size_t size,
+			     size_t interval)
+{
+	double weight = 1 / (1 - tc_sample_exp_neg((double)size / interval));
+	size_t i = ((uintptr_t)location >> 3) % TC_SAMPLE_TABLE_SIZE;
+	struct tc_sample_site *site;
+
+	TC_SAMPLE_LOCK();
+	for (;;) {
+		site = &tc_sample_table[i];
+		if (site->location == location) {
+			break;
+		}
+		if (site->location == NULL) {
+			if (tc_sample_num_sites >= TC_SAMPLE_MAX_SITES &&
+			    location != tc_sample_other) {
+				TC_SAMPLE_UNLOCK();
+				tc_sample_record(tc_sample_other, size,
+						 interval);
+				return;
+			}
+			site->location = location;
+			tc_sample_num_sites++;
+			break;
+		}
+		i = (i + 1) % TC_SAMPLE_TABLE_SIZE;
+	}
+	site->samples++;
+	site->count += weight;
+	site->bytes += weight * size;
+	TC_SAMPLE_UNLOCK();
+}
+
+static void tc_sample_take(size_t size, const char *name)
+{
+	struct tc_sampler *s = &tc_sampler;
+	size_t interval = tc_sample_interval;
+
+	if (interval == 0) {
+		return;
+	}
+
+	if (s->generation != tc_sample_generation) {
+		/* the interval has changed */
+		s->generation = tc_sample_generation;
+		s->bytes_left = tc_sample_distance(s, interval);
+		if (size < s->bytes_left) {
+			s->bytes_left -= size;
+			return;
+		}
+	}
+
+	/*
+	 * The next sample point is counted from the end of this
+	 * allocation, the distribution has no memory.
+	 */
+	s->bytes_left = tc_sample_distance(s, interval);
+	if (name == TALLOC_MAGIC_REFERENCE) {
+		name = tc_sample_reference;
+	}
+	tc_sample_record(name, size, interval);
+}
+
+static inline void tc_sample(size_t size, const char *name)
+{
+	struct tc_sampler *s;
+
+	if (likely(tc_sample_interval == 0)) {
+		return;
+	}
+
+	s = &tc_sampler;
+	if (likely(size < s->bytes_left &&
+		   s->generation == tc_sample_generation)) {
+		s->bytes_left -= size;
+		return;
+	}
+
+	tc_sample_take(size, name);
+}
+
+_PUBLIC_ void talloc_enable_sampling(size_t interval)
+{
+	tc_sample_generation++;
+	tc_sample_interval = interval;
+}
+
+_PUBLIC_ void talloc_disable_sampling(void)
+{
+	tc_sample_interval = 0;
+}
+
+static int tc_sample_cmp(const void *a, const void *b)
+{
+	const struct talloc_sample *sa = (const struct talloc_sample *)a;
+	const struct talloc_sample *sb = (const struct talloc_sample *)b;
+
+	if (sa->bytes != sb->bytes) {
+		return sa->bytes < sb->bytes ? 1 : -1;
+	}
+	return strcmp(sa->location, sb->location);
+}
+
+_PUBLIC_ size_t talloc_sample_report(struct talloc_sample *samples,
+				     size_t num_samples)
+{
+	struct talloc_sample all[TC_SAMPLE_MAX_SITES + 1];
+	size_t i, n = 0;
+
+	TC_SAMPLE_LOCK();
+	for (i = 0; i < TC_SAMPLE_TABLE_SIZE; i++) {
+		struct tc_sample_site *site = &tc_sample_table[i];
+
+		if (site->location == NULL) {
+			continue;
+		}
+		all[n].location = site->location;
+		all[n].samples = site->samples;
+		all[n].count = (size_t)(site->count + 0.5);
+		all[n].bytes = (size_t)(site->bytes + 0.5);
+		n++;
+	}
+	TC_SAMPLE_UNLOCK();
+
+	qsort(all, n, sizeof(all[0]), tc_sample_cmp);
+	if (num_samples > 0) {
+		memcpy(samples, all, MIN(n, num_samples) * sizeof(all[0]));
+	}
+
+	return n;
+}
+
+_PUBLIC_ void talloc_sample_reset(void)
+{
+	TC_SAMPLE_LOCK();
+	memset(tc_sample_table, 0, sizeof(tc_sample_table));
+	tc_sample_num_sites = 0;
+	TC_SAMPLE_UNLOCK();
+}
+
+/*
+  A thread-safe context created with talloc_threadsafe_context()
+  carries a mutex in a prefix in front of its talloc_chunk. The mutex
+  protects the list of children of the context, so that several
+  threads can add and remove children of it at the same time.
+
+  Thread-safe contexts have TALLOC_XFLAG_PARENT_LINKS, every child
+  keeps its parent pointer, not just the first one. That way
+  a child finds the mutex to take without walking its siblings, which
+  another thread might be changing at the same time.
+*/
+
+#ifdef TALLOC_THREADSAFE
+
+struct talloc_threadsafe_hdr {
+	pthread_mutex_t mutex;
+	bool initialised;
+};
+
+#define TS_HDR_SIZE TC_ALIGN16(sizeof(struct talloc_threadsafe_hdr))
+
+static inline struct talloc_threadsafe_hdr *talloc_threadsafe_from_chunk(
+	struct talloc_chunk *c)
+{
+	return (struct talloc_threadsafe_hdr *)((char *)c - TS_HDR_SIZE);
+}
+
+static inline void tc_threadsafe_lock(struct talloc_chunk *tc)
+{
+	if (unlikely(tc->xflags & TALLOC_XFLAG_THREADSAFE)) {
+		pthread_mutex_lock(&talloc_threadsafe_from_chunk(tc)->mutex);
+	}
+}
+
+static inline void tc_threadsafe_unlock(struct talloc_chunk *tc)
+{
+	if (unlikely(tc->xflags & TALLOC_XFLAG_THREADSAFE)) {
+		pthread_mutex_unlock(&talloc_threadsafe_from_chunk(tc)->mutex);
+	}
+}
+
+static inline void tc_threadsafe_destroy(struct talloc_chunk *tc)
+{
+	struct talloc_threadsafe_hdr *ts_hdr = talloc_threadsafe_from_chunk(tc);
+
+	if (ts_hdr->initialised) {
+		pthread_mutex_destroy(&ts_hdr->mutex);
+		ts_hdr->initialised = false;
+	}
+}
+
+#else
+
+#define TS_HDR_SIZE 0
+
+static inline void *talloc_threadsafe_from_chunk(struct talloc_chunk *c)
+{
+	return c;
+}
+
+static inline void tc_threadsafe_lock(struct talloc_chunk *tc)
+{
+}
+
+static inline void tc_threadsafe_unlock(struct talloc_chunk *tc)
+{
+}
+
+static inline void tc_threadsafe_destroy(struct talloc_chunk *tc)
+{
+}
+
+#endif
+
+/*
+  Put tc into the list of children of a context with
+  TALLOC_XFLAG_PARENT_LINKS, which thread-safe contexts always have.
+*/
+static inline void tc_link_with_parent(struct talloc_chunk *parent,
+				       struct talloc_chunk *tc)
+{
+	tc_threadsafe_lock(parent);
+	tc->parent = parent;
+	tc->prev = NULL;
+	tc->next = parent->child;
+	if (tc->next) {
+		tc->next->prev = tc;
+	}
+	parent->child = tc;
+	tc_threadsafe_unlock(parent);
+}
+
+/* Make a new chunk the first child of parent */
+static inline void tc_link_new_child(struct talloc_chunk *parent,
+				     struct talloc_chunk *tc)
+{
+	if (unlikely(parent->xflags & TALLOC_XFLAG_PARENT_LINKS)) {
+		tc_link_with_parent(parent, tc);
+		return;
+	}
+
+	if (parent->child) {
+		parent->child->parent = NULL;
+		tc->next = parent->child;
+		tc->next->prev = tc;
+	} else {
+		tc->next = NULL;
+	}
+	tc->parent = parent;
+	tc->prev = NULL;
+	parent->child = tc;
+}
+
+/*
+   Allocate a bit of memory as a child of an existing pointer
+*/
+static inline void *__talloc_with_prefix(const void *context,
+					size_t size,
+					size_t prefix_len,
+					struct talloc_chunk **tc_ret)
+{
+	struct talloc_chunk *tc = NULL;
+	struct talloc_memlimit *limit = NULL;
+	size_t total_len = TC_HDR_SIZE + size + prefix_len;
+	struct talloc_chunk *parent = NULL;
+
+	if (unlikely(context == NULL)) {
+		context = null_context;
+	}
+
+	if (unlikely(size >= MAX_TALLOC_SIZE)) {
+		return NULL;
+	}
+
+	if (unlikely(total_len < TC_HDR_SIZE)) {
+		return NULL;
+	}
+
+	if (likely(context != NULL)) {
+		parent = talloc_chunk_from_ptr(context);
+
+		if (parent->limit != NULL) {
+			limit = parent->limit;
+		}
+
+		if (unlikely(parent->flags & TALLOC_FLAG_POOL) &&
+		    prefix_len == 0) {
+			tc = tc_alloc_arena(parent, size);
+			if (tc != NULL) {
+				/*
+				 * Sampled by the caller like any other
+				 * chunk, see _talloc_named_const().
+				 */
+				*tc_ret = tc;
+				return TC_PTR_FROM_CHUNK(tc);
+			}
+		}
+
+		if (unlikely(parent->xflags & TALLOC_XFLAG_UNLINKED)) {
+			tc_arena_link(parent);
+		}
+
+		tc = tc_alloc_pool(parent, TC_HDR_SIZE+size, prefix_len);
+	}
+
+	if (tc == NULL) {
+		char *ptr;
+		unsigned xflags = 0;
+
+		/*
+		 * Only do the memlimit check/update on actual allocation.
+		 */
+		if (!talloc_memlimit_check(limit, total_len)) {
+			errno = ENOMEM;
+			return NULL;
+		}
+
+		if (likely(prefix_len == 0)) {
+			tc = tc_cache_get(size);
+			if (unlikely(tc == NULL && tc_mmap_wanted(size))) {
+				tc = tc_mmap_alloc(size);
+				if (tc != NULL) {
+					xflags |= TALLOC_XFLAG_MMAP;
+				}
+			}
+		} else if (prefix_len == TP_HDR_SIZE &&
+			   unlikely(tc_hugepages_wanted(size))) {
+			/* only pools come with a size and this prefix */
+			struct talloc_pool_hdr *pool_hdr = tc_hugepage_map(size);
+
+			if (pool_hdr != NULL) {
+				tc = talloc_chunk_from_pool(pool_hdr);
+				xflags |= TALLOC_XFLAG_MMAP;
+			}
+		}
+		if (tc == NULL) {
+			ptr = malloc(TC_ALIGN16(total_len));
+			if (unlikely(ptr == NULL)) {
+				return NULL;
+			}
+			tc = (struct talloc_chunk *)(ptr + prefix_len);
+		}
+		tc->flags = talloc_magic;
+		tc->xflags = xflags;
+		tc->pool  = NULL;
+
+		talloc_memlimit_grow(limit, total_len);
+	}
+
+	tc->limit = limit;
+	tc->size = size;
+	tc->destructor = NULL;
+	tc->child = NULL;
+	tc->name = NULL;
+	tc->refs = NULL;
+
+	if (likely(context != NULL)) {
+		tc_link_new_child(parent, tc);
 	} else {
 		tc->next = tc->prev = tc->parent = NULL;
 	}
 
-	*tc_ret = tc;
-	return TC_PTR_FROM_CHUNK(tc);
+	if (unlikely(limit != NULL)) {
+		talloc_memlimit_account(limit, size, 1);
+	}
+
+	*tc_ret = tc;
+	return TC_PTR_FROM_CHUNK(tc);
+}
+
+static inline void *__talloc(const void *context,
+			size_t size,
+			struct talloc_chunk **tc)
+{
+	return __talloc_with_prefix(context, size, 0, tc);
+}
+
+/*
+ * Create a talloc pool, without marking its parents for the slow free
+ * path. That is only right for a pool that never stays in the tree,
+ * see _talloc_array_of_chunks().
+ */
+
+static inline void *__talloc_pool(const void *context, size_t size)
+{
+	struct talloc_chunk *tc;
+	struct talloc_pool_hdr *pool_hdr;
+	void *result;
+
+	result = __talloc_with_prefix(context, size, TP_HDR_SIZE, &tc);
+
+	if (unlikely(result == NULL)) {
+		return NULL;
+	}
+
+	pool_hdr = talloc_pool_from_chunk(tc);
+
+	tc->flags |= TALLOC_FLAG_POOL;
+	tc->size = 0;
+
+	/* the pool memory is not part of talloc_total_size() */
+	talloc_memlimit_unaccount(tc->limit, size, 0);
+
+	pool_hdr->object_count = 1;
+	pool_hdr->end = result;
+	pool_hdr->poolsize = size;
+	pool_hdr->chain = NULL;
+
+	tc_invalidate_pool(pool_hdr);
+
+	return result;
+}
+
+/*
+ * Create a talloc pool
+ */
+
+static inline void *_talloc_pool(const void *context, size_t size)
+{
+	void *result = __talloc_pool(context, size);
+
+	if (likely(result != NULL)) {
+		tc_set_slowfree(talloc_chunk_from_ptr(result));
+	}
+
+	return result;
+}
+
+_PUBLIC_ void *talloc_pool(const void *context, size_t size)
+{
+	return _talloc_pool(context, size);
+}
+
+/*
+ * Attach a talloc_pool_chain to a pool
+ */
+
+static struct talloc_pool_chain *tc_pool_chain_new(struct talloc_pool_hdr *pool_hdr,
+						   size_t max_size)
+{
+	struct talloc_pool_chain *chain;
+
+	chain = malloc(sizeof(struct talloc_pool_chain));
+	if (chain == NULL) {
+		return NULL;
+	}
+
+	chain->pool = pool_hdr;
+	chain->current = pool_hdr;
+	chain->slabs = NULL;
+	chain->num_slabs = 1;
+	chain->slab_bytes = 0;
+	chain->total_size = pool_hdr->poolsize;
+	chain->next_size = MAX(pool_hdr->poolsize, 1024) * 2;
+	chain->max_size = max_size;
+	chain->fallbacks = 0;
+	chain->bins = NULL;
+	chain->num_binned = 0;
+	chain->reused = 0;
+	chain->arena = false;
+
+	pool_hdr->chain = chain;
+
+	return chain;
+}
+
+/*
+ * Create a talloc pool that grows by chaining additional slabs
+ */
+
+_PUBLIC_ void *talloc_growable_pool(const void *context, size_t size,
+				    size_t max_size)
+{
+	struct talloc_pool_chain *chain;
+	struct talloc_pool_hdr *pool_hdr;
+	void *result;
+
+	if (max_size != 0 && max_size < size) {
+		errno = EINVAL;
+		return NULL;
+	}
+
+	result = _talloc_pool(context, size);
+	if (unlikely(result == NULL)) {
+		return NULL;
+	}
+
+	pool_hdr = talloc_pool_from_chunk(talloc_chunk_from_ptr(result));
+
+	chain = tc_pool_chain_new(pool_hdr, max_size);
+	if (chain == NULL) {
+		talloc_free(result);
+		return NULL;
+	}
+
+	return result;
 }
 
-static inline void *__talloc(const void *context,
-			size_t size,
-			struct talloc_chunk **tc)
+/*
+ * Create an arena
+ */
+
+_PUBLIC_ void *talloc_arena(const void *context, size_t size)
 {
-	return __talloc_with_prefix(context, size, 0, tc);
+	void *result;
+
+	result = talloc_growable_pool(context, size, 0);
+	if (unlikely(result == NULL)) {
+		return NULL;
+	}
+
+	talloc_pool_from_chunk(talloc_chunk_from_ptr(result))->chain->arena = true;
+
+	return result;
 }
 
 /*
- * Create a talloc pool
+ * Reset all slabs of an arena that no longer contain linked children,
+ * after all children of the arena were freed
  */
 
-static inline void *_talloc_pool(const void *context, size_t size)
+static void tc_arena_reset_slab(struct talloc_pool_chain *chain,
+				struct talloc_pool_hdr *pool_hdr)
+{
+	if (pool_hdr->object_count != 1) {
+		return;
+	}
+	tc_pool_bins_purge(chain, pool_hdr);
+	pool_hdr->end = tc_pool_first_chunk(pool_hdr);
+	tc_invalidate_pool(pool_hdr);
+}
+
+static void tc_arena_reset(struct talloc_pool_chain *chain)
+{
+	struct talloc_chunk *slab;
+
+	tc_arena_reset_slab(chain, chain->pool);
+
+	for (slab = chain->slabs; slab != NULL; slab = slab->next) {
+		tc_arena_reset_slab(chain, talloc_pool_from_chunk(slab));
+	}
+}
+
+/*
+ * Create a thread-safe context
+ */
+
+_PUBLIC_ void *talloc_threadsafe_context(const void *context)
 {
+#ifdef TALLOC_THREADSAFE
 	struct talloc_chunk *tc;
-	struct talloc_pool_hdr *pool_hdr;
+	struct talloc_threadsafe_hdr *ts_hdr;
 	void *result;
 
-	result = __talloc_with_prefix(context, size, TP_HDR_SIZE, &tc);
+	if (context != NULL && talloc_chunk_from_ptr(context)->limit != NULL) {
+		/* memory limits are not thread-safe */
+		errno = EINVAL;
+		return NULL;
+	}
 
+	result = __talloc_with_prefix(context, 0, TS_HDR_SIZE, &tc);
 	if (unlikely(result == NULL)) {
 		return NULL;
 	}
 
-	pool_hdr = talloc_pool_from_chunk(tc);
+	if (tc->limit != NULL) {
+		/* the null_context has a limit */
+		talloc_free(result);
+		errno = EINVAL;
+		return NULL;
+	}
 
-	tc->flags |= TALLOC_FLAG_POOL;
-	tc->size = 0;
+	tc->xflags |= TALLOC_XFLAG_THREADSAFE;
+	tc->xflags |= TALLOC_XFLAG_PARENT_LINKS;
+	ts_hdr = talloc_threadsafe_from_chunk(tc);
+	ts_hdr->initialised = false;
 
-	pool_hdr->object_count = 1;
-	pool_hdr->end = result;
-	pool_hdr->poolsize = size;
+	if (pthread_mutex_init(&ts_hdr->mutex, NULL) != 0) {
+		talloc_free(result);
+		errno = ENOMEM;
+		return NULL;
+	}
+	ts_hdr->initialised = true;
 
-	tc_invalidate_pool(pool_hdr);
+	_tc_set_name_const(tc, "talloc_threadsafe_context");
+
+	/* the mutex has to be destroyed on free */
+	tc_set_slowfree(tc);
 
 	return result;
+#else
+	errno = ENOSYS;
+	return NULL;
+#endif
 }
 
-_PUBLIC_ void *talloc_pool(const void *context, size_t size)
+/*
+ * Reuse the space of freed children inside a talloc pool
+ */
+
+_PUBLIC_ int talloc_pool_enable_reuse(const void *ptr)
 {
-	return _talloc_pool(context, size);
+	struct talloc_chunk *tc = talloc_chunk_from_ptr(ptr);
+	struct talloc_pool_hdr *pool_hdr;
+	struct talloc_pool_chain *chain;
+
+	if (!(tc->flags & TALLOC_FLAG_POOL)) {
+		errno = EINVAL;
+		return -1;
+	}
+
+	pool_hdr = talloc_pool_from_chunk(tc);
+
+	chain = pool_hdr->chain;
+	if (chain == NULL) {
+		/* a normal pool keeps to its initial memory */
+		chain = tc_pool_chain_new(pool_hdr, pool_hdr->poolsize);
+		if (chain == NULL) {
+			errno = ENOMEM;
+			return -1;
+		}
+	}
+
+	if (chain->bins == NULL) {
+		chain->bins = calloc(TC_POOL_NUM_BINS,
+				     sizeof(struct talloc_chunk *));
+		if (chain->bins == NULL) {
+			errno = ENOMEM;
+			return -1;
+		}
+	}
+
+	return 0;
+}
+
+/*
+ * Release the additional slabs of a growable pool that is being freed
+ */
+
+static inline void tc_pool_chain_free(struct talloc_chunk *pool_tc,
+				      const char *location)
+{
+	struct talloc_pool_hdr *pool_hdr = talloc_pool_from_chunk(pool_tc);
+	struct talloc_pool_chain *chain = pool_hdr->chain;
+	struct talloc_chunk *slab, *next;
+
+	talloc_memlimit_shrink(pool_tc->limit, chain->slab_bytes);
+
+	for (slab = chain->slabs; slab != NULL; slab = next) {
+		struct talloc_pool_hdr *slab_hdr = talloc_pool_from_chunk(slab);
+
+		next = slab->next;
+		slab->next = NULL;
+		slab_hdr->chain = NULL;
+
+		_talloc_chunk_set_free(slab, location);
+		slab_hdr->object_count--;
+
+		if (slab_hdr->object_count == 0) {
+			unsigned xflags = slab->xflags;
+
+			TC_INVALIDATE_FULL_CHUNK(slab);
+			tc_pool_block_free(slab_hdr, xflags);
+		}
+	}
+
+	pool_hdr->chain = NULL;
+	free(chain->bins);
+	free(chain);
+}
+
+/*
+ * Return statistics about a talloc pool
+ */
+
+_PUBLIC_ int talloc_pool_stats(const void *ptr, struct talloc_pool_stats *stats)
+{
+	struct talloc_chunk *tc = talloc_chunk_from_ptr(ptr);
+	struct talloc_pool_hdr *pool_hdr;
+	struct talloc_pool_chain *chain;
+	struct talloc_chunk *slab;
+
+	if (!(tc->flags & TALLOC_FLAG_POOL)) {
+		errno = EINVAL;
+		return -1;
+	}
+
+	pool_hdr = talloc_pool_from_chunk(tc);
+	chain = pool_hdr->chain;
+
+	stats->num_slabs = 1;
+	stats->size = pool_hdr->poolsize;
+	stats->used = (char *)pool_hdr->end -
+		(char *)tc_pool_first_chunk(pool_hdr);
+	stats->wasted = 0;
+	stats->fallbacks = 0;
+	stats->reused = 0;
+
+	if (chain == NULL) {
+		return 0;
+	}
+
+	if (chain->current != pool_hdr) {
+		stats->wasted += tc_pool_space_left(pool_hdr);
+	}
+
+	for (slab = chain->slabs; slab != NULL; slab = slab->next) {
+		struct talloc_pool_hdr *slab_hdr = talloc_pool_from_chunk(slab);
+
+		stats->num_slabs++;
+		stats->size += slab_hdr->poolsize;
+		stats->used += (char *)slab_hdr->end -
+			(char *)tc_pool_first_chunk(slab_hdr);
+		if (chain->current != slab_hdr) {
+			stats->wasted += tc_pool_space_left(slab_hdr);
+		}
+	}
+
+	stats->fallbacks = chain->fallbacks;
+	stats->reused = chain->reused;
+
+	return 0;
 }
 
 /*
@@ -889,6 +2572,7 @@ _PUBLIC_ void *_talloc_pooled_object(const void *ctx,
 
 	tc = talloc_chunk_from_ptr(ret);
 	tc->size = type_size;
+	talloc_memlimit_account(tc->limit, type_size, 0);
 
 	pool_hdr = talloc_pool_from_chunk(tc);
 
@@ -915,6 +2599,13 @@ _PUBLIC_ void _talloc_set_destructor(const void *ptr, int (*destructor)(void *))
 {
 	struct talloc_chunk *tc = talloc_chunk_from_ptr(ptr);
 	tc->destructor = destructor;
+	tc->xflags &= ~TALLOC_XFLAG_DEFERRED;
+	if (destructor != NULL) {
+		if (unlikely(tc->xflags & TALLOC_XFLAG_UNLINKED)) {
+			tc_arena_link(tc);
+		}
+		tc_set_slowfree(tc);
+	}
 }
 
 /*
@@ -928,6 +2619,153 @@ _PUBLIC_ int talloc_increase_ref_count(const void *ptr)
 	return 0;
 }
 
+static inline size_t tc_ref_hash(struct talloc_reference_index *index,
+				 struct talloc_chunk *owner)
+{
+	uintptr_t key = (uintptr_t)owner >> 4;
+
+	return (key * 2654435761U) & (index->num_buckets - 1);
+}
+
+static inline void tc_ref_index_insert(struct talloc_reference_index *index,
+				       struct talloc_reference_handle *h)
+{
+	size_t b = tc_ref_hash(index, h->owner);
+
+	if (h->owner != NULL) {
+		h->owner->xflags |= TALLOC_XFLAG_REF_OWNER;
+	}
+
+	h->hash_prev = NULL;
+	h->hash_next = index->buckets[b];
+	if (h->hash_next != NULL) {
+		h->hash_next->hash_prev = h;
+	}
+	index->buckets[b] = h;
+	index->count++;
+}
+
+static inline void tc_ref_index_remove(struct talloc_reference_index *index,
+				       struct talloc_reference_handle *h)
+{
+	if (h->hash_prev != NULL) {
+		h->hash_prev->hash_next = h->hash_next;
+	} else {
+		index->buckets[tc_ref_hash(index, h->owner)] = h->hash_next;
+	}
+	if (h->hash_next != NULL) {
+		h->hash_next->hash_prev = h->hash_prev;
+	}
+	h->hash_next = h->hash_prev = NULL;
+	index->count--;
+}
+
+/*
+  Record a new parent of a reference handle.
+*/
+static inline void tc_ref_set_owner(struct talloc_reference_handle *h,
+				    struct talloc_chunk *owner)
+{
+	if (h->index != NULL) {
+		tc_ref_index_remove(h->index, h);
+		h->owner = owner;
+		tc_ref_index_insert(h->index, h);
+	} else {
+		h->owner = owner;
+	}
+}
+
+/*
+  (Re)build the index of the references to tc with num_buckets buckets.
+  On failure the references stay as they were.
+*/
+static void tc_ref_index_build(struct talloc_chunk *tc, size_t num_buckets)
+{
+	struct talloc_reference_index *old_index = tc->refs->index;
+	struct talloc_reference_index *index;
+	struct talloc_reference_handle *h, *last = NULL;
+
+	index = (struct talloc_reference_index *)calloc(1,
+		sizeof(struct talloc_reference_index) +
+		num_buckets * sizeof(struct talloc_reference_handle *));
+	if (index == NULL) {
+		return;
+	}
+	index->num_buckets = num_buckets;
+
+	/* add the oldest first, so each bucket lists the newest first */
+	for (h = tc->refs; h != NULL; h = h->next) {
+		last = h;
+	}
+	for (h = last; h != NULL; h = h->prev) {
+		if (old_index == NULL) {
+			/* nobody kept the owner up to date so far */
+			h->owner = talloc_parent_chunk(h);
+		}
+		h->index = index;
+		tc_ref_index_insert(index, h);
+	}
+
+	free(old_index);
+}
+
+/*
+  Find the most recent reference to tc hanging off owner, NULL for
+  references without a parent.
+*/
+static struct talloc_reference_handle *tc_ref_find(struct talloc_chunk *tc,
+						    struct talloc_chunk *owner)
+{
+	struct talloc_reference_index *index;
+	struct talloc_reference_handle *h;
+
+	if (tc->refs == NULL) {
+		return NULL;
+	}
+
+	index = tc->refs->index;
+
+	if (index != NULL) {
+		h = index->buckets[tc_ref_hash(index, owner)];
+		for (; h != NULL; h = h->hash_next) {
+			if (h->owner == owner) {
+				return h;
+			}
+		}
+		return NULL;
+	}
+
+	for (h = tc->refs; h != NULL; h = h->next) {
+		if (talloc_parent_chunk(h) == owner) {
+			return h;
+		}
+	}
+
+	return NULL;
+}
+
+/*
+  The chunk owner moved or went away, hash the indexed reference
+  handles among its children again with new_owner.
+*/
+static void tc_ref_rekey_children(struct talloc_chunk *owner,
+				  struct talloc_chunk *new_owner)
+{
+	struct talloc_chunk *c;
+
+	for (c = owner->child; c != NULL; c = c->next) {
+		struct talloc_reference_handle *h;
+
+		if (c->name != TALLOC_MAGIC_REFERENCE) {
+			continue;
+		}
+		h = (struct talloc_reference_handle *)TC_PTR_FROM_CHUNK(c);
+		if (h->index != NULL) {
+			tc_ref_set_owner(h, new_owner);
+		}
+	}
+}
+
 /*
   helper for talloc_reference()
 
@@ -937,6 +2775,13 @@ static int talloc_reference_destructor(struct talloc_reference_handle *handle)
 {
 	struct talloc_chunk *ptr_tc = talloc_chunk_from_ptr(handle->ptr);
 	_TLIST_REMOVE(ptr_tc->refs, handle);
+	if (handle->index != NULL) {
+		tc_ref_index_remove(handle->index, handle);
+		if (ptr_tc->refs == NULL) {
+			free(handle->index);
+		}
+		handle->index = NULL;
+	}
 	return 0;
 }
 
@@ -964,6 +2809,7 @@ static inline void *_talloc_named_const(const void *context, size_t size, const
 	}
 
 	_tc_set_name_const(tc, name);
+	tc_sample(size, name);
 
 	return ptr;
 }
@@ -989,17 +2835,49 @@ _PUBLIC_ void *_talloc_reference_loc(const void *context, const void *ptr, const
 						   TALLOC_MAGIC_REFERENCE);
 	if (unlikely(handle == NULL)) return NULL;
 
+	/* the size of reference handles is not part of talloc_total_size() */
+	talloc_memlimit_unaccount(talloc_chunk_from_ptr(handle)->limit,
+				  sizeof(struct talloc_reference_handle), 0);
+
 	/* note that we hang the destructor off the handle, not the
 	   main context as that allows the caller to still setup their
 	   own destructor on the context if they want to */
 	talloc_set_destructor(handle, talloc_reference_destructor);
 	handle->ptr = discard_const_p(void, ptr);
 	handle->location = location;
+	/* the handle is the first child of its parent, this is cheap */
+	handle->owner = talloc_parent_chunk(handle);
+	handle->hash_next = handle->hash_prev = NULL;
+	handle->index = NULL;
 	_TLIST_ADD(tc->refs, handle);
+	if (handle->next != NULL && handle->next->index != NULL) {
+		struct talloc_reference_index *index = handle->next->index;
+
+		handle->index = index;
+		tc_ref_index_insert(index, handle);
+		if (index->count > 2 * index->num_buckets) {
+			tc_ref_index_build(tc, 4 * index->num_buckets);
+		}
+	} else if (handle->next != NULL) {
+		struct talloc_reference_handle *h;
+		size_t count = 0;
+
+		for (h = handle; h != NULL; h = h->next) {
+			count++;
+		}
+		if (count >= TALLOC_REFERENCE_INDEX_MIN) {
+			tc_ref_index_build(tc, TALLOC_REFERENCE_INDEX_MIN);
+		}
+	}
+	if (unlikely(tc->xflags & TALLOC_XFLAG_UNLINKED)) {
+		tc_arena_link(tc);
+	}
+	tc_set_slowfree(tc);
 	return handle->ptr;
 }
 
 static void *_talloc_steal_internal(const void *new_ctx, const void *ptr);
+static bool tc_has_threadsafe(struct talloc_chunk *root);
 
 static inline void _tc_free_poolmem(struct talloc_chunk *tc,
 					const char *location)
@@ -1007,15 +2885,28 @@ static inline void _tc_free_poolmem(struct talloc_chunk *tc,
 	struct talloc_pool_hdr *pool;
 	struct talloc_chunk *pool_tc;
 	void *next_tc;
+	bool unlinked;
 
 	pool = tc->pool;
 	pool_tc = talloc_chunk_from_pool(pool);
 	next_tc = tc_next_chunk(tc);
+	unlinked = (tc->xflags & TALLOC_XFLAG_UNLINKED);
 
 	_talloc_chunk_set_free(tc, location);
 
 	TC_INVALIDATE_FULL_CHUNK(tc);
 
+	if (unlikely(unlinked)) {
+		/*
+		 * Unlinked arena children are not counted in
+		 * object_count, see tc_alloc_arena().
+		 */
+		if (pool->end == next_tc) {
+			pool->end = tc;
+		}
+		return;
+	}
+
 	if (unlikely(pool->object_count == 0)) {
 		talloc_abort("Pool object count zero!");
 		return;
@@ -1024,7 +2915,8 @@ static inline void _tc_free_poolmem(struct talloc_chunk *tc,
 	pool->object_count--;
 
 	if (unlikely(pool->object_count == 1
-		     && !(pool_tc->flags & TALLOC_FLAG_FREE))) {
+		     && !(pool_tc->flags & TALLOC_FLAG_FREE)
+		     && !tc_pool_is_arena(pool))) {
 		/*
 		 * if there is just one object left in the pool
 		 * and pool->flags does not have TALLOC_FLAG_FREE,
@@ -1032,6 +2924,9 @@ static inline void _tc_free_poolmem(struct talloc_chunk *tc,
 		 * the rest is available for new objects
 		 * again.
 		 */
+		if (pool->chain != NULL) {
+			tc_pool_bins_purge(pool->chain, pool);
+		}
 		pool->end = tc_pool_first_chunk(pool);
 		tc_invalidate_pool(pool);
 		return;
@@ -1048,6 +2943,8 @@ static inline void _tc_free_poolmem(struct talloc_chunk *tc,
 		if (pool_tc->flags & TALLOC_FLAG_POOLMEM) {
 			_tc_free_poolmem(pool_tc, location);
 		} else {
+			unsigned xflags = pool_tc->xflags;
+
 			/*
 			 * The tc_memlimit_update_on_free()
 			 * call takes into account the
@@ -1056,7 +2953,7 @@ static inline void _tc_free_poolmem(struct talloc_chunk *tc,
 			 */
 			tc_memlimit_update_on_free(pool_tc);
 			TC_INVALIDATE_FULL_CHUNK(pool_tc);
-			free(pool);
+			tc_pool_block_free(pool, xflags);
 		}
 		return;
 	}
@@ -1071,10 +2968,54 @@ static inline void _tc_free_poolmem(struct talloc_chunk *tc,
 		return;
 	}
 
+	if (pool->chain != NULL && tc_pool_bins_put(pool->chain, tc)) {
+		/*
+		 * The next chunk of the same size will take the
+		 * place of 'tc'.
+		 */
+		return;
+	}
+
 	/*
 	 * Do nothing. The memory is just "wasted", waiting for the pool
-	 * itself to be freed.
+	 * itself to be freed, or for the chunk in front of it to grow
+	 * into it, see tc_pool_grow_in_place().
 	 */
+#if defined(DEVELOPER) && defined(VALGRIND_MAKE_MEM_DEFINED)
+	VALGRIND_MAKE_MEM_DEFINED(tc, TC_HDR_SIZE);
+#endif
+}
+
+enum tc_cursor_event {
+	TC_CURSOR_GONE,		/* the chunk is freed */
+	TC_CURSOR_MOVED,	/* the chunk moves to another parent */
+	TC_CURSOR_CHILDREN_GONE	/* the children of the chunk are freed */
+};
+
+static void tc_report_cursors_update(struct talloc_chunk *tc,
+				     enum tc_cursor_event event);
+
+/* Take tc out of the child list of its parent, as it is freed */
+static inline void tc_unlink(struct talloc_chunk *tc)
+{
+	if (unlikely(tc->xflags & TALLOC_XFLAG_CURSOR)) {
+		tc_report_cursors_update(tc, TC_CURSOR_GONE);
+	}
+
+	if (tc->parent) {
+		struct talloc_chunk *parent = tc->parent;
+
+		tc_threadsafe_lock(parent);
+		_TLIST_REMOVE(parent->child, tc);
+		if (parent->child) {
+			parent->child->parent = parent;
+		}
+		tc_threadsafe_unlock(parent);
+	} else {
+		if (tc->prev) tc->prev->next = tc->next;
+		if (tc->next) tc->next->prev = tc->prev;
+		tc->prev = tc->next = NULL;
+	}
 }
 
 static inline void _tc_free_children_internal(struct talloc_chunk *tc,
@@ -1083,6 +3024,8 @@ static inline void _tc_free_children_internal(struct talloc_chunk *tc,
 
 static inline int _talloc_free_internal(void *ptr, const char *location);
 
+static int tc_defer_free(struct talloc_chunk *tc);
+
 /*
    internal free call that takes a struct talloc_chunk *.
 */
@@ -1114,6 +3057,10 @@ static inline int _tc_free_internal(struct talloc_chunk *tc,
 		return 0;
 	}
 
+	if (unlikely(tc->xflags & TALLOC_XFLAG_DEFERRED)) {
+		return tc_defer_free(tc);
+	}
+
 	if (unlikely(tc->destructor)) {
 		talloc_destructor_t d = tc->destructor;
 
@@ -1147,16 +3094,9 @@ static inline int _tc_free_internal(struct talloc_chunk *tc,
 		tc->destructor = NULL;
 	}
 
-	if (tc->parent) {
-		_TLIST_REMOVE(tc->parent->child, tc);
-		if (tc->parent->child) {
-			tc->parent->child->parent = tc->parent;
-		}
-	} else {
-		if (tc->prev) tc->prev->next = tc->next;
-		if (tc->next) tc->next->prev = tc->prev;
-		tc->prev = tc->next = NULL;
-	}
+	tc_unlink(tc);
+
+	tc_memlimit_unaccount_chunk(tc);
 
 	tc->flags |= TALLOC_FLAG_LOOP;
 
@@ -1169,6 +3109,10 @@ static inline int _tc_free_internal(struct talloc_chunk *tc,
 
 		pool = talloc_pool_from_chunk(tc);
 
+		if (pool->chain != NULL) {
+			tc_pool_chain_free(tc, location);
+		}
+
 		if (unlikely(pool->object_count == 0)) {
 			talloc_abort("Pool object count zero!");
 			return 0;
@@ -1186,6 +3130,9 @@ static inline int _tc_free_internal(struct talloc_chunk *tc,
 		 * to be freed as poolmem, else it needs to be just freed.
 		*/
 		ptr_to_free = pool;
+	} else if (unlikely(tc->xflags & TALLOC_XFLAG_THREADSAFE)) {
+		tc_threadsafe_destroy(tc);
+		ptr_to_free = talloc_threadsafe_from_chunk(tc);
 	} else {
 		ptr_to_free = tc;
 	}
@@ -1198,6 +3145,18 @@ static inline int _tc_free_internal(struct talloc_chunk *tc,
 	tc_memlimit_update_on_free(tc);
 
 	TC_INVALIDATE_FULL_CHUNK(tc);
+	if (unlikely(tc->xflags & TALLOC_XFLAG_MMAP)) {
+		if (ptr_to_free != tc) {
+			/* a pool on hugepages */
+			tc_hugepage_unmap(ptr_to_free);
+		} else {
+			tc_mmap_free(tc);
+		}
+		return 0;
+	}
+	if (ptr_to_free == tc && tc_cache_put(tc)) {
+		return 0;
+	}
 	free(ptr_to_free);
 	return 0;
 }
@@ -1230,6 +3189,39 @@ static inline int _talloc_free_internal(void *ptr, const char *location)
 static inline size_t _talloc_total_limit_size(const void *ptr,
 					struct talloc_memlimit *old_limit,
 					struct talloc_memlimit *new_limit);
+static inline void _talloc_total_counts(const void *ptr,
+					size_t *size, size_t *blocks);
+
+/*
+  Take the subtree of tc out of the memory limit it is under, as when
+  it moves away from its parent. A limit set on tc itself stays with
+  it. total_size and total_blocks return the talloc_total_size() and
+  talloc_total_blocks() of the subtree.
+*/
+static void tc_memlimit_detach(struct talloc_chunk *tc,
+			       size_t *total_size, size_t *total_blocks)
+{
+	void *ptr = TC_PTR_FROM_CHUNK(tc);
+	struct talloc_memlimit *old_limit;
+	size_t ctx_size;
+
+	_talloc_total_counts(ptr, total_size, total_blocks);
+
+	if (tc->limit->parent == tc) {
+		tc_memlimit_release_all(tc->limit);
+		ctx_size = tc->limit->cur_size;
+		old_limit = tc->limit->upper;
+		tc->limit->upper = NULL;
+	} else {
+		/* this also detaches the whole tree from the limit */
+		old_limit = tc->limit;
+		ctx_size = _talloc_total_limit_size(ptr, old_limit, NULL);
+	}
+
+	/* Decrement the memory limit from the source .. */
+	talloc_memlimit_shrink(old_limit, ctx_size);
+	talloc_memlimit_unaccount(old_limit, *total_size, *total_blocks);
+}
 
 /*
    move a lump of memory from one talloc context to another return the
@@ -1240,6 +3232,8 @@ static void *_talloc_steal_internal(const void *new_ctx, const void *ptr)
 {
 	struct talloc_chunk *tc, *new_tc;
 	size_t ctx_size = 0;
+	size_t total_size = 0;
+	size_t total_blocks = 0;
 
 	if (unlikely(!ptr)) {
 		return NULL;
@@ -1251,68 +3245,224 @@ static void *_talloc_steal_internal(const void *new_ctx, const void *ptr)
 
 	tc = talloc_chunk_from_ptr(ptr);
 
-	if (tc->limit != NULL) {
-
-		ctx_size = _talloc_total_limit_size(ptr, NULL, NULL);
+	if (unlikely(tc->xflags & TALLOC_XFLAG_UNLINKED)) {
+		tc_arena_link(tc);
+	}
 
-		/* Decrement the memory limit from the source .. */
-		talloc_memlimit_shrink(tc->limit->upper, ctx_size);
+	if (new_ctx != NULL) {
+		new_tc = talloc_chunk_from_ptr(new_ctx);
 
-		if (tc->limit->parent == tc) {
-			tc->limit->upper = NULL;
-		} else {
-			tc->limit = NULL;
+		if (unlikely(tc == new_tc || tc->parent == new_tc)) {
+			return discard_const_p(void, ptr);
 		}
 	}
 
+	/*
+	 * A thread-safe context must not get a memory limit. A chunk
+	 * that already is under a limit has none below it.
+	 */
+	if (new_ctx != NULL && new_tc->limit != NULL && tc->limit == NULL &&
+	    tc_has_threadsafe(tc)) {
+		return NULL;
+	}
+
+	if (tc->limit != NULL) {
+		tc_memlimit_detach(tc, &total_size, &total_blocks);
+	}
+
+	if (unlikely(tc->xflags & TALLOC_XFLAG_CURSOR)) {
+		tc_report_cursors_update(tc, TC_CURSOR_MOVED);
+	}
+
 	if (unlikely(new_ctx == NULL)) {
 		if (tc->parent) {
-			_TLIST_REMOVE(tc->parent->child, tc);
-			if (tc->parent->child) {
-				tc->parent->child->parent = tc->parent;
+			struct talloc_chunk *parent = tc->parent;
+
+			tc_threadsafe_lock(parent);
+			_TLIST_REMOVE(parent->child, tc);
+			if (parent->child) {
+				parent->child->parent = parent;
 			}
+			tc_threadsafe_unlock(parent);
 		} else {
 			if (tc->prev) tc->prev->next = tc->next;
 			if (tc->next) tc->next->prev = tc->prev;
 		}
 
 		tc->parent = tc->next = tc->prev = NULL;
+		if (unlikely(tc->name == TALLOC_MAGIC_REFERENCE)) {
+			tc_ref_set_owner(discard_const_p(
+				struct talloc_reference_handle, ptr), NULL);
+		}
 		return discard_const_p(void, ptr);
 	}
 
 	new_tc = talloc_chunk_from_ptr(new_ctx);
 
-	if (unlikely(tc == new_tc || tc->parent == new_tc)) {
-		return discard_const_p(void, ptr);
-	}
-
 	if (tc->parent) {
-		_TLIST_REMOVE(tc->parent->child, tc);
-		if (tc->parent->child) {
-			tc->parent->child->parent = tc->parent;
+		struct talloc_chunk *parent = tc->parent;
+
+		tc_threadsafe_lock(parent);
+		_TLIST_REMOVE(parent->child, tc);
+		if (parent->child) {
+			parent->child->parent = parent;
 		}
+		tc_threadsafe_unlock(parent);
 	} else {
 		if (tc->prev) tc->prev->next = tc->next;
 		if (tc->next) tc->next->prev = tc->prev;
 		tc->prev = tc->next = NULL;
 	}
 
-	tc->parent = new_tc;
-	if (new_tc->child) new_tc->child->parent = NULL;
-	_TLIST_ADD(new_tc->child, tc);
+	if (unlikely(new_tc->xflags & TALLOC_XFLAG_PARENT_LINKS)) {
+		tc_link_with_parent(new_tc, tc);
+	} else {
+		tc->parent = new_tc;
+		if (new_tc->child) new_tc->child->parent = NULL;
+		_TLIST_ADD(new_tc->child, tc);
+	}
 
-	if (tc->limit || new_tc->limit) {
-		ctx_size = _talloc_total_limit_size(ptr, tc->limit,
-						    new_tc->limit);
-		/* .. and increment it in the destination. */
-		if (new_tc->limit) {
-			talloc_memlimit_grow(new_tc->limit, ctx_size);
+	if (unlikely(tc->name == TALLOC_MAGIC_REFERENCE)) {
+		tc_ref_set_owner(discard_const_p(struct talloc_reference_handle,
+						 ptr), new_tc);
+	}
+
+	if (tc->xflags & TALLOC_XFLAG_SLOWFREE) {
+		tc_set_slowfree(new_tc);
+	}
+
+	if (new_tc->limit) {
+		if (total_blocks == 0) {
+			_talloc_total_counts(ptr, &total_size, &total_blocks);
 		}
+		ctx_size = _talloc_total_limit_size(ptr, NULL, new_tc->limit);
+		/* .. and increment it in the destination. */
+		talloc_memlimit_grow(new_tc->limit, ctx_size);
+		talloc_memlimit_account(new_tc->limit, total_size,
+					total_blocks);
 	}
 
 	return discard_const_p(void, ptr);
 }
 
+/*
+  Deferred destructors.
+
+  A chunk whose destructor was set with talloc_set_deferred_destructor()
+  is not destroyed when it is freed. It is taken out of the tree, with
+  its children, and out of its memory limit, and queued. Then
+  talloc_run_deferred() runs the destructors of the queued chunks and
+  frees them, children first as usual. Freeing those may queue more
+  deferred chunks from the subtree, which are run by the same call.
+
+  The queue is a list through tc->next, with tc->parent and tc->prev
+  kept NULL, so a queued chunk looks like one without a parent.
+*/
+
+static struct talloc_chunk *tc_deferred_head;
+static struct talloc_chunk *tc_deferred_tail;
+static void (*tc_deferred_executor)(void *private_data);
+static void *tc_deferred_private_data;
+
+#ifdef TALLOC_THREADSAFE
+static pthread_mutex_t tc_deferred_mutex = PTHREAD_MUTEX_INITIALIZER;
+#define TC_DEFERRED_LOCK() pthread_mutex_lock(&tc_deferred_mutex)
+#define TC_DEFERRED_UNLOCK() pthread_mutex_unlock(&tc_deferred_mutex)
+#else
+#define TC_DEFERRED_LOCK() do { } while (0)
+#define TC_DEFERRED_UNLOCK() do { } while (0)
+#endif
+
+static int tc_defer_free(struct talloc_chunk *tc)
+{
+	void (*executor)(void *private_data);
+	void *private_data;
+	bool was_empty;
+
+	if (tc->limit != NULL) {
+		size_t total_size = 0, total_blocks = 0;
+
+		tc_memlimit_detach(tc, &total_size, &total_blocks);
+	}
+
+	tc_unlink(tc);
+	tc->parent = tc->prev = tc->next = NULL;
+
+	TC_DEFERRED_LOCK();
+	was_empty = tc_deferred_head == NULL;
+	if (was_empty) {
+		tc_deferred_head = tc;
+	} else {
+		tc_deferred_tail->next = tc;
+	}
+	tc_deferred_tail = tc;
+	executor = tc_deferred_executor;
+	private_data = tc_deferred_private_data;
+	TC_DEFERRED_UNLOCK();
+
+	if (was_empty && executor != NULL) {
+		executor(private_data);
+	}
+
+	return 0;
+}
+
+_PUBLIC_ void _talloc_set_deferred_destructor(const void *ptr,
+					      int (*destructor)(void *))
+{
+	struct talloc_chunk *tc = talloc_chunk_from_ptr(ptr);
+
+	_talloc_set_destructor(ptr, destructor);
+	if (destructor != NULL) {
+		tc->xflags |= TALLOC_XFLAG_DEFERRED;
+	}
+}
+
+_PUBLIC_ void talloc_set_deferred_executor(void (*executor)(void *private_data),
+					   void *private_data)
+{
+	TC_DEFERRED_LOCK();
+	tc_deferred_executor = executor;
+	tc_deferred_private_data = private_data;
+	TC_DEFERRED_UNLOCK();
+}
+
+_PUBLIC_ size_t talloc_run_deferred(void)
+{
+	struct talloc_chunk *tc;
+	size_t count = 0;
+
+	while (true) {
+		TC_DEFERRED_LOCK();
+		tc = tc_deferred_head;
+		if (tc != NULL) {
+			tc_deferred_head = tc->next;
+			if (tc_deferred_head == NULL) {
+				tc_deferred_tail = NULL;
+			}
+		}
+		TC_DEFERRED_UNLOCK();
+
+		if (tc == NULL) {
+			break;
+		}
+
+		/*
+		 * A destructor that fails leaves the chunk without a
+		 * parent, just like a child that can't be freed with
+		 * its parent.
+		 */
+		tc->next = NULL;
+		tc->xflags &= ~TALLOC_XFLAG_DEFERRED;
+		if (_talloc_free_internal(TC_PTR_FROM_CHUNK(tc),
+					  __location__) == 0) {
+			count++;
+		}
+	}
+
+	return count;
+}
+
 /*
    move a lump of memory from one talloc context to another return the
    ptr on success, or NULL if it could not be transferred.
@@ -1372,13 +3522,12 @@ _PUBLIC_ void *talloc_reparent(const void *old_parent, const void *new_parent, c
 	}
 
 	tc = talloc_chunk_from_ptr(ptr);
-	for (h=tc->refs;h;h=h->next) {
-		if (talloc_parent(h) == old_parent) {
-			if (_talloc_steal_internal(new_parent, h) != h) {
-				return NULL;
-			}
-			return discard_const_p(void, ptr);
+	h = tc_ref_find(tc, old_parent ? talloc_chunk_from_ptr(old_parent) : NULL);
+	if (h != NULL) {
+		if (_talloc_steal_internal(new_parent, h) != h) {
+			return NULL;
 		}
+		return discard_const_p(void, ptr);
 	}
 
 	/* it wasn't a parent */
@@ -1399,14 +3548,7 @@ static inline int talloc_unreference(const void *context, const void *ptr)
 		context = null_context;
 	}
 
-	for (h=tc->refs;h;h=h->next) {
-		struct talloc_chunk *p = talloc_parent_chunk(h);
-		if (p == NULL) {
-			if (context == NULL) break;
-		} else if (TC_PTR_FROM_CHUNK(p) == context) {
-			break;
-		}
-	}
+	h = tc_ref_find(tc, context ? talloc_chunk_from_ptr(context) : NULL);
 	if (h == NULL) {
 		return -1;
 	}
@@ -1551,6 +3693,228 @@ _PUBLIC_ const char *talloc_get_name(const void *ptr)
 	return __talloc_get_name(ptr);
 }
 
+/*
+  The type name registry.
+
+  talloc() and talloc_get_type() pass "#type" as the name, so within
+  one module the names are equal pointers and the type checks below
+  get away with a pointer comparison. Every module has its own copy
+  of the literal though, and comparing a name from another module
+  takes a strcmp(). talloc_register_type_name() gives such literals a
+  type id, shared by all registered pointers to equal strings, and the
+  type checks compare the ids of registered names instead.
+
+  Registered names live as long as the process, so the table is only
+  ever added to, under a mutex. Readers go without a lock: the table
+  and the name of every entry are published with a release store after
+  everything they lead to is written, and readers get them with an
+  acquire load, see tc_type_load(). A reader that does not see an entry
+  yet falls back to strcmp(). A table that is replaced by a larger one
+  is never freed, as readers may still look at it.
+
+  Two hash lookups are not much cheaper than a strcmp() of a short
+  name, so every thread also remembers the pairs of registered names
+  it found equal, and a check repeating one of them is down to two
+  pointer comparisons.
+*/
+
+struct tc_type_entry {
+	const char *name;
+	unsigned id;
+};
+
+struct tc_type_table {
+	size_t size;
+	size_t count;
+	unsigned shift;
+	struct tc_type_entry entries[1];
+};
+
+static struct tc_type_table *tc_type_table;
+static unsigned tc_type_next_id;
+
+#ifdef HAVE___THREAD
+#define TC_TYPE_CACHE_BITS 6
+#define TC_TYPE_CACHE_SIZE (1 << TC_TYPE_CACHE_BITS)
+
+struct tc_type_pair {
+	const char *pname;
+	const char *name;
+};
+
+static __thread struct tc_type_pair tc_type_cache[TC_TYPE_CACHE_SIZE];
+#endif
+
+#ifdef TALLOC_THREADSAFE
+static pthread_mutex_t tc_type_mutex = PTHREAD_MUTEX_INITIALIZER;
+#endif
+
+static inline void tc_type_barrier(void)
+{
+#ifdef HAVE___SYNC_FETCH_AND_ADD
+	__sync_synchronize();
+#endif
+}
+
+/*
+  Without the __atomic builtins a load is followed by a full barrier
+  with tc_type_acquire() where nothing depends on the loaded pointer.
+*/
+#ifdef HAVE___ATOMIC_LOAD_N
+#define tc_type_load(p) __atomic_load_n(&(p), __ATOMIC_ACQUIRE)
+#define tc_type_store(p, v) __atomic_store_n(&(p), (v), __ATOMIC_RELEASE)
+#define tc_type_acquire() do { } while (0)
+#else
+#define tc_type_load(p) (p)
+#define tc_type_store(p, v) do { tc_type_barrier(); (p) = (v); } while (0)
+#define tc_type_acquire() tc_type_barrier()
+#endif
+
+/* literals are packed closely, spread them with Fibonacci hashing */
+static inline size_t tc_type_hash(const struct tc_type_table *t,
+				  const char *name)
+{
+	return ((uint64_t)(uintptr_t)name * 0x9E3779B97F4A7C15ULL) >> t->shift;
+}
+
+/* the id of a registered name, 0 if it is not registered */
+static inline unsigned tc_type_id(const struct tc_type_table *t,
+				  const char *name)
+{
+	size_t i = tc_type_hash(t, name);
+	const char *n;
+
+	while ((n = tc_type_load(t->entries[i].name)) != NULL) {
+		if (n == name) {
+			tc_type_acquire();
+			return t->entries[i].id;
+		}
+		i = (i + 1) & (t->size - 1);
+	}
+	return 0;
+}
+
+static inline bool tc_type_name_matches(const char *pname, const char *name)
+{
+	const struct tc_type_table *t;
+
+	if (likely(pname == name)) {
+		return true;
+	}
+	t = tc_type_load(tc_type_table);
+	if (t != NULL) {
+		unsigned id, other;
+#ifdef HAVE___THREAD
+		struct tc_type_pair *pair;
+
+		pair = &tc_type_cache[((uint64_t)((uintptr_t)pname ^
+						  (uintptr_t)name) *
+				       0x9E3779B97F4A7C15ULL) >>
+				      (64 - TC_TYPE_CACHE_BITS)];
+		if (pair->pname == pname && pair->name == name) {
+			return true;
+		}
+#endif
+		id = tc_type_id(t, pname);
+		other = id ? tc_type_id(t, name) : 0;
+		if (other != 0) {
+#ifdef HAVE___THREAD
+			if (id == other) {
+				pair->pname = pname;
+				pair->name = name;
+			}
+#endif
+			return id == other;
+		}
+	}
+	return strcmp(pname, name) == 0;
+}
+
+static void tc_type_insert(struct tc_type_table *t, const char *name,
+			   unsigned id)
+{
+	size_t i = tc_type_hash(t, name);
+
+	while (t->entries[i].name != NULL) {
+		i = (i + 1) & (t->size - 1);
+	}
+	/* readers must not see the name before its id */
+	t->entries[i].id = id;
+	tc_type_store(t->entries[i].name, name);
+	t->count++;
+}
+
+_PUBLIC_ int talloc_register_type_name(const char *name)
+{
+	struct tc_type_table *t;
+	unsigned id = 0;
+	size_t i;
+	int ret = 0;
+
+	if (name == NULL) {
+		errno = EINVAL;
+		return -1;
+	}
+
+#ifdef TALLOC_THREADSAFE
+	pthread_mutex_lock(&tc_type_mutex);
+#endif
+
+	t = tc_type_table;
+
+	if (t != NULL) {
+		if (tc_type_id(t, name) != 0) {
+			goto done;
+		}
+		for (i = 0; i < t->size && id == 0; i++) {
+			if (t->entries[i].name != NULL &&
+			    strcmp(t->entries[i].name, name) == 0) {
+				id = t->entries[i].id;
+			}
+		}
+	}
+	if (id == 0) {
+		id = ++tc_type_next_id;
+	}
+
+	if (t == NULL || (t->count + 1) * 2 > t->size) {
+		size_t size = t ? t->size * 2 : 64;
+		struct tc_type_table *n;
+
+		n = (struct tc_type_table *)calloc(1,
+			offsetof(struct tc_type_table, entries) +
+			size * sizeof(n->entries[0]));
+		if (n == NULL) {
+			errno = ENOMEM;
+			ret = -1;
+			goto done;
+		}
+		n->size = size;
+		n->shift = 64;
+		while (size > 1) {
+			n->shift--;
+			size >>= 1;
+		}
+		for (i = 0; t != NULL && i < t->size; i++) {
+			if (t->entries[i].name != NULL) {
+				tc_type_insert(n, t->entries[i].name,
+					       t->entries[i].id);
+			}
+		}
+		/* the old table stays around for current readers */
+		tc_type_store(tc_type_table, n);
+		t = n;
+	}
+
+	tc_type_insert(t, name, id);
+
+done:
+#ifdef TALLOC_THREADSAFE
+	pthread_mutex_unlock(&tc_type_mutex);
+#endif
+	return ret;
+}
+
 /*
   check if a pointer has the given name. If it does, return the pointer,
   otherwise return NULL
@@ -1560,7 +3924,7 @@ _PUBLIC_ void *talloc_check_name(const void *ptr, const char *name)
 	const char *pname;
 	if (unlikely(ptr == NULL)) return NULL;
 	pname = __talloc_get_name(ptr);
-	if (likely(pname == name || strcmp(pname, name) == 0)) {
+	if (likely(tc_type_name_matches(pname, name))) {
 		return discard_const_p(void, ptr);
 	}
 	return NULL;
@@ -1594,7 +3958,7 @@ _PUBLIC_ void *_talloc_get_type_abort(const void *ptr, const char *name, const c
 	}
 
 	pname = __talloc_get_name(ptr);
-	if (likely(pname == name || strcmp(pname, name) == 0)) {
+	if (likely(tc_type_name_matches(pname, name))) {
 		return discard_const_p(void, ptr);
 	}
 
@@ -1627,10 +3991,70 @@ _PUBLIC_ void *talloc_init(const char *fmt, ...)
 	return ptr;
 }
 
+/*
+  free all children of a chunk without TALLOC_XFLAG_SLOWFREE.
+
+  None of the chunks below such a chunk has a destructor, a reference,
+  a pool or a memory limit of its own, so nothing can fail and no
+  callback can run. Instead of recursing through _tc_free_internal()
+  for every child, the subtree is released in a single linear pass:
+  when a chunk with children is freed, its list of children is spliced
+  in front of its remaining siblings.
+*/
+static inline void _tc_free_children_fast(struct talloc_chunk *tc,
+					  const char *location)
+{
+	struct talloc_chunk *c = tc->child;
+
+	tc->child = NULL;
+
+	while (c != NULL) {
+		struct talloc_chunk *next;
+
+		if (c->child != NULL) {
+			struct talloc_chunk *last = c->child;
+
+			while (last->next != NULL) {
+				last = last->next;
+			}
+			last->next = c->next;
+			next = c->child;
+		} else {
+			next = c->next;
+		}
+
+		tc_memlimit_unaccount_chunk(c);
+
+		if (c->flags & TALLOC_FLAG_POOLMEM) {
+			_tc_free_poolmem(c, location);
+		} else {
+			_talloc_chunk_set_free(c, location);
+			tc_memlimit_update_on_free(c);
+			TC_INVALIDATE_FULL_CHUNK(c);
+			if (unlikely(c->xflags & TALLOC_XFLAG_MMAP)) {
+				tc_mmap_free(c);
+			} else if (!tc_cache_put(c)) {
+				free(c);
+			}
+		}
+
+		c = next;
+	}
+}
+
 static inline void _tc_free_children_internal(struct talloc_chunk *tc,
 						  void *ptr,
 						  const char *location)
 {
+	if (unlikely(tc->xflags & TALLOC_XFLAG_CURSOR)) {
+		tc_report_cursors_update(tc, TC_CURSOR_CHILDREN_GONE);
+	}
+
+	if (!(tc->xflags & TALLOC_XFLAG_SLOWFREE)) {
+		_tc_free_children_fast(tc, location);
+		return;
+	}
+
 	while (tc->child) {
 		/* we need to work out who will own an abandoned child
 		   if it cannot be freed. In priority order, the first
@@ -1691,8 +4115,20 @@ _PUBLIC_ void talloc_free_children(void *ptr)
 
 	_tc_free_children_internal(tc, ptr, __location__);
 
+	if (unlikely(tc->flags & TALLOC_FLAG_POOL)) {
+		struct talloc_pool_hdr *pool_hdr = talloc_pool_from_chunk(tc);
+
+		if (tc_pool_is_arena(pool_hdr)) {
+			tc_arena_reset(pool_hdr->chain);
+		}
+	}
+
 	/* .. so we put it back after all other children have been freed */
 	if (tc_name) {
+		if (unlikely(tc->xflags & TALLOC_XFLAG_PARENT_LINKS)) {
+			tc_link_with_parent(tc, tc_name);
+			return;
+		}
 		if (tc->child) {
 			tc->child->parent = NULL;
 		}
@@ -1772,45 +4208,22 @@ _PUBLIC_ int _talloc_free(void *ptr, const char *location)
 
 
 /*
-  A talloc version of realloc. The context argument is only used if
-  ptr is NULL
+  The part of _talloc_realloc() that resizes or moves the chunk
 */
-_PUBLIC_ void *_talloc_realloc(const void *context, void *ptr, size_t size, const char *name)
+static void tc_report_cursors_realloc(struct talloc_chunk *old_tc,
+				      struct talloc_chunk *new_tc);
+
+static inline void *_talloc_realloc_chunk(struct talloc_chunk *tc,
+					  void *ptr, size_t size,
+					  const char *name)
 {
-	struct talloc_chunk *tc;
+	struct talloc_chunk *old_tc = tc;
 	void *new_ptr;
 	bool malloced = false;
 	struct talloc_pool_hdr *pool_hdr = NULL;
 	size_t old_size = 0;
 	size_t new_size = 0;
 
-	/* size zero is equivalent to free() */
-	if (unlikely(size == 0)) {
-		talloc_unlink(context, ptr);
-		return NULL;
-	}
-
-	if (unlikely(size >= MAX_TALLOC_SIZE)) {
-		return NULL;
-	}
-
-	/* realloc(NULL) is equivalent to malloc() */
-	if (ptr == NULL) {
-		return _talloc_named_const(context, size, name);
-	}
-
-	tc = talloc_chunk_from_ptr(ptr);
-
-	/* don't allow realloc on referenced pointers */
-	if (unlikely(tc->refs)) {
-		return NULL;
-	}
-
-	/* don't let anybody try to realloc a talloc_pool */
-	if (unlikely(tc->flags & TALLOC_FLAG_POOL)) {
-		return NULL;
-	}
-
 	if (tc->limit && (size > tc->size)) {
 		if (!talloc_memlimit_check(tc->limit, (size - tc->size))) {
 			errno = ENOMEM;
@@ -1823,6 +4236,20 @@ _PUBLIC_ void *_talloc_realloc(const void *context, void *ptr, size_t size, cons
 		pool_hdr = tc->pool;
 	}
 
+	/* a mapping that keeps its number of pages stays where it is */
+	if (unlikely(tc->xflags & TALLOC_XFLAG_MMAP) &&
+	    TC_MMAP_LEN(size) == TC_MMAP_LEN(tc->size)) {
+		if (size < tc->size) {
+			TC_INVALIDATE_SHRINK_CHUNK(tc, size);
+			talloc_memlimit_shrink(tc->limit, tc->size - size);
+		} else {
+			TC_UNDEFINE_GROW_CHUNK(tc, size);
+			talloc_memlimit_grow(tc->limit, size - tc->size);
+		}
+		tc->size = size;
+		return ptr;
+	}
+
 #if (ALWAYS_REALLOC == 0)
 	/* don't shrink if we have less than 1k to gain */
 	if (size < tc->size && tc->limit == NULL) {
@@ -1833,9 +4260,12 @@ _PUBLIC_ void *_talloc_realloc(const void *context, void *ptr, size_t size, cons
 			if (next_tc == pool_hdr->end) {
 				/* note: tc->size has changed, so this works */
 				pool_hdr->end = tc_next_chunk(tc);
+			} else if (next_tc != tc_next_chunk(tc)) {
+				tc->xflags |= TALLOC_XFLAG_POOLGAP;
 			}
 			return ptr;
-		} else if ((tc->size - size) < 1024) {
+		} else if ((tc->size - size) < 1024 &&
+			   !(tc->xflags & TALLOC_XFLAG_MMAP)) {
 			/*
 			 * if we call TC_INVALIDATE_SHRINK_CHUNK() here
 			 * we would need to call TC_UNDEFINE_GROW_CHUNK()
@@ -1876,26 +4306,41 @@ _PUBLIC_ void *_talloc_realloc(const void *context, void *ptr, size_t size, cons
 	 */
 	_talloc_chunk_set_free(tc, NULL);
 
+	if (unlikely(tc->xflags & TALLOC_XFLAG_MMAP)) {
+		old_size = tc->size;
+		new_size = size;
+		new_ptr = tc_mmap_realloc(tc, size);
+		goto got_new_ptr;
+	}
+
 #if ALWAYS_REALLOC
 	if (pool_hdr) {
+		struct talloc_pool_hdr *new_pool_hdr = NULL;
+
 		new_ptr = tc_alloc_pool(tc, size + TC_HDR_SIZE, 0);
 		pool_hdr->object_count--;
 
 		if (new_ptr == NULL) {
-			new_ptr = malloc(TC_HDR_SIZE+size);
+			new_ptr = malloc(TC_MALLOC_SIZE(size));
 			malloced = true;
 			new_size = size;
+		} else {
+			new_pool_hdr = ((struct talloc_chunk *)new_ptr)->pool;
 		}
 
 		if (new_ptr) {
 			memcpy(new_ptr, tc, MIN(tc->size,size) + TC_HDR_SIZE);
 			TC_INVALIDATE_FULL_CHUNK(tc);
+			if (new_pool_hdr != NULL) {
+				/* a growable pool may have used another slab */
+				((struct talloc_chunk *)new_ptr)->pool = new_pool_hdr;
+			}
 		}
 	} else {
 		/* We're doing malloc then free here, so record the difference. */
 		old_size = tc->size;
 		new_size = size;
-		new_ptr = malloc(size + TC_HDR_SIZE);
+		new_ptr = malloc(TC_MALLOC_SIZE(size));
 		if (new_ptr) {
 			memcpy(new_ptr, tc, MIN(tc->size, size) + TC_HDR_SIZE);
 			free(tc);
@@ -1904,6 +4349,7 @@ _PUBLIC_ void *_talloc_realloc(const void *context, void *ptr, size_t size, cons
 #else
 	if (pool_hdr) {
 		struct talloc_chunk *pool_tc;
+		struct talloc_pool_hdr *new_pool_hdr = NULL;
 		void *next_tc = tc_next_chunk(tc);
 		size_t old_chunk_size = TC_ALIGN16(TC_HDR_SIZE + tc->size);
 		size_t new_chunk_size = TC_ALIGN16(TC_HDR_SIZE + size);
@@ -1916,7 +4362,7 @@ _PUBLIC_ void *_talloc_realloc(const void *context, void *ptr, size_t size, cons
 			chunk_count -= 1;
 		}
 
-		if (chunk_count == 1) {
+		if (chunk_count == 1 && !tc_pool_is_arena(pool_hdr)) {
 			/*
 			 * optimize for the case where 'tc' is the only
 			 * chunk in the pool.
@@ -1930,6 +4376,11 @@ _PUBLIC_ void *_talloc_realloc(const void *context, void *ptr, size_t size, cons
 				size_t new_used = TC_HDR_SIZE + size;
 				new_ptr = start;
 
+				if (pool_hdr->chain != NULL) {
+					tc_pool_bins_purge(pool_hdr->chain,
+							   pool_hdr);
+				}
+
 #if defined(DEVELOPER) && defined(VALGRIND_MAKE_MEM_UNDEFINED)
 				{
 					/*
@@ -1978,33 +4429,34 @@ _PUBLIC_ void *_talloc_realloc(const void *context, void *ptr, size_t size, cons
 			return ptr;
 		}
 
-		if (next_tc == pool_hdr->end) {
+		if (next_tc != NULL && new_chunk_size > old_chunk_size &&
+		    tc_pool_grow_in_place(tc, pool_hdr, new_chunk_size)) {
 			/*
-			 * optimize for the case where 'tc' is the last
-			 * chunk in the pool.
+			 * optimize for the case where 'tc' is followed by
+			 * free space in the pool.
 			 */
-			space_needed = new_chunk_size - old_chunk_size;
-			space_left = tc_pool_space_left(pool_hdr);
-
-			if (space_left >= space_needed) {
-				TC_UNDEFINE_GROW_CHUNK(tc, size);
-				_talloc_chunk_set_not_free(tc);
-				tc->size = size;
-				pool_hdr->end = tc_next_chunk(tc);
-				return ptr;
-			}
+			TC_UNDEFINE_GROW_CHUNK(tc, size);
+			_talloc_chunk_set_not_free(tc);
+			tc->size = size;
+			return ptr;
 		}
 
 		new_ptr = tc_alloc_pool(tc, size + TC_HDR_SIZE, 0);
 
 		if (new_ptr == NULL) {
-			new_ptr = malloc(TC_HDR_SIZE+size);
+			new_ptr = malloc(TC_MALLOC_SIZE(size));
 			malloced = true;
 			new_size = size;
+		} else {
+			new_pool_hdr = ((struct talloc_chunk *)new_ptr)->pool;
 		}
 
 		if (new_ptr) {
 			memcpy(new_ptr, tc, MIN(tc->size,size) + TC_HDR_SIZE);
+			if (new_pool_hdr != NULL) {
+				/* a growable pool may have used another slab */
+				((struct talloc_chunk *)new_ptr)->pool = new_pool_hdr;
+			}
 
 			_tc_free_poolmem(tc, __location__ "_talloc_realloc");
 		}
@@ -2013,10 +4465,24 @@ _PUBLIC_ void *_talloc_realloc(const void *context, void *ptr, size_t size, cons
 		/* We're doing realloc here, so record the difference. */
 		old_size = tc->size;
 		new_size = size;
-		new_ptr = realloc(tc, size + TC_HDR_SIZE);
+		new_ptr = NULL;
+		if (unlikely(tc_mmap_wanted(size))) {
+			/* move into a mapping, further growth is cheap */
+			new_ptr = tc_mmap_alloc(size);
+			if (new_ptr != NULL) {
+				memcpy(new_ptr, tc,
+				       TC_HDR_SIZE + MIN(tc->size, size));
+				((struct talloc_chunk *)new_ptr)->xflags |=
+					TALLOC_XFLAG_MMAP;
+				free(tc);
+			}
+		}
+		if (new_ptr == NULL) {
+			new_ptr = realloc(tc, TC_MALLOC_SIZE(size));
+		}
 	}
-got_new_ptr:
 #endif
+got_new_ptr:
 	if (unlikely(!new_ptr)) {
 		/*
 		 * Ok, this is a strange spot.  We have to put back
@@ -2036,22 +4502,35 @@ got_new_ptr:
 	 */
 	tc = (struct talloc_chunk *)new_ptr;
 	_talloc_chunk_set_not_free(tc);
+	tc->xflags &= ~TALLOC_XFLAG_POOLGAP;
 	if (malloced) {
 		tc->flags &= ~TALLOC_FLAG_POOLMEM;
 	}
-	if (tc->parent) {
+	if (tc->prev) {
+		tc->prev->next = tc;
+	} else if (tc->parent) {
 		tc->parent->child = tc;
 	}
 	if (tc->child) {
+		if (unlikely(tc->xflags & TALLOC_XFLAG_REF_OWNER)) {
+			/* reference handles among the children moved */
+			tc_ref_rekey_children(tc, tc);
+		}
 		tc->child->parent = tc;
-	}
+		if (unlikely(tc->xflags & TALLOC_XFLAG_PARENT_LINKS)) {
+			struct talloc_chunk *c;
 
-	if (tc->prev) {
-		tc->prev->next = tc;
+			for (c = tc->child->next; c != NULL; c = c->next) {
+				c->parent = tc;
+			}
+		}
 	}
 	if (tc->next) {
 		tc->next->prev = tc;
 	}
+	if (unlikely(tc->xflags & TALLOC_XFLAG_CURSOR)) {
+		tc_report_cursors_realloc(old_tc, tc);
+	}
 
 	if (new_size > old_size) {
 		talloc_memlimit_grow(tc->limit, new_size - old_size);
@@ -2065,6 +4544,91 @@ got_new_ptr:
 	return TC_PTR_FROM_CHUNK(tc);
 }
 
+/*
+  A talloc version of realloc. The context argument is only used if
+  ptr is NULL
+*/
+_PUBLIC_ void *_talloc_realloc(const void *context, void *ptr, size_t size, const char *name)
+{
+	struct talloc_chunk *tc;
+	struct talloc_memlimit *limit;
+	size_t old_size;
+
+	/* size zero is equivalent to free() */
+	if (unlikely(size == 0)) {
+		talloc_unlink(context, ptr);
+		return NULL;
+	}
+
+	if (unlikely(size >= MAX_TALLOC_SIZE)) {
+		return NULL;
+	}
+
+	/* realloc(NULL) is equivalent to malloc() */
+	if (ptr == NULL) {
+		return _talloc_named_const(context, size, name);
+	}
+
+	tc = talloc_chunk_from_ptr(ptr);
+
+	/* don't allow realloc on referenced pointers */
+	if (unlikely(tc->refs)) {
+		return NULL;
+	}
+
+	/* don't let anybody try to realloc a talloc_pool */
+	if (unlikely(tc->flags & TALLOC_FLAG_POOL)) {
+		return NULL;
+	}
+
+	/* .. or a thread-safe context */
+	if (unlikely(tc->xflags & TALLOC_XFLAG_THREADSAFE)) {
+		return NULL;
+	}
+
+	/* the chunk may leave the arena memory */
+	if (unlikely(tc->xflags & TALLOC_XFLAG_UNLINKED)) {
+		tc_arena_link(tc);
+	}
+
+	limit = tc->limit;
+	old_size = tc->size;
+
+	/*
+	 * The chunk may move, so hold the lock of a thread-safe parent
+	 * while its siblings still point to the old memory.
+	 */
+	if (unlikely(tc->parent != NULL &&
+		     (tc->parent->xflags & TALLOC_XFLAG_THREADSAFE))) {
+		struct talloc_chunk *parent = tc->parent;
+
+		tc_threadsafe_lock(parent);
+		ptr = _talloc_realloc_chunk(tc, ptr, size, name);
+		tc_threadsafe_unlock(parent);
+	} else {
+		ptr = _talloc_realloc_chunk(tc, ptr, size, name);
+	}
+
+	if (unlikely(ptr == NULL)) {
+		return NULL;
+	}
+
+	tc_sample(size, name);
+
+	if (unlikely(limit != NULL)) {
+		talloc_memlimit_unaccount(limit, old_size, 0);
+		talloc_memlimit_account(limit, size, 0);
+	}
+
+	/*
+	 * The length trailer of a string builder is gone, the result
+	 * is a plain buffer of the new size.
+	 */
+	talloc_chunk_from_ptr(ptr)->xflags &= ~TALLOC_XFLAG_STRBUF;
+
+	return ptr;
+}
+
 /*
   a wrapper around talloc_steal() for situations where you are moving a pointer
   between two structures, and want the old pointer to be set to NULL
@@ -2083,42 +4647,107 @@ enum talloc_mem_count_type {
 	TOTAL_MEM_LIMIT,
 };
 
-static inline size_t _talloc_total_mem_internal(const void *ptr,
-					 enum talloc_mem_count_type type,
-					 struct talloc_memlimit *old_limit,
-					 struct talloc_memlimit *new_limit)
+/*
+  The chunk after tc in a depth-first walk of the tree below root, or
+  NULL at the end of the walk. The children of tc are only walked if
+  descend is set. *depth follows the level of the returned chunk.
+
+  The walk climbs back up through the parent pointers instead of
+  keeping a stack, so it takes no memory and works on trees of any
+  depth. Climbing from the last child of a chunk walks back over its
+  siblings, so the whole walk is still linear.
+*/
+static inline struct talloc_chunk *tc_walk_next(struct talloc_chunk *root,
+						struct talloc_chunk *tc,
+						bool descend, int *depth)
 {
-	size_t total = 0;
-	struct talloc_chunk *c, *tc;
+	if (descend && tc->child != NULL) {
+		(*depth)++;
+		tc = tc->child;
+	} else {
+		while (tc != root && tc->next == NULL) {
+			while (tc->parent == NULL && tc->prev) tc = tc->prev;
+			tc = tc->parent;
+			(*depth)--;
+		}
+		if (tc == root) {
+			return NULL;
+		}
+		tc = tc->next;
+	}
 
-	if (ptr == NULL) {
-		ptr = null_context;
+	/* only a corrupted tree leads back to where the walk started */
+	if (unlikely(tc == root)) {
+		return NULL;
 	}
-	if (ptr == NULL) {
-		return 0;
+
+	return tc;
+}
+
+/*
+  Whether root or a chunk below it is a thread-safe context. Memory
+  limits are not thread-safe, so none may end up under one.
+*/
+static bool tc_has_threadsafe(struct talloc_chunk *root)
+{
+	struct talloc_chunk *tc;
+	int depth = 0;
+
+	for (tc = root; tc != NULL; tc = tc_walk_next(root, tc, true, &depth)) {
+		if (unlikely(tc->xflags & TALLOC_XFLAG_THREADSAFE)) {
+			return true;
+		}
 	}
 
-	tc = talloc_chunk_from_ptr(ptr);
+	return false;
+}
+
+/*
+  The part of _talloc_total_mem_internal() for a single chunk. Clears
+  *descend if the children of tc are already counted.
+*/
+static inline size_t _talloc_chunk_mem(struct talloc_chunk *tc,
+				       enum talloc_mem_count_type type,
+				       struct talloc_memlimit *old_limit,
+				       struct talloc_memlimit *new_limit,
+				       bool *descend)
+{
+	size_t total = 0;
+
+	*descend = false;
 
 	if (old_limit || new_limit) {
 		if (tc->limit && tc->limit->upper == old_limit) {
+			/* the credit was taken from the old limit */
+			tc_memlimit_release_all(tc->limit);
 			tc->limit->upper = new_limit;
 		}
 	}
 
 	/* optimize in the memlimits case */
-	if (type == TOTAL_MEM_LIMIT &&
-	    tc->limit != NULL &&
+	if (tc->limit != NULL &&
 	    tc->limit != old_limit &&
 	    tc->limit->parent == tc) {
-		return tc->limit->cur_size;
+		switch (type) {
+		case TOTAL_MEM_SIZE:
+			/* collect the totals the limits below still hold */
+			tc_memlimit_reclaim(tc->limit);
+			return tc->limit->total_size;
+		case TOTAL_MEM_BLOCKS:
+			tc_memlimit_reclaim(tc->limit);
+			return tc->limit->total_blocks;
+		case TOTAL_MEM_LIMIT:
+			tc_memlimit_release_credit(tc->limit);
+			return tc->limit->cur_size;
+		}
 	}
 
 	if (tc->flags & TALLOC_FLAG_LOOP) {
+		/* this chunk is being freed */
 		return 0;
 	}
 
-	tc->flags |= TALLOC_FLAG_LOOP;
+	*descend = true;
 
 	if (old_limit || new_limit) {
 		if (old_limit == tc->limit) {
@@ -2155,6 +4784,9 @@ static inline size_t _talloc_total_mem_internal(const void *ptr,
 					total = pool_hdr->poolsize +
 							TC_HDR_SIZE +
 							TP_HDR_SIZE;
+					if (pool_hdr->chain != NULL) {
+						total += pool_hdr->chain->slab_bytes;
+					}
 				} else {
 					total = tc->size + TC_HDR_SIZE;
 				}
@@ -2162,16 +4794,46 @@ static inline size_t _talloc_total_mem_internal(const void *ptr,
 		}
 		break;
 	}
-	for (c = tc->child; c; c = c->next) {
-		total += _talloc_total_mem_internal(TC_PTR_FROM_CHUNK(c), type,
-						    old_limit, new_limit);
+
+	return total;
+}
+
+static inline size_t _talloc_total_mem_internal(const void *ptr,
+					 enum talloc_mem_count_type type,
+					 struct talloc_memlimit *old_limit,
+					 struct talloc_memlimit *new_limit)
+{
+	size_t total = 0;
+	struct talloc_chunk *root, *tc;
+	int depth = 0;
+
+	if (ptr == NULL) {
+		ptr = null_context;
+	}
+	if (ptr == NULL) {
+		return 0;
 	}
 
-	tc->flags &= ~TALLOC_FLAG_LOOP;
+	root = talloc_chunk_from_ptr(ptr);
+
+	for (tc = root; tc != NULL; ) {
+		bool descend;
+
+		total += _talloc_chunk_mem(tc, type, old_limit, new_limit,
+					   &descend);
+		tc = tc_walk_next(root, tc, descend, &depth);
+	}
 
 	return total;
 }
 
+static inline void _talloc_total_counts(const void *ptr,
+					size_t *size, size_t *blocks)
+{
+	*size = _talloc_total_mem_internal(ptr, TOTAL_MEM_SIZE, NULL, NULL);
+	*blocks = _talloc_total_mem_internal(ptr, TOTAL_MEM_BLOCKS, NULL, NULL);
+}
+
 /*
   return the total size of a talloc pool (subtree)
 */
@@ -2203,45 +4865,271 @@ _PUBLIC_ size_t talloc_reference_count(const void *ptr)
 	return ret;
 }
 
+struct talloc_report_cursor {
+	struct talloc_report_cursor *prev, *next;
+	struct talloc_chunk *root;
+	/* the next chunk to report, NULL at the end */
+	struct talloc_chunk *tc;
+	int depth;
+	int max_depth;
+};
+
+/*
+  The cursors from talloc_report_cursor() still in use.
+
+  Between two batches, the chunk a cursor stands on and its parents up
+  to the root of the walk carry TALLOC_XFLAG_CURSOR. When one of them
+  is freed, stolen or reallocated, the cursors are updated: a cursor
+  standing in the subtree of a chunk that leaves moves on to the chunk
+  after that subtree, as if it had already been walked. The flag is
+  only cleared there, so it may be left on chunks the cursors have
+  passed.
+
+  The root of a walk and its parents get TALLOC_XFLAG_SLOWFREE, so that
+  none of the flagged chunks is ever released by
+  _tc_free_children_fast() without being seen.
+*/
+static struct talloc_report_cursor *tc_report_cursors;
+
+#ifdef TALLOC_THREADSAFE
+static pthread_mutex_t tc_cursor_mutex = PTHREAD_MUTEX_INITIALIZER;
+#define TC_CURSOR_LOCK() pthread_mutex_lock(&tc_cursor_mutex)
+#define TC_CURSOR_UNLOCK() pthread_mutex_unlock(&tc_cursor_mutex)
+#else
+#define TC_CURSOR_LOCK() do { } while (0)
+#define TC_CURSOR_UNLOCK() do { } while (0)
+#endif
+
+/* flag the chunk the cursor stands on and its parents up to the root */
+static void tc_report_cursor_mark(struct talloc_report_cursor *cursor)
+{
+	struct talloc_chunk *tc = cursor->tc;
+
+	while (tc != NULL) {
+		tc->xflags |= TALLOC_XFLAG_CURSOR;
+		if (tc == cursor->root) {
+			return;
+		}
+		while (tc->parent == NULL && tc->prev) tc = tc->prev;
+		tc = tc->parent;
+	}
+}
+
+/*
+  Update the cursors for a flagged chunk that is about to leave its
+  place in the hierarchy, while it is still linked to its parent.
+*/
+static void tc_report_cursors_update(struct talloc_chunk *tc,
+				     enum tc_cursor_event event)
+{
+	struct talloc_report_cursor *cursor;
+
+	TC_CURSOR_LOCK();
+
+	tc->xflags &= ~TALLOC_XFLAG_CURSOR;
+
+	for (cursor = tc_report_cursors; cursor; cursor = cursor->next) {
+		struct talloc_chunk *c = cursor->tc;
+		int depth = cursor->depth;
+
+		if (c == NULL) {
+			continue;
+		}
+
+		if (tc == cursor->root && event != TC_CURSOR_CHILDREN_GONE) {
+			/* a moved root takes the rest of the walk along */
+			if (event == TC_CURSOR_GONE) {
+				cursor->root = cursor->tc = NULL;
+			}
+			continue;
+		}
+
+		/* is tc between the cursor and the root of the walk? */
+		while (c != NULL && c != tc && c != cursor->root) {
+			while (c->parent == NULL && c->prev) c = c->prev;
+			c = c->parent;
+			depth--;
+		}
+		if (c != tc) {
+			continue;
+		}
+		if (tc == cursor->tc && event == TC_CURSOR_CHILDREN_GONE) {
+			/* the children have not been reported yet */
+			continue;
+		}
+
+		cursor->tc = tc_walk_next(cursor->root, tc, false, &depth);
+		cursor->depth = depth;
+	}
+
+	/* tc may still be on the path of some cursor */
+	for (cursor = tc_report_cursors; cursor; cursor = cursor->next) {
+		tc_report_cursor_mark(cursor);
+	}
+
+	TC_CURSOR_UNLOCK();
+}
+
+/*
+  Update the cursors for a flagged chunk that realloc moved.
+*/
+static void tc_report_cursors_realloc(struct talloc_chunk *old_tc,
+				      struct talloc_chunk *new_tc)
+{
+	struct talloc_report_cursor *cursor;
+
+	TC_CURSOR_LOCK();
+	for (cursor = tc_report_cursors; cursor; cursor = cursor->next) {
+		if (cursor->root == old_tc) {
+			cursor->root = new_tc;
+		}
+		if (cursor->tc == old_tc) {
+			cursor->tc = new_tc;
+		}
+	}
+	TC_CURSOR_UNLOCK();
+}
+
+static int tc_report_cursor_destructor(struct talloc_report_cursor *cursor)
+{
+	TC_CURSOR_LOCK();
+	_TLIST_REMOVE(tc_report_cursors, cursor);
+	TC_CURSOR_UNLOCK();
+	return 0;
+}
+
+static inline void tc_report_cursor_init(struct talloc_report_cursor *cursor,
+					 const void *ptr, int depth,
+					 int max_depth)
+{
+	cursor->root = NULL;
+	cursor->tc = NULL;
+	cursor->depth = depth;
+	cursor->max_depth = max_depth;
+
+	if (ptr == NULL) {
+		ptr = null_context;
+	}
+	if (ptr == NULL) {
+		return;
+	}
+
+	cursor->root = talloc_chunk_from_ptr(ptr);
+	cursor->tc = cursor->root;
+}
+
+static size_t tc_report_cursor_next(struct talloc_report_cursor *cursor,
+				    size_t max_chunks,
+				    void (*callback)(const void *ptr,
+						     int depth, int max_depth,
+						     int is_ref,
+						     void *private_data),
+				    void *private_data)
+{
+	size_t count = 0;
+
+	while (cursor->tc != NULL && count < max_chunks) {
+		struct talloc_chunk *tc = cursor->tc;
+		int depth = cursor->depth;
+		bool descend = false;
+
+		if (tc->flags & TALLOC_FLAG_LOOP) {
+			/* this chunk is being freed */
+		} else if (tc != cursor->root &&
+			   tc->name == TALLOC_MAGIC_REFERENCE) {
+			struct talloc_reference_handle *h =
+				(struct talloc_reference_handle *)TC_PTR_FROM_CHUNK(tc);
+			callback(h->ptr, depth, cursor->max_depth, 1,
+				 private_data);
+			count++;
+		} else {
+			callback(TC_PTR_FROM_CHUNK(tc), depth,
+				 cursor->max_depth, 0, private_data);
+			count++;
+			descend = (cursor->max_depth < 0 ||
+				   depth < cursor->max_depth);
+		}
+
+		cursor->tc = tc_walk_next(cursor->root, tc, descend,
+					  &cursor->depth);
+	}
+
+	return count;
+}
+
+/*
+  report on memory usage by all children of a pointer, giving a full tree view
+*/
+_PUBLIC_ void talloc_report_depth_cb(const void *ptr, int depth, int max_depth,
+			    void (*callback)(const void *ptr,
+			  		     int depth, int max_depth,
+					     int is_ref,
+					     void *private_data),
+			    void *private_data)
+{
+	struct talloc_report_cursor cursor;
+
+	tc_report_cursor_init(&cursor, ptr, depth, max_depth);
+	tc_report_cursor_next(&cursor, SIZE_MAX, callback, private_data);
+}
+
+/*
+  start a report that is walked in batches by talloc_report_cursor_next()
+*/
+_PUBLIC_ struct talloc_report_cursor *talloc_report_cursor(const void *ctx,
+							   const void *ptr,
+							   int depth,
+							   int max_depth)
+{
+	struct talloc_report_cursor *cursor;
+
+	cursor = talloc(ctx, struct talloc_report_cursor);
+	if (cursor == NULL) {
+		return NULL;
+	}
+
+	tc_report_cursor_init(cursor, ptr, depth, max_depth);
+	if (cursor->root != NULL) {
+		tc_set_slowfree(cursor->root);
+	}
+
+	TC_CURSOR_LOCK();
+	_TLIST_ADD(tc_report_cursors, cursor);
+	tc_report_cursor_mark(cursor);
+	TC_CURSOR_UNLOCK();
+
+	talloc_set_destructor(cursor, tc_report_cursor_destructor);
+
+	return cursor;
+}
+
 /*
-  report on memory usage by all children of a pointer, giving a full tree view
+  report on up to max_chunks more chunks, return how many were reported
 */
-_PUBLIC_ void talloc_report_depth_cb(const void *ptr, int depth, int max_depth,
-			    void (*callback)(const void *ptr,
-			  		     int depth, int max_depth,
-					     int is_ref,
-					     void *private_data),
-			    void *private_data)
+_PUBLIC_ size_t talloc_report_cursor_next(struct talloc_report_cursor *cursor,
+					  size_t max_chunks,
+					  void (*callback)(const void *ptr,
+							   int depth,
+							   int max_depth,
+							   int is_ref,
+							   void *private_data),
+					  void *private_data)
 {
-	struct talloc_chunk *c, *tc;
-
-	if (ptr == NULL) {
-		ptr = null_context;
-	}
-	if (ptr == NULL) return;
-
-	tc = talloc_chunk_from_ptr(ptr);
+	size_t count;
 
-	if (tc->flags & TALLOC_FLAG_LOOP) {
-		return;
+	if (cursor == NULL) {
+		return 0;
 	}
 
-	callback(ptr, depth, max_depth, 0, private_data);
+	count = tc_report_cursor_next(cursor, max_chunks, callback,
+				      private_data);
 
-	if (max_depth >= 0 && depth >= max_depth) {
-		return;
-	}
+	/* follow the chunk the cursor now stands on until the next batch */
+	TC_CURSOR_LOCK();
+	tc_report_cursor_mark(cursor);
+	TC_CURSOR_UNLOCK();
 
-	tc->flags |= TALLOC_FLAG_LOOP;
-	for (c=tc->child;c;c=c->next) {
-		if (c->name == TALLOC_MAGIC_REFERENCE) {
-			struct talloc_reference_handle *h = (struct talloc_reference_handle *)TC_PTR_FROM_CHUNK(c);
-			callback(h->ptr, depth + 1, max_depth, 1, private_data);
-		} else {
-			talloc_report_depth_cb(TC_PTR_FROM_CHUNK(c), depth + 1, max_depth, callback, private_data);
-		}
-	}
-	tc->flags &= ~TALLOC_FLAG_LOOP;
+	return count;
 }
 
 static void talloc_report_depth_FILE_helper(const void *ptr, int depth, int max_depth, int is_ref, void *_f)
@@ -2325,6 +5213,254 @@ _PUBLIC_ void talloc_report(const void *ptr, FILE *f)
 	talloc_report_depth_file(ptr, 0, 1, f);
 }
 
+/*
+  The format written by talloc_report_binary(). All integers are
+  little-endian.
+
+    "TALLOCSN", u32 version, u32 reserved (0)
+
+  followed by records of a u32 type and a u32 length of the payload:
+
+    TC_SNAPSHOT_NAME:  u64 name id, the name without a trailing '\0'
+    TC_SNAPSHOT_CHUNK: u64 id, u64 parent id, u64 name id, u64 size,
+                       u32 flags, u32 number of references
+    TC_SNAPSHOT_REF:   u64 id, u64 parent id, u64 id of the target
+
+  Chunks come in the order of talloc_report_full(), parents before
+  their children. Ids are the addresses of the chunks and names, a
+  name record comes before the first chunk using it. Readers skip
+  records of unknown types.
+*/
+#define TC_SNAPSHOT_MAGIC "TALLOCSN"
+#define TC_SNAPSHOT_VERSION 1
+
+#define TC_SNAPSHOT_NAME 1
+#define TC_SNAPSHOT_CHUNK 2
+#define TC_SNAPSHOT_REF 3
+
+#define TC_SNAPSHOT_FLAG_POOL 0x01
+#define TC_SNAPSHOT_FLAG_POOLMEM 0x02
+#define TC_SNAPSHOT_FLAG_DESTRUCTOR 0x04
+#define TC_SNAPSHOT_FLAG_MEMLIMIT 0x08
+
+/* longer names, like those of talloc_asprintf() strings, are cut */
+#define TC_SNAPSHOT_NAME_MAX 256
+
+struct tc_snapshot {
+	FILE *f;
+	bool failed;
+	/* the names written so far, an open addressing hash set */
+	const char **names;
+	size_t num_names;
+	size_t names_size;
+	/* the chunks from the root down to the current one */
+	struct talloc_chunk **path;
+	size_t path_size;
+};
+
+static inline void tc_put_u32(uint8_t *p, uint32_t v)
+{
+	p[0] = v;
+	p[1] = v >> 8;
+	p[2] = v >> 16;
+	p[3] = v >> 24;
+}
+
+static inline void tc_put_u64(uint8_t *p, uint64_t v)
+{
+	tc_put_u32(p, (uint32_t)v);
+	tc_put_u32(p + 4, (uint32_t)(v >> 32));
+}
+
+static void tc_snapshot_record(struct tc_snapshot *s, uint32_t type,
+			       const uint8_t *payload, size_t len,
+			       const void *extra, size_t extra_len)
+{
+	uint8_t hdr[8];
+
+	tc_put_u32(hdr, type);
+	tc_put_u32(hdr + 4, len + extra_len);
+
+	if (fwrite(hdr, sizeof(hdr), 1, s->f) != 1 ||
+	    fwrite(payload, len, 1, s->f) != 1 ||
+	    (extra_len > 0 && fwrite(extra, extra_len, 1, s->f) != 1)) {
+		s->failed = true;
+	}
+}
+
+/*
+  Write a name record unless the name was written before.
+*/
+static void tc_snapshot_name(struct tc_snapshot *s, const char *name)
+{
+	uint8_t payload[8];
+	size_t i;
+
+	if (s->num_names * 2 >= s->names_size) {
+		size_t new_size = s->names_size ? s->names_size * 2 : 1024;
+		const char **names = (const char **)calloc(new_size,
+							   sizeof(*names));
+
+		if (names == NULL) {
+			s->failed = true;
+			return;
+		}
+		for (i = 0; i < s->names_size; i++) {
+			const char *n = s->names[i];
+			size_t j;
+
+			if (n == NULL) {
+				continue;
+			}
+			j = ((uintptr_t)n >> 3) & (new_size - 1);
+			while (names[j] != NULL) {
+				j = (j + 1) & (new_size - 1);
+			}
+			names[j] = n;
+		}
+		free(s->names);
+		s->names = names;
+		s->names_size = new_size;
+	}
+
+	i = ((uintptr_t)name >> 3) & (s->names_size - 1);
+	while (s->names[i] != NULL) {
+		if (s->names[i] == name) {
+			return;
+		}
+		i = (i + 1) & (s->names_size - 1);
+	}
+	s->names[i] = name;
+	s->num_names++;
+
+	tc_put_u64(payload, (uintptr_t)name);
+	tc_snapshot_record(s, TC_SNAPSHOT_NAME, payload, sizeof(payload),
+			   name, strnlen(name, TC_SNAPSHOT_NAME_MAX));
+}
+
+static void tc_snapshot_chunk(struct tc_snapshot *s,
+			      struct talloc_chunk *tc,
+			      struct talloc_chunk *parent)
+{
+	const void *ptr = TC_PTR_FROM_CHUNK(tc);
+	const char *name = __talloc_get_name(ptr);
+	uint8_t payload[40];
+	uint32_t flags = 0;
+
+	tc_snapshot_name(s, name);
+
+	if (tc->flags & TALLOC_FLAG_POOL) {
+		flags |= TC_SNAPSHOT_FLAG_POOL;
+	}
+	if (tc->flags & TALLOC_FLAG_POOLMEM) {
+		flags |= TC_SNAPSHOT_FLAG_POOLMEM;
+	}
+	if (tc->destructor != NULL) {
+		flags |= TC_SNAPSHOT_FLAG_DESTRUCTOR;
+	}
+	if (tc->limit != NULL && tc->limit->parent == tc) {
+		flags |= TC_SNAPSHOT_FLAG_MEMLIMIT;
+	}
+
+	tc_put_u64(payload, (uintptr_t)ptr);
+	tc_put_u64(payload + 8,
+		   parent ? (uintptr_t)TC_PTR_FROM_CHUNK(parent) : 0);
+	tc_put_u64(payload + 16, (uintptr_t)name);
+	tc_put_u64(payload + 24, tc->size);
+	tc_put_u32(payload + 32, flags);
+	tc_put_u32(payload + 36, talloc_reference_count(ptr));
+
+	tc_snapshot_record(s, TC_SNAPSHOT_CHUNK, payload, sizeof(payload),
+			   NULL, 0);
+}
+
+static void tc_snapshot_ref(struct tc_snapshot *s,
+			    struct talloc_chunk *tc,
+			    struct talloc_chunk *parent)
+{
+	struct talloc_reference_handle *h =
+		(struct talloc_reference_handle *)TC_PTR_FROM_CHUNK(tc);
+	uint8_t payload[24];
+
+	tc_put_u64(payload, (uintptr_t)h);
+	tc_put_u64(payload + 8,
+		   parent ? (uintptr_t)TC_PTR_FROM_CHUNK(parent) : 0);
+	tc_put_u64(payload + 16, (uintptr_t)h->ptr);
+
+	tc_snapshot_record(s, TC_SNAPSHOT_REF, payload, sizeof(payload),
+			   NULL, 0);
+}
+
+/*
+  write a binary snapshot of the memory used by all children of a pointer
+*/
+_PUBLIC_ int talloc_report_binary(const void *ptr, FILE *f)
+{
+	struct tc_snapshot s;
+	struct talloc_chunk *root, *tc;
+	uint8_t hdr[16];
+	int depth = 0;
+
+	if (f == NULL) {
+		return -1;
+	}
+
+	memset(&s, 0, sizeof(s));
+	s.f = f;
+
+	memcpy(hdr, TC_SNAPSHOT_MAGIC, 8);
+	tc_put_u32(hdr + 8, TC_SNAPSHOT_VERSION);
+	tc_put_u32(hdr + 12, 0);
+	if (fwrite(hdr, sizeof(hdr), 1, f) != 1) {
+		return -1;
+	}
+
+	if (ptr == NULL) {
+		ptr = null_context;
+	}
+	root = ptr ? talloc_chunk_from_ptr(ptr) : NULL;
+
+	for (tc = root; tc != NULL && !s.failed; ) {
+		struct talloc_chunk *parent;
+		bool descend = false;
+
+		if ((size_t)depth >= s.path_size) {
+			size_t new_size = s.path_size ? s.path_size * 2 : 64;
+			struct talloc_chunk **path;
+
+			path = (struct talloc_chunk **)realloc(s.path,
+				new_size * sizeof(*path));
+			if (path == NULL) {
+				s.failed = true;
+				break;
+			}
+			s.path = path;
+			s.path_size = new_size;
+		}
+		s.path[depth] = tc;
+		parent = depth > 0 ? s.path[depth - 1] : NULL;
+
+		if (tc->flags & TALLOC_FLAG_LOOP) {
+			/* this chunk is being freed */
+		} else if (tc != root && tc->name == TALLOC_MAGIC_REFERENCE) {
+			tc_snapshot_ref(&s, tc, parent);
+		} else {
+			tc_snapshot_chunk(&s, tc, parent);
+			descend = true;
+		}
+
+		tc = tc_walk_next(root, tc, descend, &depth);
+	}
+
+	free(s.names);
+	free(s.path);
+
+	if (s.failed || fflush(f) != 0) {
+		return -1;
+	}
+	return 0;
+}
+
 /*
   enable tracking of the NULL context
 */
@@ -2359,6 +5495,10 @@ _PUBLIC_ void talloc_disable_null_tracking(void)
 		   context */
 		struct talloc_chunk *tc, *tc2;
 		tc = talloc_chunk_from_ptr(null_context);
+		if (tc->xflags & TALLOC_XFLAG_REF_OWNER) {
+			/* reference handles among them lose their parent */
+			tc_ref_rekey_children(tc, NULL);
+		}
 		for (tc2 = tc->child; tc2; tc2=tc2->next) {
 			if (tc2->parent == tc) tc2->parent = NULL;
 			if (tc2->prev == tc) tc2->prev = NULL;
@@ -2455,19 +5595,112 @@ _PUBLIC_ char *talloc_strndup(const void *t, const char *p, size_t n)
 	return __talloc_strlendup(t, p, strnlen(p, n));
 }
 
+/*
+ * A string builder (TALLOC_XFLAG_STRBUF) is a string with spare
+ * capacity.  tc->size is the real size of the chunk, so memory limits
+ * and accounting stay exact, and the length of the string is kept in
+ * a trailer in the last bytes of the chunk.
+ */
+#define TALLOC_STRBUF_TRAILER sizeof(size_t)
+#define TALLOC_STRBUF_MIN 64
+
+static inline size_t tc_strbuf_len(struct talloc_chunk *tc)
+{
+	size_t len;
+
+	memcpy(&len,
+	       (char *)TC_PTR_FROM_CHUNK(tc) + tc->size - TALLOC_STRBUF_TRAILER,
+	       sizeof(len));
+	return len;
+}
+
+static inline void tc_strbuf_set_len(struct talloc_chunk *tc, size_t len)
+{
+	memcpy((char *)TC_PTR_FROM_CHUNK(tc) + tc->size - TALLOC_STRBUF_TRAILER,
+	       &len, sizeof(len));
+}
+
+/*
+ * Make room for a string of len characters plus the trailing \0 in a
+ * string builder, at least doubling the capacity when it has to grow.
+ */
+static char *talloc_strbuf_reserve(char *s, size_t len)
+{
+	struct talloc_chunk *tc = talloc_chunk_from_ptr(s);
+	size_t capacity = tc->size - TALLOC_STRBUF_TRAILER;
+	size_t new_capacity;
+	size_t slen;
+
+	if (likely(len < capacity)) {
+		return s;
+	}
+
+	if (unlikely(len + 1 + TALLOC_STRBUF_TRAILER <= len)) {
+		return NULL;
+	}
+
+	new_capacity = capacity * 2;
+	if (new_capacity < len + 1) {
+		new_capacity = len + 1;
+	}
+	if (new_capacity + TALLOC_STRBUF_TRAILER >= MAX_TALLOC_SIZE) {
+		new_capacity = len + 1;
+	}
+
+	slen = tc_strbuf_len(tc);
+
+	s = (char *)_talloc_realloc(NULL, s,
+				    new_capacity + TALLOC_STRBUF_TRAILER,
+				    "char");
+	if (unlikely(s == NULL)) {
+		return NULL;
+	}
+
+	tc = talloc_chunk_from_ptr(s);
+	tc->xflags |= TALLOC_XFLAG_STRBUF;
+	tc_strbuf_set_len(tc, slen);
+	return s;
+}
+
+/*
+ * The end of the talloc'ed buffer, which for a string builder is the
+ * end of the string it holds.
+ */
+static inline size_t talloc_buffer_len(const char *s)
+{
+	struct talloc_chunk *tc = talloc_chunk_from_ptr(s);
+
+	if (unlikely(tc->xflags & TALLOC_XFLAG_STRBUF)) {
+		return tc_strbuf_len(tc);
+	}
+	if (likely(tc->size > 0)) {
+		return tc->size - 1;
+	}
+	return 0;
+}
+
 static inline char *__talloc_strlendup_append(char *s, size_t slen,
 					      const char *a, size_t alen)
 {
+	struct talloc_chunk *tc;
 	char *ret;
 
-	ret = talloc_realloc(NULL, s, char, slen + alen + 1);
+	if (unlikely(talloc_chunk_from_ptr(s)->xflags & TALLOC_XFLAG_STRBUF)) {
+		ret = talloc_strbuf_reserve(s, slen + alen);
+	} else {
+		ret = talloc_realloc(NULL, s, char, slen + alen + 1);
+	}
 	if (unlikely(!ret)) return NULL;
 
 	/* append the string and the trailing \0 */
 	memcpy(&ret[slen], a, alen);
 	ret[slen+alen] = 0;
 
-	_tc_set_name_const(talloc_chunk_from_ptr(ret), ret);
+	tc = talloc_chunk_from_ptr(ret);
+	if (unlikely(tc->xflags & TALLOC_XFLAG_STRBUF)) {
+		tc_strbuf_set_len(tc, slen + alen);
+	}
+	_tc_set_name_const(tc, ret);
 	return ret;
 }
 
@@ -2503,10 +5736,7 @@ _PUBLIC_ char *talloc_strdup_append_buffer(char *s, const char *a)
 		return s;
 	}
 
-	slen = talloc_get_size(s);
-	if (likely(slen > 0)) {
-		slen--;
-	}
+	slen = talloc_buffer_len(s);
 
 	return __talloc_strlendup_append(s, slen, a, strlen(a));
 }
@@ -2543,10 +5773,7 @@ _PUBLIC_ char *talloc_strndup_append_buffer(char *s, const char *a, size_t n)
 		return s;
 	}
 
-	slen = talloc_get_size(s);
-	if (likely(slen > 0)) {
-		slen--;
-	}
+	slen = talloc_buffer_len(s);
 
 	return __talloc_strlendup_append(s, slen, a, strnlen(a, n));
 }
@@ -2559,6 +5786,15 @@ _PUBLIC_ char *talloc_strndup_append_buffer(char *s, const char *a, size_t n)
 #endif
 #endif
 
+/*
+ * Below this much free pool space _vasprintf_tc() formats into a
+ * stack buffer first. It never claims more than
+ * TALLOC_VASPRINTF_MAX_ROOM of the pool for a single string, longer
+ * results are formatted a second time.
+ */
+#define TALLOC_VASPRINTF_MIN_ROOM 128
+#define TALLOC_VASPRINTF_MAX_ROOM 4096
+
 static struct talloc_chunk *_vasprintf_tc(const void *t,
 					  const char *fmt,
 					  va_list ap) PRINTF_ATTRIBUTE(2,0);
@@ -2573,6 +5809,62 @@ static struct talloc_chunk *_vasprintf_tc(const void *t,
 	va_list ap2;
 	struct talloc_chunk *tc;
 	char buf[1024];
+	size_t room = 0;
+
+	if (t != NULL) {
+		room = tc_pool_room(talloc_chunk_from_ptr(t));
+		room = MIN(room, TALLOC_VASPRINTF_MAX_ROOM);
+	}
+
+	if (room >= TALLOC_VASPRINTF_MIN_ROOM) {
+		/*
+		 * Format straight into the free pool space and give back
+		 * what is left over, only formatting a second time if
+		 * the result does not fit.
+		 */
+		ret = (char *)__talloc(t, room, &tc);
+		if (unlikely(!ret)) return NULL;
+
+		va_copy(ap2, ap);
+		vlen = vsnprintf(ret, room, fmt, ap2);
+		va_end(ap2);
+		if (unlikely(vlen < 0)) {
+			talloc_free(ret);
+			return NULL;
+		}
+		len = vlen;
+
+		if (likely(len < room)) {
+			/*
+			 * Not _talloc_realloc(), the string must not be
+			 * sampled as a "char" allocation. There is no
+			 * memory limit, see tc_pool_room().
+			 */
+			ret = (char *)_talloc_realloc_chunk(tc, ret, len + 1,
+							    "char");
+			if (unlikely(!ret)) return NULL;
+
+			tc = talloc_chunk_from_ptr(ret);
+			_tc_set_name_const(tc, ret);
+			return tc;
+		}
+
+		talloc_free(ret);
+
+		if (unlikely(len + 1 < len)) {
+			return NULL;
+		}
+
+		ret = (char *)__talloc(t, len+1, &tc);
+		if (unlikely(!ret)) return NULL;
+
+		va_copy(ap2, ap);
+		vsnprintf(ret, len+1, fmt, ap2);
+		va_end(ap2);
+
+		_tc_set_name_const(tc, ret);
+		return tc;
+	}
 
 	/* this call looks strange, but it makes it work on older solaris boxes */
 	va_copy(ap2, ap);
@@ -2633,6 +5925,7 @@ static inline char *__talloc_vaslenprintf_append(char *s, size_t slen,
 static inline char *__talloc_vaslenprintf_append(char *s, size_t slen,
 						 const char *fmt, va_list ap)
 {
+	struct talloc_chunk *tc;
 	ssize_t alen;
 	va_list ap2;
 	char c;
@@ -2651,14 +5944,22 @@ static inline char *__talloc_vaslenprintf_append(char *s, size_t slen,
 		return s;
 	}
 
-	s = talloc_realloc(NULL, s, char, slen + alen + 1);
+	if (unlikely(talloc_chunk_from_ptr(s)->xflags & TALLOC_XFLAG_STRBUF)) {
+		s = talloc_strbuf_reserve(s, slen + alen);
+	} else {
+		s = talloc_realloc(NULL, s, char, slen + alen + 1);
+	}
 	if (!s) return NULL;
 
 	va_copy(ap2, ap);
 	vsnprintf(s + slen, alen + 1, fmt, ap2);
 	va_end(ap2);
 
-	_tc_set_name_const(talloc_chunk_from_ptr(s), s);
+	tc = talloc_chunk_from_ptr(s);
+	if (unlikely(tc->xflags & TALLOC_XFLAG_STRBUF)) {
+		tc_strbuf_set_len(tc, slen + alen);
+	}
+	_tc_set_name_const(tc, s);
 	return s;
 }
 
@@ -2690,10 +5991,7 @@ _PUBLIC_ char *talloc_vasprintf_append_buffer(char *s, const char *fmt, va_list
 		return talloc_vasprintf(NULL, fmt, ap);
 	}
 
-	slen = talloc_get_size(s);
-	if (likely(slen > 0)) {
-		slen--;
-	}
+	slen = talloc_buffer_len(s);
 
 	return __talloc_vaslenprintf_append(s, slen, fmt, ap);
 }
@@ -2714,17 +6012,125 @@ _PUBLIC_ char *talloc_asprintf_append(char *s, const char *fmt, ...)
 }
 
 /*
-  Realloc @p s to append the formatted result of @p fmt and return @p
-  s, which may have moved.  Good for gradually accumulating output
-  into a buffer.
- */
-_PUBLIC_ char *talloc_asprintf_append_buffer(char *s, const char *fmt, ...)
+  Realloc @p s to append the formatted result of @p fmt and return @p
+  s, which may have moved.  Good for gradually accumulating output
+  into a buffer.
+ */
+_PUBLIC_ char *talloc_asprintf_append_buffer(char *s, const char *fmt, ...)
+{
+	va_list ap;
+
+	va_start(ap, fmt);
+	s = talloc_vasprintf_append_buffer(s, fmt, ap);
+	va_end(ap);
+	return s;
+}
+
+/*
+  create an empty string builder with room for capacity characters
+*/
+_PUBLIC_ char *talloc_strbuf_new(const void *ctx, size_t capacity)
+{
+	struct talloc_chunk *tc;
+	char *s;
+
+	if (capacity < TALLOC_STRBUF_MIN) {
+		capacity = TALLOC_STRBUF_MIN;
+	}
+	if (unlikely(capacity + TALLOC_STRBUF_TRAILER >= MAX_TALLOC_SIZE)) {
+		return NULL;
+	}
+
+	s = (char *)__talloc(ctx, capacity + TALLOC_STRBUF_TRAILER, &tc);
+	if (unlikely(s == NULL)) {
+		return NULL;
+	}
+
+	s[0] = '\0';
+	tc->xflags |= TALLOC_XFLAG_STRBUF;
+	tc_strbuf_set_len(tc, 0);
+	_tc_set_name_const(tc, s);
+	return s;
+}
+
+/*
+  turn a talloc'ed string into a string builder, the string ends at
+  the end of the talloc'ed buffer
+*/
+_PUBLIC_ char *talloc_strbuf(char *s)
+{
+	struct talloc_chunk *tc;
+	size_t slen;
+	size_t capacity;
+
+	if (unlikely(s == NULL)) {
+		return NULL;
+	}
+
+	tc = talloc_chunk_from_ptr(s);
+	if (tc->xflags & TALLOC_XFLAG_STRBUF) {
+		return s;
+	}
+
+	slen = talloc_buffer_len(s);
+	capacity = slen + 1;
+	if (capacity < TALLOC_STRBUF_MIN) {
+		capacity = TALLOC_STRBUF_MIN;
+	}
+	if (unlikely(capacity + TALLOC_STRBUF_TRAILER >= MAX_TALLOC_SIZE)) {
+		return NULL;
+	}
+
+	s = (char *)_talloc_realloc(NULL, s,
+				    capacity + TALLOC_STRBUF_TRAILER,
+				    "char");
+	if (unlikely(s == NULL)) {
+		return NULL;
+	}
+
+	s[slen] = '\0';
+	tc = talloc_chunk_from_ptr(s);
+	tc->xflags |= TALLOC_XFLAG_STRBUF;
+	tc_strbuf_set_len(tc, slen);
+	_tc_set_name_const(tc, s);
+	return s;
+}
+
+/*
+  return the length of the string held by a string builder
+*/
+_PUBLIC_ size_t talloc_strbuf_len(const char *s)
+{
+	if (unlikely(s == NULL)) {
+		return 0;
+	}
+	return talloc_buffer_len(s);
+}
+
+/*
+  shrink a string builder to fit and turn it back into a plain string
+*/
+_PUBLIC_ char *talloc_strbuf_finish(char *s)
 {
-	va_list ap;
+	struct talloc_chunk *tc;
+	size_t slen;
 
-	va_start(ap, fmt);
-	s = talloc_vasprintf_append_buffer(s, fmt, ap);
-	va_end(ap);
+	if (unlikely(s == NULL)) {
+		return NULL;
+	}
+
+	tc = talloc_chunk_from_ptr(s);
+	if (!(tc->xflags & TALLOC_XFLAG_STRBUF)) {
+		return s;
+	}
+
+	slen = tc_strbuf_len(tc);
+	s = (char *)_talloc_realloc(NULL, s, slen + 1, "char");
+	if (unlikely(s == NULL)) {
+		return NULL;
+	}
+
+	_tc_set_name_const(talloc_chunk_from_ptr(s), s);
 	return s;
 }
 
@@ -2750,6 +6156,128 @@ _PUBLIC_ void *_talloc_zero_array(const void *ctx, size_t el_size, unsigned coun
 	return _talloc_zero(ctx, el_size * count, name);
 }
 
+/*
+  Allocate count chunks of el_size bytes each as children of ctx, and
+  an array of pointers to them, from a single block. The block is a
+  talloc pool that is freed right away: like the children of a pool
+  that were stolen out of it, the chunks stay independent talloc
+  chunks, and the block goes back to malloc once all of them are
+  freed.
+*/
+_PUBLIC_ void *_talloc_array_of_chunks(const void *ctx, size_t el_size,
+				       unsigned count, const char *name)
+{
+	struct talloc_chunk *parent = NULL;
+	struct talloc_chunk *pool_tc, *tc;
+	struct talloc_memlimit *limit;
+	size_t chunk_len, array_len;
+	void **array = NULL;
+	void *pool;
+	unsigned i;
+
+	if (ctx == NULL) {
+		ctx = null_context;
+	}
+	if (ctx != NULL) {
+		parent = talloc_chunk_from_ptr(ctx);
+	}
+
+	if (el_size >= MAX_TALLOC_SIZE ||
+	    count >= MAX_TALLOC_SIZE / sizeof(void *)) {
+		return NULL;
+	}
+	chunk_len = TC_ALIGN16(TC_HDR_SIZE + el_size);
+	array_len = TC_ALIGN16(TC_HDR_SIZE + count * sizeof(void *));
+	if (count >= (MAX_TALLOC_SIZE - array_len) / chunk_len) {
+		return NULL;
+	}
+
+	/*
+	 * The children of pools and thread-safe contexts can't come from
+	 * a block of their own.
+	 */
+	if (parent != NULL &&
+	    ((parent->flags & (TALLOC_FLAG_POOL | TALLOC_FLAG_POOLMEM)) ||
+	     (parent->xflags & TALLOC_XFLAG_THREADSAFE))) {
+		array = (void **)_talloc_array(ctx, sizeof(void *), count,
+					       "talloc_array_of_chunks");
+		if (array == NULL) {
+			return NULL;
+		}
+		for (i = 0; i < count; i++) {
+			array[i] = _talloc_named_const(ctx, el_size, name);
+			if (array[i] == NULL) {
+				while (i > 0) {
+					_talloc_free_internal(array[--i],
+							      __location__);
+				}
+				_talloc_free_internal(array, __location__);
+				return NULL;
+			}
+		}
+		return array;
+	}
+
+	/*
+	 * The pool is only a block to carve the chunks from, it leaves
+	 * the tree again below, so ctx does not need the slow free path.
+	 */
+	pool = __talloc_pool(ctx, array_len + count * chunk_len);
+	if (pool == NULL) {
+		return NULL;
+	}
+	pool_tc = talloc_chunk_from_ptr(pool);
+	limit = pool_tc->limit;
+
+	for (i = 0; i <= count; i++) {
+		size_t size = i == 0 ? count * sizeof(void *) : el_size;
+
+		tc = tc_alloc_pool(pool_tc, TC_HDR_SIZE + size, 0);
+		if (unlikely(tc == NULL)) {
+			unsigned j;
+
+			for (j = 1; j < i; j++) {
+				_talloc_free_internal(array[j - 1],
+						      __location__);
+			}
+			if (i > 0) {
+				_talloc_free_internal(array, __location__);
+			}
+			_talloc_free_internal(pool, __location__);
+			return NULL;
+		}
+		tc->limit = limit;
+		tc->size = size;
+		tc->destructor = NULL;
+		tc->child = NULL;
+		tc->refs = NULL;
+
+		if (parent != NULL) {
+			tc_link_new_child(parent, tc);
+		} else {
+			tc->next = tc->prev = tc->parent = NULL;
+		}
+
+		if (unlikely(limit != NULL)) {
+			talloc_memlimit_account(limit, size, 1);
+		}
+
+		if (i == 0) {
+			_tc_set_name_const(tc, "talloc_array_of_chunks");
+			array = (void **)TC_PTR_FROM_CHUNK(tc);
+		} else {
+			_tc_set_name_const(tc, name);
+			tc_sample(el_size, name);
+			array[i - 1] = TC_PTR_FROM_CHUNK(tc);
+		}
+	}
+
+	/* the block stays until the last of the chunks is freed */
+	_talloc_free_internal(pool, __location__);
+
+	return array;
+}
+
 /*
   realloc an array, checking for integer overflow in the array size
 */
@@ -2898,14 +6426,196 @@ static inline size_t _talloc_total_limit_size(const void *ptr,
 					  old_limit, new_limit);
 }
 
+/*
+  Nested memory limits work with credit.
+
+  Every byte charged to a limit has to be charged to all limits above
+  it as well. Instead of walking the whole 'upper' chain on every
+  allocation and free, a nested limit reserves a batch of memory from
+  the limit above it at once, and keeps what it did not use yet as its
+  'credit'. The limit above counts the credit in its cur_size as if it
+  was in use, so a limit is never exceeded. As long as an allocation is
+  covered by the credit, only the limit of the chunk itself needs to be
+  checked and updated.
+
+  Freed memory becomes credit of the limit again, and if that grows
+  beyond TC_MEMLIMIT_CREDIT_MAX, the excess is given back to the limit
+  above. Before a limit refuses an allocation, it takes back the credit
+  held by the limits below it, so unused credit never makes an
+  allocation fail.
+
+  The totals for talloc_total_size() and talloc_total_blocks() are
+  batched the same way: a nested limit only updates its own totals,
+  and passes the change on to the limit above when it gets or gives
+  back credit. Reading the totals of a limit first collects what the
+  limits below it still hold.
+
+  To find that credit and those totals without walking the tree, every
+  limit that holds either of them, or has a limit below it that does,
+  is on the 'lower' list of the limit above it.
+*/
+
+#define TC_MEMLIMIT_CREDIT (16*1024)
+#define TC_MEMLIMIT_CREDIT_MAX (2*TC_MEMLIMIT_CREDIT)
+
+static inline bool tc_memlimit_fits(struct talloc_memlimit *limit,
+				    size_t size)
+{
+	return limit->max_size == 0 ||
+	       (limit->max_size > limit->cur_size &&
+		limit->max_size - limit->cur_size >= size);
+}
+
+static inline bool tc_memlimit_has_credit(struct talloc_memlimit *limit)
+{
+	return limit->credit != 0 || limit->pending_size != 0 ||
+	       limit->pending_blocks != 0 || limit->lower != NULL;
+}
+
+/*
+  Keep a limit whose credit or pending totals changed, and the limits
+  above it, on the right 'lower' lists. had_credit is what
+  tc_memlimit_has_credit() returned before the change. Only the first
+  change and the last one give any work.
+*/
+static inline void tc_memlimit_relist(struct talloc_memlimit *limit,
+				      bool had_credit)
+{
+	struct talloc_memlimit *l = limit;
+
+	while (l->upper != NULL) {
+		struct talloc_memlimit *upper = l->upper;
+		bool upper_had_credit;
+
+		if (tc_memlimit_has_credit(l) == had_credit) {
+			return;
+		}
+
+		upper_had_credit = tc_memlimit_has_credit(upper);
+		if (had_credit) {
+			_TLIST_REMOVE(upper->lower, l);
+		} else {
+			_TLIST_ADD(upper->lower, l);
+		}
+		l = upper;
+		had_credit = upper_had_credit;
+	}
+}
+
+/*
+  Set the credit of a limit.
+*/
+static inline void tc_memlimit_set_credit(struct talloc_memlimit *limit,
+					  size_t credit)
+{
+	bool had_credit = tc_memlimit_has_credit(limit);
+
+	limit->credit = credit;
+	tc_memlimit_relist(limit, had_credit);
+}
+
+/*
+  Pass the pending change of the totals of a limit to the limit above.
+*/
+static inline void tc_memlimit_pass_totals(struct talloc_memlimit *limit)
+{
+	size_t size = limit->pending_size;
+	size_t blocks = limit->pending_blocks;
+	bool had_credit;
+
+	if (size == 0 && blocks == 0) {
+		return;
+	}
+
+	had_credit = tc_memlimit_has_credit(limit);
+	limit->pending_size = 0;
+	limit->pending_blocks = 0;
+	tc_memlimit_relist(limit, had_credit);
+
+	/* a decrease wraps around, and does so again when it is added */
+	talloc_memlimit_account(limit->upper, size, blocks);
+}
+
+/*
+  Give the credit of all limits below 'limit' back to the limits above
+  them, the lowest ones first, so that it ends up with 'limit'. Only
+  the limits on the 'lower' lists are visited.
+*/
+static void tc_memlimit_reclaim(struct talloc_memlimit *limit)
+{
+	struct talloc_memlimit *l = limit;
+
+	while (true) {
+		struct talloc_memlimit *upper;
+
+		if (l->lower != NULL) {
+			l = l->lower;
+			continue;
+		}
+		if (l == limit) {
+			return;
+		}
+		upper = l->upper;
+		tc_memlimit_release_credit(l);
+		l = upper;
+	}
+}
+
+static bool tc_memlimit_reserve(struct talloc_memlimit *limit, size_t size);
+
 static inline bool talloc_memlimit_check(struct talloc_memlimit *limit, size_t size)
 {
-	struct talloc_memlimit *l;
+	if (limit == NULL) {
+		return true;
+	}
+
+	if (unlikely(!tc_memlimit_fits(limit, size))) {
+		tc_memlimit_reclaim(limit);
+		if (!tc_memlimit_fits(limit, size)) {
+			return false;
+		}
+	}
+
+	if (likely(limit->upper == NULL || limit->credit >= size)) {
+		return true;
+	}
+
+	return tc_memlimit_reserve(limit, size);
+}
+
+/*
+  Get enough credit from the limits above to cover size.
+*/
+static bool tc_memlimit_reserve(struct talloc_memlimit *limit, size_t size)
+{
+	size_t extra = TC_MEMLIMIT_CREDIT;
+
+	tc_memlimit_pass_totals(limit);
+
+	while (limit->credit < size) {
+		size_t want = size - limit->credit;
+
+		if (limit->max_size != 0) {
+			/* more credit than this limit can use is no help */
+			size_t used = limit->cur_size + limit->credit + want;
+			size_t room = 0;
+
+			if (used >= want && limit->max_size > used) {
+				room = limit->max_size - used;
+			}
+			extra = MIN(extra, room);
+		}
+		if (want + extra < want) {
+			extra = 0;
+		}
 
-	for (l = limit; l != NULL; l = l->upper) {
-		if (l->max_size != 0 &&
-		    ((l->max_size <= l->cur_size) ||
-		     (l->max_size - l->cur_size < size))) {
+		if (talloc_memlimit_check(limit->upper, want + extra)) {
+			talloc_memlimit_grow(limit->upper, want + extra);
+			tc_memlimit_set_credit(limit,
+					       limit->credit + want + extra);
+		} else if (extra != 0) {
+			extra = 0;
+		} else {
 			return false;
 		}
 	}
@@ -2913,6 +6623,34 @@ static inline bool talloc_memlimit_check(struct talloc_memlimit *limit, size_t s
 	return true;
 }
 
+/*
+  Give the credit of a limit back to the limit above it, together with
+  the pending change of its totals.
+*/
+static void tc_memlimit_release_credit(struct talloc_memlimit *limit)
+{
+	size_t credit = limit->credit;
+
+	tc_memlimit_pass_totals(limit);
+
+	if (credit == 0) {
+		return;
+	}
+
+	tc_memlimit_set_credit(limit, 0);
+	talloc_memlimit_shrink(limit->upper, credit);
+}
+
+/*
+  Give back the credit of a limit and of all limits below it, as
+  before the limit moves to a different limit above it.
+*/
+static void tc_memlimit_release_all(struct talloc_memlimit *limit)
+{
+	tc_memlimit_reclaim(limit);
+	tc_memlimit_release_credit(limit);
+}
+
 /*
   Update memory limits when freeing a talloc_chunk.
 */
@@ -2954,27 +6692,64 @@ static void tc_memlimit_update_on_free(struct talloc_chunk *tc)
 	talloc_memlimit_shrink(tc->limit, limit_shrink_size);
 
 	if (tc->limit->parent == tc) {
+		tc_memlimit_release_all(tc->limit);
 		free(tc->limit);
 	}
 
 	tc->limit = NULL;
 }
 
+/*
+  Update the accounting of a chunk that leaves the talloc hierarchy.
+*/
+static inline void tc_memlimit_unaccount_chunk(struct talloc_chunk *tc)
+{
+	size_t size = tc->size;
+
+	if (likely(tc->limit == NULL)) {
+		return;
+	}
+
+	/* unlinked arena chunks have never been counted */
+	if (tc->xflags & TALLOC_XFLAG_UNLINKED) {
+		return;
+	}
+
+	if (unlikely(tc->name == TALLOC_MAGIC_REFERENCE)) {
+		size = 0;
+	}
+
+	talloc_memlimit_unaccount(tc->limit, size, 1);
+}
+
 /*
   Increase memory limit accounting after a malloc/realloc.
 */
 static void talloc_memlimit_grow(struct talloc_memlimit *limit,
 				size_t size)
 {
-	struct talloc_memlimit *l;
+	struct talloc_memlimit *l = limit;
 
-	for (l = limit; l != NULL; l = l->upper) {
+	while (l != NULL) {
 		size_t new_cur_size = l->cur_size + size;
 		if (new_cur_size < l->cur_size) {
 			talloc_abort("logic error in talloc_memlimit_grow\n");
 			return;
 		}
 		l->cur_size = new_cur_size;
+
+		if (l->upper == NULL) {
+			return;
+		}
+		if (likely(l->credit >= size)) {
+			tc_memlimit_set_credit(l, l->credit - size);
+			return;
+		}
+
+		/* charge what the credit does not cover above */
+		size -= l->credit;
+		tc_memlimit_set_credit(l, 0);
+		l = l->upper;
 	}
 }
 
@@ -2984,15 +6759,84 @@ static void talloc_memlimit_grow(struct talloc_memlimit *limit,
 static void talloc_memlimit_shrink(struct talloc_memlimit *limit,
 				size_t size)
 {
-	struct talloc_memlimit *l;
+	struct talloc_memlimit *l = limit;
 
-	for (l = limit; l != NULL; l = l->upper) {
+	while (l != NULL) {
 		if (l->cur_size < size) {
 			talloc_abort("logic error in talloc_memlimit_shrink\n");
 			return;
 		}
 		l->cur_size = l->cur_size - size;
+
+		if (l->upper == NULL) {
+			return;
+		}
+		if (likely(l->credit + size <= TC_MEMLIMIT_CREDIT_MAX)) {
+			tc_memlimit_set_credit(l, l->credit + size);
+			return;
+		}
+
+		/* give back what is too much to keep */
+		size = l->credit + size - TC_MEMLIMIT_CREDIT;
+		tc_memlimit_set_credit(l, TC_MEMLIMIT_CREDIT);
+		l = l->upper;
+	}
+}
+
+/*
+  Count chunks entering a context with a memory limit in
+  talloc_total_size() and talloc_total_blocks(). Only the limit itself
+  is updated, the limits above get the change with the next credit.
+*/
+static inline void talloc_memlimit_account(struct talloc_memlimit *limit,
+				size_t size, size_t blocks)
+{
+	bool had_credit;
+
+	if (limit == NULL) {
+		return;
+	}
+
+	limit->total_size += size;
+	limit->total_blocks += blocks;
+
+	if (limit->upper == NULL) {
+		return;
+	}
+
+	had_credit = tc_memlimit_has_credit(limit);
+	limit->pending_size += size;
+	limit->pending_blocks += blocks;
+	tc_memlimit_relist(limit, had_credit);
+}
+
+/*
+  Count chunks leaving a context with a memory limit.
+*/
+static inline void talloc_memlimit_unaccount(struct talloc_memlimit *limit,
+				size_t size, size_t blocks)
+{
+	bool had_credit;
+
+	if (limit == NULL) {
+		return;
+	}
+
+	if (limit->total_size < size || limit->total_blocks < blocks) {
+		talloc_abort("logic error in talloc_memlimit_unaccount\n");
+		return;
+	}
+	limit->total_size -= size;
+	limit->total_blocks -= blocks;
+
+	if (limit->upper == NULL) {
+		return;
 	}
+
+	had_credit = tc_memlimit_has_credit(limit);
+	limit->pending_size -= size;
+	limit->pending_blocks -= blocks;
+	tc_memlimit_relist(limit, had_credit);
 }
 
 _PUBLIC_ int talloc_set_memlimit(const void *ctx, size_t max_size)
@@ -3001,18 +6845,39 @@ _PUBLIC_ int talloc_set_memlimit(const void *ctx, size_t max_size)
 	struct talloc_memlimit *orig_limit;
 	struct talloc_memlimit *limit = NULL;
 
+	if (unlikely(tc->xflags & TALLOC_XFLAG_UNLINKED)) {
+		tc_arena_link(tc);
+	}
+
+	/* memory limits are not thread-safe */
+	if (unlikely(tc->xflags & TALLOC_XFLAG_THREADSAFE)) {
+		return 1;
+	}
+
 	if (tc->limit && tc->limit->parent == tc) {
 		tc->limit->max_size = max_size;
 		return 0;
 	}
 	orig_limit = tc->limit;
 
+	/* .. nor is any other memory limit above a thread-safe context */
+	if (orig_limit == NULL && tc_has_threadsafe(tc)) {
+		return 1;
+	}
+
 	limit = malloc(sizeof(struct talloc_memlimit));
 	if (limit == NULL) {
 		return 1;
 	}
 	limit->parent = tc;
 	limit->max_size = max_size;
+	limit->credit = 0;
+	limit->pending_size = 0;
+	limit->pending_blocks = 0;
+	limit->lower = NULL;
+	limit->prev = limit->next = NULL;
+	/* count before the tree points to the new limit */
+	_talloc_total_counts(ctx, &limit->total_size, &limit->total_blocks);
 	limit->cur_size = _talloc_total_limit_size(ctx, tc->limit, limit);
 
 	if (orig_limit) {
@@ -3021,5 +6886,49 @@ _PUBLIC_ int talloc_set_memlimit(const void *ctx, size_t max_size)
 		limit->upper = NULL;
 	}
 
+	/*
+	 * The limit is owned by this chunk and freed with it, so its
+	 * children must not be swept by _tc_free_children_fast().
+	 */
+	tc_set_slowfree(tc);
+
+	return 0;
+}
+
+_PUBLIC_ int talloc_enable_accounting(const void *ctx)
+{
+	struct talloc_chunk *tc = talloc_chunk_from_ptr(ctx);
+
+	if (tc->limit && tc->limit->parent == tc) {
+		return 0;
+	}
+
+	return talloc_set_memlimit(ctx, 0);
+}
+
+/*
+  Let every child of ctx point to it directly, not just the first one,
+  so talloc_parent() and talloc_steal() of its children are O(1).
+*/
+_PUBLIC_ int talloc_enable_parent_links(const void *ctx)
+{
+	struct talloc_chunk *tc;
+	struct talloc_chunk *c;
+
+	if (unlikely(ctx == NULL)) {
+		return -1;
+	}
+
+	tc = talloc_chunk_from_ptr(ctx);
+
+	if (tc->xflags & TALLOC_XFLAG_PARENT_LINKS) {
+		return 0;
+	}
+
+	tc->xflags |= TALLOC_XFLAG_PARENT_LINKS;
+	for (c = tc->child; c != NULL; c = c->next) {
+		c->parent = tc;
+	}
+
 	return 0;
 }
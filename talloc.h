@@ -329,8 +329,9 @@ void talloc_set_destructor(const void *ptr, int (*destructor)(void *));
  *
  * @param[in]  ptr      The talloc chunk to move.
  *
- * @return              Returns the pointer that you pass it. It does not have
- *                      any failure modes.
+ * @return              Returns the pointer that you pass it, or NULL if
+ *                      ptr is or contains a thread-safe context and new_ctx
+ *                      has a memory limit.
  *
  * @note It is possible to produce loops in the parent/child relationship
  * if you are not careful with talloc_steal(). No guarantees are provided
@@ -360,6 +361,79 @@ void _talloc_set_destructor(const void *ptr, int (*_destructor)(void *));
 void *_talloc_steal_loc(const void *new_ctx, const void *ptr, const char *location);
 #endif /* DOXYGEN */
 
+#ifdef DOXYGEN
+/**
+ * @brief Assign a destructor that runs later, from talloc_run_deferred().
+ *
+ * This works like talloc_set_destructor(), except that freeing the chunk
+ * does not run the destructor right away. Instead, talloc_free() takes the
+ * chunk and its children out of the tree, and out of the memory limit they
+ * were under, and puts it on a queue. The destructor only runs, and the
+ * memory of the chunk and its children is only released, when
+ * talloc_run_deferred() is called. This moves the teardown of large trees
+ * whose destructors close descriptors or sockets off the path that freed
+ * them.
+ *
+ * When the destructor runs, the chunk no longer has a parent. If it
+ * returns -1, the chunk is left without a parent, as it would be if it
+ * had been freed along with its parent. Calling talloc_set_destructor()
+ * on the chunk makes its destructor run right away again.
+ *
+ * @param[in]  ptr      The talloc chunk to add a destructor to.
+ *
+ * @param[in]  destructor  The destructor function to be called. NULL to remove
+ *                         it.
+ *
+ * @see talloc_set_destructor()
+ * @see talloc_run_deferred()
+ * @see talloc_set_deferred_executor()
+ */
+void talloc_set_deferred_destructor(const void *ptr, int (*destructor)(void *));
+#else
+#if (__GNUC__ >= 3)
+#define talloc_set_deferred_destructor(ptr, function)			      \
+	do {								      \
+		int (*_talloc_destructor_fn)(_TALLOC_TYPEOF(ptr)) = (function);	      \
+		_talloc_set_deferred_destructor((ptr), (int (*)(void *))_talloc_destructor_fn); \
+	} while(0)
+#else
+#define talloc_set_deferred_destructor(ptr, function) \
+	_talloc_set_deferred_destructor((ptr), (int (*)(void *))(function))
+#endif
+void _talloc_set_deferred_destructor(const void *ptr, int (*_destructor)(void *));
+#endif
+
+/**
+ * @brief Run the destructors of freed chunks with deferred destructors.
+ *
+ * This runs the destructors of all chunks queued by talloc_free() because
+ * of talloc_set_deferred_destructor(), and then frees them and their
+ * children. Deferred chunks below them are run by the same call.
+ *
+ * @return              The number of chunks freed.
+ *
+ * @see talloc_set_deferred_destructor()
+ */
+size_t talloc_run_deferred(void);
+
+/**
+ * @brief Get notified when deferred destructors are queued.
+ *
+ * The executor is called whenever talloc_free() queues a chunk on an empty
+ * queue of deferred destructors, from the thread that freed it. It is meant
+ * to arrange for talloc_run_deferred() to be called later, for example
+ * from an idle handler of the event loop. It must not call
+ * talloc_run_deferred() itself.
+ *
+ * @param[in]  executor The function to call, NULL for none.
+ *
+ * @param[in]  private_data The argument to pass to the executor.
+ *
+ * @see talloc_run_deferred()
+ */
+void talloc_set_deferred_executor(void (*executor)(void *private_data),
+				  void *private_data);
+
 /**
  * @brief Assign a name to a talloc chunk.
  *
@@ -644,6 +718,33 @@ void *talloc_parent(const void *ptr);
  */
 const char *talloc_parent_name(const void *ptr);
 
+/**
+ * @brief Let every child of a context point to it directly.
+ *
+ * Normally only the first child in the list of children of a context
+ * points to the context, and talloc_parent() of any other child walks
+ * back over its older siblings to find it. So talloc_parent(),
+ * talloc_parent_name(), talloc_is_parent(), talloc_unlink() and
+ * talloc_steal() of a child take time proportional to the number of
+ * children of its parent.
+ *
+ * After this call every child of ctx keeps a pointer to it, which
+ * makes all of these O(1) for children of ctx. This costs no memory,
+ * the pointer is part of every chunk already, but talloc_realloc() of
+ * ctx has to update all of its children when ctx moves. Use it for
+ * contexts with very many children, such as tables of connections.
+ *
+ * Contexts created with talloc_threadsafe_context() always have this
+ * enabled.
+ *
+ * @param[in]  ctx      The talloc context with many children.
+ *
+ * @return              0 on success, -1 on error.
+ *
+ * @see talloc_parent()
+ */
+int talloc_enable_parent_links(const void *ctx);
+
 /**
  * @brief Get the total size of a talloc chunk including its children.
  *
@@ -654,6 +755,9 @@ const char *talloc_parent_name(const void *ptr);
  * talloc_enable_leak_report() or talloc_enable_leak_report_full() has
  * been called.
  *
+ * This walks all children of ptr, unless talloc_enable_accounting() was
+ * called for ptr.
+ *
  * @param[in]  ptr      The talloc chunk.
  *
  * @return              The total size.
@@ -671,6 +775,9 @@ size_t talloc_total_size(const void *ptr);
  * talloc_enable_leak_report() or talloc_enable_leak_report_full() has
  * been called.
  *
+ * This walks all children of ptr, unless talloc_enable_accounting() was
+ * called for ptr.
+ *
  * @param[in]  ptr      The talloc chunk.
  *
  * @return              The total size.
@@ -772,6 +879,51 @@ void *talloc_get_type_abort(const void *ptr, #type);
 void *_talloc_get_type_abort(const void *ptr, const char *name, const char *location);
 #endif
 
+#ifdef DOXYGEN
+/**
+ * @brief Register a type name for fast type checks.
+ *
+ * talloc_get_type() and talloc_get_type_abort() compare the name of a chunk
+ * with the name of the type by pointer first, which only works as long as
+ * both come from the same string literal. Names from a different library or
+ * module take a strcmp(). Registering the type in every module that uses it
+ * lets the checks compare registered names by a type id instead.
+ *
+ * The name is not copied, it has to stay valid for the rest of the process.
+ * Don't register names from a module that may be unloaded.
+ *
+ * @param[in]  type     The type to register.
+ *
+ * @return              0 on success, -1 on error with errno set.
+ *
+ * Example:
+ * @code
+ *      static int foo_module_init(void)
+ *      {
+ *              return talloc_register_type(struct foo);
+ *      }
+ * @endcode
+ *
+ * @see talloc_register_type_name()
+ */
+int talloc_register_type(#type);
+#else
+#define talloc_register_type(type) talloc_register_type_name(#type)
+#endif
+
+/**
+ * @brief Register a type name for fast type checks.
+ *
+ * This is talloc_register_type() for a name given as a string.
+ *
+ * @param[in]  name     The name to register, as used in talloc_set_name_const().
+ *
+ * @return              0 on success, -1 on error with errno set.
+ *
+ * @see talloc_register_type()
+ */
+int talloc_register_type_name(const char *name);
+
 /**
  * @brief Find a parent context by name.
  *
@@ -891,6 +1043,320 @@ void *_talloc_pooled_object(const void *ctx,
 			    size_t total_subobjects_size);
 #endif
 
+/**
+ * @brief Allocate a talloc pool that grows on demand.
+ *
+ * A talloc_pool() that runs out of space silently falls back to malloc(3)
+ * for every further child, so a pool that is only slightly too small loses
+ * most of its benefit. A growable pool instead chains an additional slab of
+ * memory when it is full and keeps serving children from the pool. Every
+ * new slab is twice the size of the previous one, until the pool as a whole
+ * reaches max_size. Only then children fall back to malloc(3).
+ *
+ * Apart from that a growable pool behaves exactly like a talloc_pool(). All
+ * slabs are released together with the pool, and a child moved out of the
+ * pool keeps the memory of its slab alive until it is freed itself.
+ *
+ * @param[in]  context  The talloc context to hang the result off.
+ *
+ * @param[in]  size     Size of the first slab of the pool.
+ *
+ * @param[in]  max_size The maximum total size of all slabs, 0 for no limit.
+ *
+ * @return              The allocated talloc pool, NULL on error.
+ *
+ * @see talloc_pool()
+ * @see talloc_pool_stats()
+ */
+void *talloc_growable_pool(const void *context, size_t size, size_t max_size);
+
+/**
+ * @brief Allocate a talloc arena.
+ *
+ * An arena is a growable pool, see talloc_growable_pool(), for scopes where
+ * everything dies together, like the processing of a single request. Its
+ * direct children are carved off the arena memory with a simple pointer
+ * increment, and are not even put into the list of children of the arena.
+ * They are released all at once when the arena is freed.
+ *
+ * A child is put into the list of children only once it needs to be: when
+ * it gets a destructor, a reference, a child of its own or a memory limit,
+ * or when it is moved to another parent or reallocated. So destructors and
+ * references work as usual, and a child moved out of the arena stays valid.
+ *
+ * As the unlinked children are not in the list, they are not seen by
+ * talloc_total_size(), talloc_total_blocks() and the talloc_report()
+ * functions. talloc_free_children() on the arena releases them as well.
+ *
+ * @param[in]  context  The talloc context to hang the result off.
+ *
+ * @param[in]  size     Size of the first slab of the arena.
+ *
+ * @return              The allocated talloc arena, NULL on error.
+ *
+ * @see talloc_growable_pool()
+ */
+void *talloc_arena(const void *context, size_t size);
+
+/**
+ * @brief Statistics about a talloc pool, see talloc_pool_stats().
+ */
+struct talloc_pool_stats {
+	/** The number of slabs, including the initial pool memory. */
+	size_t num_slabs;
+	/** The total size of all slabs. */
+	size_t size;
+	/** The bytes taken by children, including freed holes. */
+	size_t used;
+	/** The bytes left unused at the end of slabs that are full. */
+	size_t wasted;
+	/** The number of children that had to fall back to malloc(3). */
+	size_t fallbacks;
+	/** The number of children that took the place of freed ones. */
+	size_t reused;
+};
+
+/**
+ * @brief Get statistics about a talloc pool.
+ *
+ * This works for pools created with talloc_pool(), talloc_pooled_object()
+ * and talloc_growable_pool(). Only growable pools have more than one slab
+ * and count their fallbacks to malloc(3).
+ *
+ * @param[in]  pool     The talloc pool to inspect.
+ *
+ * @param[out] stats    The statistics of the pool.
+ *
+ * @return              0 on success, -1 if pool is not a talloc pool.
+ *
+ * @see talloc_growable_pool()
+ */
+int talloc_pool_stats(const void *pool, struct talloc_pool_stats *stats);
+
+/**
+ * @brief Reuse the memory of freed children inside a talloc pool.
+ *
+ * Normally the memory of a child of a talloc pool is only reused if it was
+ * the last one allocated from the pool, or once all children are gone. A
+ * long-lived pool with many short-lived children therefore runs full and
+ * falls back to malloc(3) even though most of its memory is unused.
+ *
+ * After this call a pool keeps freed children in lists of their size, and
+ * a new child of exactly the same size takes the place of a freed one. This
+ * works for children of up to 1024 bytes including the talloc header.
+ *
+ * @param[in]  pool     The talloc pool, as returned by talloc_pool(),
+ *                      talloc_pooled_object() or talloc_growable_pool().
+ *
+ * @return              0 on success, -1 on error.
+ *
+ * @see talloc_pool_stats()
+ */
+int talloc_pool_enable_reuse(const void *pool);
+
+/**
+ * @brief Enable the per-thread cache of small chunks.
+ *
+ * Request/response style code tends to allocate and free large numbers of
+ * small chunks. With the chunk cache enabled, small chunks are not given
+ * back to free(3) when they are released. Instead every thread keeps them
+ * on a private free list for their size class, and the next allocation of
+ * the same size class in the same thread reuses them without calling
+ * malloc(3).
+ *
+ * Chunks allocated from a talloc_pool() are not affected. The cache of a
+ * thread is flushed when the thread exits.
+ *
+ * Calling this function again changes the depth of the cache. A depth of 0
+ * is equivalent to talloc_disable_chunk_cache(): caching stops and the
+ * chunks cached by the calling thread are given back to free(3), while
+ * the chunks cached by other threads are only released when those
+ * threads exit.
+ *
+ * @param[in]  depth    The maximum number of chunks each thread keeps per
+ *                      size class.
+ *
+ * @return              0 on success, -1 if the chunk cache is not available
+ *                      on this platform.
+ *
+ * @see talloc_disable_chunk_cache()
+ */
+int talloc_enable_chunk_cache(unsigned int depth);
+
+/**
+ * @brief Disable the per-thread cache of small chunks.
+ *
+ * This stops caching and gives the chunks cached by the calling thread back
+ * to free(3). Chunks cached by other threads are released when those
+ * threads exit.
+ *
+ * @see talloc_enable_chunk_cache()
+ */
+void talloc_disable_chunk_cache(void);
+
+/**
+ * @brief Put large chunks into memory mappings of their own.
+ *
+ * Growing a large buffer with talloc_realloc() usually means copying it
+ * every time realloc(3) cannot extend it in place. With a threshold set,
+ * every chunk of at least that many bytes that is not allocated from a
+ * talloc_pool() is placed in an anonymous memory mapping instead, and
+ * talloc_realloc() resizes it with mremap(2), which moves pages rather than
+ * copying the contents. A chunk that grows beyond the threshold with
+ * talloc_realloc() is moved into a mapping once.
+ *
+ * Thresholds below the page size are raised to the page size. Chunks
+ * already in a mapping stay there when the threshold is changed.
+ *
+ * @param[in]  threshold The size from which chunks get a mapping, 0 to
+ *                       turn this off, which is the default.
+ *
+ * @return              0 on success, -1 if memory mappings are not available
+ *                      on this platform.
+ */
+int talloc_set_mmap_threshold(size_t threshold);
+
+/**
+ * @brief Back large pools with transparent hugepages.
+ *
+ * The memory of a talloc_pool() comes from malloc(3) and is mapped with
+ * normal pages, so walking a large pooled object graph takes a TLB miss
+ * every few kilobytes. With a threshold set, every pool of at least that
+ * size, including those of talloc_pooled_object() and the slabs of growable
+ * pools, is placed in an anonymous mapping aligned to a hugepage and
+ * advised with MADV_HUGEPAGE, so that the kernel can back it with
+ * transparent hugepages. The mapping is rounded up to whole hugepages,
+ * the part beyond the pool is never touched.
+ *
+ * Whether hugepages are actually used depends on the transparent hugepage
+ * settings of the system, the pools work the same either way. Thresholds
+ * below the hugepage size are raised to it. Pools that already exist are
+ * not affected when the threshold is changed.
+ *
+ * @param[in]  threshold The pool size from which pools get hugepages, 0 to
+ *                       turn this off, which is the default.
+ *
+ * @return              0 on success, -1 if hugepage mappings are not
+ *                      available on this platform.
+ *
+ * @see talloc_pool()
+ */
+int talloc_set_pool_hugepage_threshold(size_t threshold);
+
+/**
+ * @brief An allocation site seen by the sampling profiler.
+ *
+ * @see talloc_sample_report()
+ */
+struct talloc_sample {
+	/** The name of the allocations, usually their location in the source. */
+	const char *location;
+	/** The number of allocations sampled. */
+	size_t samples;
+	/** The estimated number of allocations. */
+	size_t count;
+	/** The estimated number of bytes allocated. */
+	size_t bytes;
+};
+
+/**
+ * @brief Start sampling allocations per allocation site.
+ *
+ * The sampling profiler finds the places that allocate most, with an
+ * overhead low enough for production use. On average one byte out of every
+ * interval bytes allocated is sampled, at random points, and the allocation
+ * containing it is recorded together with its name. That name is the
+ * location in the source for talloc_size(), talloc_new(), talloc_zero_size()
+ * and the like, or the type for talloc(), talloc_array() and the like.
+ * Allocations named after their contents, like the strings of
+ * talloc_strdup() and talloc_asprintf(), are not sampled. A
+ * talloc_realloc() counts as an allocation of the new size.
+ *
+ * The samples are kept until talloc_sample_reset() is called, calling this
+ * function again only changes the interval.
+ *
+ * @param[in]  interval The average number of bytes between two samples.
+ *
+ * @see talloc_sample_report()
+ */
+void talloc_enable_sampling(size_t interval);
+
+/**
+ * @brief Stop sampling allocations.
+ *
+ * The samples taken so far are kept.
+ *
+ * @see talloc_enable_sampling()
+ */
+void talloc_disable_sampling(void);
+
+/**
+ * @brief Get the allocation sites seen by the sampling profiler.
+ *
+ * The counts and sizes are scaled up from the samples, so they estimate the
+ * real numbers of allocations and bytes since sampling was enabled or last
+ * reset. Sites are ordered by bytes, the site allocating most comes first.
+ *
+ * @param[out] samples  The array to fill in, may be NULL if num_samples
+ *                      is 0.
+ *
+ * @param[in]  num_samples The number of elements of samples.
+ *
+ * @return              The number of sites seen, which may be more than
+ *                      num_samples.
+ *
+ * @see talloc_enable_sampling()
+ */
+size_t talloc_sample_report(struct talloc_sample *samples, size_t num_samples);
+
+/**
+ * @brief Throw away the samples taken so far.
+ *
+ * @see talloc_enable_sampling()
+ */
+void talloc_sample_reset(void);
+
+/**
+ * @brief Create a context that several threads can allocate children of.
+ *
+ * talloc itself is not thread-safe, a talloc hierarchy normally belongs
+ * to a single thread. A thread-safe context is the exception: its list of
+ * children is protected by a mutex of its own, so several threads can
+ * allocate, free, reallocate and steal direct children of it at the same
+ * time. There is no global lock, threads using different thread-safe
+ * contexts never wait for each other.
+ *
+ * Only the list of direct children is protected. A child of the context,
+ * and everything below it, must still be used by one thread at a time.
+ *
+ * Everything that walks all children of the context, like talloc_free()
+ * or talloc_free_children() of the context itself, talloc_total_size()
+ * and talloc_report(), must only be called while no other thread uses the
+ * context. A thread-safe context can't be reallocated and can't be placed
+ * under a memory limit: talloc_set_memlimit() and talloc_enable_accounting()
+ * fail above it, and talloc_steal() into a context with a memory limit
+ * returns NULL.
+ *
+ * @code
+ *      void *ctx = talloc_threadsafe_context(NULL);
+ *
+ *      // in each worker thread
+ *      struct request *req = talloc_zero(ctx, struct request);
+ *      ...
+ *      talloc_free(req);
+ * @endcode
+ *
+ * @param[in]  context  The parent context of the thread-safe context.
+ *
+ * @return              The thread-safe context, NULL on error. errno is
+ *                      set to ENOSYS if threads are not supported on this
+ *                      platform and to EINVAL if context has a memory
+ *                      limit.
+ *
+ * @see talloc_set_memlimit()
+ */
+void *talloc_threadsafe_context(const void *context);
+
 /**
  * @brief Free a talloc chunk and NULL out the pointer.
  *
@@ -1238,6 +1704,57 @@ void *_talloc_zero_array(const void *ctx,
 			 const char *name);
 #endif
 
+#ifdef DOXYGEN
+/**
+ * @brief Allocate a number of sibling chunks at once.
+ *
+ * This allocates count chunks of the given type as children of ctx, each
+ * of them a talloc chunk of its own that can be freed, stolen or given a
+ * destructor independently. Unlike calling talloc() count times, the chunks
+ * are carved out of a single block from malloc(3), which is released once
+ * the last of them is freed. The pointers to the chunks are returned in a
+ * talloc array, also a child of ctx and part of the same block, that can
+ * be freed as soon as it is no longer needed.
+ *
+ * The memory of the chunks is not initialized. Under a talloc_pool() or a
+ * thread-safe context, the chunks are allocated one by one as usual.
+ *
+ * @param[in]  ctx      The talloc context to hang the chunks off.
+ *
+ * @param[in]  type     The type of every chunk.
+ *
+ * @param[in]  count    The number of chunks to allocate.
+ *
+ * @return              An array of count pointers to the new chunks, NULL
+ *                      on error.
+ *
+ * Example:
+ * @code
+ *      struct foo **foos;
+ *
+ *      foos = talloc_array_of_chunks(mem_ctx, struct foo, num_foos);
+ *      if (foos == NULL) {
+ *              return ENOMEM;
+ *      }
+ *      for (i = 0; i < num_foos; i++) {
+ *              foos[i]->id = i;
+ *      }
+ *      talloc_free(foos);
+ * @endcode
+ *
+ * @see talloc_array()
+ * @see talloc_pooled_object()
+ */
+type **talloc_array_of_chunks(const void *ctx, #type, unsigned count);
+#else
+#define talloc_array_of_chunks(ctx, type, count) \
+	(type **)_talloc_array_of_chunks(ctx, sizeof(type), count, #type)
+void *_talloc_array_of_chunks(const void *ctx,
+			      size_t el_size,
+			      unsigned count,
+			      const char *name);
+#endif
+
 #ifdef DOXYGEN
 /**
  * @brief Change the size of a talloc array.
@@ -1642,6 +2159,86 @@ char *talloc_asprintf_append(char *s, const char *fmt, ...) PRINTF_ATTRIBUTE(2,3
  */
 char *talloc_asprintf_append_buffer(char *s, const char *fmt, ...) PRINTF_ATTRIBUTE(2,3);
 
+/**
+ * @brief Create an empty string builder.
+ *
+ * A string builder is a talloc'ed string with spare capacity. The
+ * talloc_*_append_buffer() functions (and the talloc_*_append()
+ * functions) grow it geometrically instead of reallocating it to the
+ * exact new length on every call, so building a long string out of
+ * many small pieces takes amortized linear time.
+ *
+ * While it is a string builder talloc_get_size() returns the capacity
+ * of the string. Use talloc_strbuf_finish() to shrink it to fit when
+ * it is complete. talloc_realloc() turns it into a plain talloc'ed
+ * buffer of the new size, and the talloc_*_append_buffer() functions
+ * then append at the end of that buffer.
+ *
+ * @code
+ *      char *s = talloc_strbuf_new(mem_ctx, 0);
+ *      int i;
+ *
+ *      for (i = 0; i < 1000; i++) {
+ *              s = talloc_asprintf_append_buffer(s, "%d,", i);
+ *      }
+ *      s = talloc_strbuf_finish(s);
+ * @endcode
+ *
+ * @param[in]  ctx      The talloc context to hang the result off.
+ *
+ * @param[in]  capacity The number of characters to reserve room for.
+ *
+ * @return              The empty string builder, NULL on error.
+ *
+ * @see talloc_strbuf()
+ * @see talloc_strbuf_finish()
+ */
+char *talloc_strbuf_new(const void *ctx, size_t capacity);
+
+/**
+ * @brief Turn a talloc'ed string into a string builder.
+ *
+ * The string is taken to end at the end of the talloc'ed buffer, as
+ * for talloc_strdup_append_buffer(). Calling this on a string builder
+ * does nothing.
+ *
+ * @param[in]  s        The string to turn into a string builder.
+ *
+ * @return              The string builder, which may have moved, NULL
+ *                      on error.
+ *
+ * @see talloc_strbuf_new()
+ */
+char *talloc_strbuf(char *s);
+
+/**
+ * @brief Get the length of the string held by a string builder.
+ *
+ * For a plain string this is talloc_get_size() - 1.
+ *
+ * @param[in]  s        The string builder.
+ *
+ * @return              The length of the string, without the trailing
+ *                      '\0'.
+ */
+size_t talloc_strbuf_len(const char *s);
+
+/**
+ * @brief Shrink a string builder to fit.
+ *
+ * Afterwards the result is a plain talloc'ed string with
+ * talloc_get_size() equal to its length plus one. Calling this on a
+ * plain string does nothing.
+ *
+ * @param[in]  s        The string builder.
+ *
+ * @return              The plain string, which may have moved, NULL on
+ *                      error.
+ *
+ * @see talloc_strbuf_new()
+ */
+char *talloc_strbuf_finish(char *s);
+
 /* @} ******************************************************************/
 
 /**
@@ -1687,6 +2284,80 @@ void talloc_report_depth_cb(const void *ptr, int depth, int max_depth,
 					     void *private_data),
 			    void *private_data);
 
+struct talloc_report_cursor;
+
+/**
+ * @brief Start walking a talloc hierarchy in batches.
+ *
+ * This is talloc_report_depth_cb() split up into several calls to
+ * talloc_report_cursor_next(), each reporting a bounded number of
+ * chunks. It lets a long report on a huge hierarchy be interleaved
+ * with other work, for example by only holding a lock for one batch
+ * at a time.
+ *
+ * Between the batches the hierarchy may change in any way. When the
+ * chunk the cursor stands on, or one of its parents, is freed or
+ * stolen, the walk goes on after that subtree as if it had already been
+ * reported, and freeing ptr ends the walk. Chunks added in the part of
+ * the hierarchy already walked are not reported. Freeing ptr, or a
+ * context above it, always takes the slow path for its children once a
+ * cursor has been started on it.
+ *
+ * @code
+ *      struct talloc_report_cursor *cursor;
+ *
+ *      cursor = talloc_report_cursor(mem_ctx, ptr, 0, -1);
+ *      do {
+ *              lock();
+ *              n = talloc_report_cursor_next(cursor, 1000, cb, state);
+ *              unlock();
+ *      } while (n > 0);
+ *      talloc_free(cursor);
+ * @endcode
+ *
+ * @param[in]  ctx      The talloc context to hang the cursor off.
+ *
+ * @param[in]  ptr      The talloc chunk to report on, NULL for the
+ *                      null context as in talloc_report_depth_cb().
+ *
+ * @param[in]  depth    The depth passed to the callback for ptr.
+ *
+ * @param[in]  max_depth  Maximum recursion level, -1 for no limit.
+ *
+ * @return              The cursor, NULL on error.
+ *
+ * @see talloc_report_cursor_next()
+ */
+struct talloc_report_cursor *talloc_report_cursor(const void *ctx,
+						  const void *ptr,
+						  int depth,
+						  int max_depth);
+
+/**
+ * @brief Walk the next batch of a talloc hierarchy.
+ *
+ * Calls the callback for up to max_chunks more chunks, exactly as
+ * talloc_report_depth_cb() would have for them.
+ *
+ * @param[in]  cursor   The cursor from talloc_report_cursor().
+ *
+ * @param[in]  max_chunks  The maximum number of chunks to report.
+ *
+ * @param[in]  callback  Function to be called on every chunk.
+ *
+ * @param[in]  private_data  Private pointer passed to callback.
+ *
+ * @return              The number of chunks reported, 0 once the
+ *                      whole hierarchy has been walked.
+ */
+size_t talloc_report_cursor_next(struct talloc_report_cursor *cursor,
+				 size_t max_chunks,
+				 void (*callback)(const void *ptr,
+						  int depth, int max_depth,
+						  int is_ref,
+						  void *private_data),
+				 void *private_data);
+
 /**
  * @brief Print a talloc hierarchy.
  *
@@ -1761,6 +2432,33 @@ void talloc_report_full(const void *ptr, FILE *f);
  */
 void talloc_report(const void *ptr, FILE *f);
 
+/**
+ * @brief Write a binary snapshot of the memory used by ptr.
+ *
+ * This covers the same chunks as talloc_report_full(), but writes a
+ * compact binary record for each of them instead of a line of text,
+ * which is much faster to produce and to load for big hierarchies.
+ * Every chunk record holds the address of the chunk and of its parent,
+ * its name, its size, whether it is a pool, was allocated from a pool,
+ * has a destructor or a memory limit, and the number of references to
+ * it. Each name is only written once.
+ *
+ * The format is described in talloc.c. The talloc_snapshot.py script
+ * in the talloc sources, installed as talloc_snapshot with the
+ * standalone library, lists the names using the most memory, the
+ * largest subtrees and the difference between two snapshots.
+ *
+ * @param[in]  ptr      The talloc chunk, NULL for the null context as in
+ *                      talloc_report_full().
+ *
+ * @param[in]  f        The file to write to.
+ *
+ * @return              0 on success, -1 on error.
+ *
+ * @see talloc_report_full()
+ */
+int talloc_report_binary(const void *ptr, FILE *f);
+
 /**
  * @brief Enable tracking the use of NULL memory contexts.
  *
@@ -1906,12 +2604,41 @@ void talloc_set_log_stderr(void);
  *	  updates memory usage but does *not* cause failure if the
  *	  move causes the new parent to exceed its limits. However
  *	  any further allocation on that hierarchy will then fail.
+ *	  A limit can't be set above a thread-safe context.
  *
  * @param[in]	ctx		The talloc context to set the limit on
  * @param[in]	max_size	The (new) max_size
+ *
+ * @return	0 on success, 1 on error.
+ *
+ * @see talloc_threadsafe_context()
  */
 int talloc_set_memlimit(const void *ctx, size_t max_size);
 
+/**
+ * @brief Keep running totals of the memory below a context.
+ *
+ * Normally talloc_total_size() and talloc_total_blocks() walk the whole
+ * hierarchy below a context on every call. With accounting enabled the
+ * context carries counters of both, which are updated whenever a chunk
+ * below it is allocated, freed, reallocated or stolen, so both functions
+ * return without walking its children.
+ *
+ * Accounting is done by the same data as talloc_set_memlimit(), enabling
+ * it is equivalent to setting a memory limit of 0 (unlimited), and a
+ * context with a memory limit has accounting enabled as well. Like memory
+ * limits, the counters of nested contexts are updated together, so every
+ * allocation below an accounted context costs a little more.
+ *
+ * @param[in]	ctx		The talloc context to keep totals for.
+ *
+ * @return			0 on success, 1 on error.
+ *
+ * @see talloc_total_size()
+ * @see talloc_set_memlimit()
+ */
+int talloc_enable_accounting(const void *ctx);
+
 /* @} ******************************************************************/
 
 #if TALLOC_DEPRECATED
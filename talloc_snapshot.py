@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# Analyze the binary snapshots written by talloc_report_binary().
+
+"""Analyze talloc_report_binary() snapshots.
+
+    talloc_snapshot.py top [-n N] SNAPSHOT
+        the names using the most memory
+
+    talloc_snapshot.py subtrees [-n N] SNAPSHOT
+        the chunks with the largest talloc_total_size()
+
+    talloc_snapshot.py diff [-n N] OLD NEW
+        the names whose memory use changed the most between two snapshots
+
+The format of the snapshots is described in talloc.c.
+"""
+
+import heapq
+import mmap
+import optparse
+import struct
+import sys
+from array import array
+
+MAGIC = b'TALLOCSN'
+VERSION = 1
+
+RECORD_NAME = 1
+RECORD_CHUNK = 2
+RECORD_REF = 3
+
+FLAG_POOL = 0x01
+FLAG_POOLMEM = 0x02
+FLAG_DESTRUCTOR = 0x04
+FLAG_MEMLIMIT = 0x08
+
+_file_header = struct.Struct('<8sII')
+_record_header = struct.Struct('<II')
+_name = struct.Struct('<Q')
+_chunk = struct.Struct('<QQQQII')
+_ref = struct.Struct('<QQQ')
+
+try:
+    array('Q')
+    _u64 = 'Q'
+except ValueError:
+    # Python 2, where 'L' is 64 bits wide on LP64 systems
+    _u64 = 'L'
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class Snapshot(object):
+    """A talloc_report_binary() snapshot.
+
+    The chunks are kept in columns in the order of the snapshot, parents
+    before their children: ids, parents, name_ids, sizes, flags and
+    refs. names maps name ids to names, references holds a tuple of
+    (id, parent, target) for every reference.
+    """
+
+    def __init__(self, data):
+        self.names = {}
+        self.ids = array(_u64)
+        self.parents = array(_u64)
+        self.name_ids = array(_u64)
+        self.sizes = array(_u64)
+        self.flags = array('I')
+        self.refs = array('I')
+        self.references = []
+        self._parse(data)
+
+    @classmethod
+    def load(cls, path):
+        f = open(path, 'rb')
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return cls(data)
+            finally:
+                data.close()
+        finally:
+            f.close()
+
+    def _parse(self, data):
+        if len(data) < _file_header.size:
+            raise SnapshotError('snapshot too short')
+        magic, version, _ = _file_header.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise SnapshotError('not a talloc snapshot')
+        if version != VERSION:
+            raise SnapshotError('unsupported snapshot version %d' % version)
+
+        names = self.names
+        add_id = self.ids.append
+        add_parent = self.parents.append
+        add_name_id = self.name_ids.append
+        add_size = self.sizes.append
+        add_flags = self.flags.append
+        add_refs = self.refs.append
+        unpack_header = _record_header.unpack_from
+        unpack_chunk = _chunk.unpack_from
+
+        end = len(data)
+        ofs = _file_header.size
+        while ofs < end:
+            if ofs + _record_header.size > end:
+                raise SnapshotError('truncated record at %d' % ofs)
+            rtype, length = unpack_header(data, ofs)
+            ofs += _record_header.size
+            if ofs + length > end:
+                raise SnapshotError('truncated record at %d' % ofs)
+            if rtype == RECORD_CHUNK:
+                (id, parent, name_id, size,
+                 flags, refs) = unpack_chunk(data, ofs)
+                add_id(id)
+                add_parent(parent)
+                add_name_id(name_id)
+                add_size(size)
+                add_flags(flags)
+                add_refs(refs)
+            elif rtype == RECORD_NAME:
+                name_id, = _name.unpack_from(data, ofs)
+                name = data[ofs + _name.size:ofs + length]
+                names[name_id] = name.decode('utf-8', 'replace')
+            elif rtype == RECORD_REF:
+                self.references.append(_ref.unpack_from(data, ofs))
+            ofs += length
+
+    def __len__(self):
+        return len(self.ids)
+
+    def name(self, i):
+        """The name of the i-th chunk."""
+        return self.names.get(self.name_ids[i], '?')
+
+    def total_size(self):
+        return sum(self.sizes)
+
+    def by_name(self):
+        """Map every name to a list of [bytes, blocks]."""
+        ret = {}
+        names = self.names
+        for name_id, size in zip(self.name_ids, self.sizes):
+            name = names.get(name_id, '?')
+            entry = ret.get(name)
+            if entry is None:
+                ret[name] = [size, 1]
+            else:
+                entry[0] += size
+                entry[1] += 1
+        return ret
+
+    def subtree_sizes(self):
+        """The talloc_total_size() of every chunk, in snapshot order."""
+        index = dict((id, i) for i, id in enumerate(self.ids))
+        totals = array(_u64, self.sizes)
+        parents = self.parents
+        for i in range(len(totals) - 1, 0, -1):
+            p = index.get(parents[i])
+            if p is not None:
+                totals[p] += totals[i]
+        return totals
+
+
+def top_names(snapshot, n):
+    """The n names using the most memory, as (bytes, blocks, name)."""
+    return heapq.nlargest(n, ((b, c, name) for name, (b, c)
+                              in snapshot.by_name().items()))
+
+
+def largest_subtrees(snapshot, n):
+    """The n chunks with the most memory below them, as
+    (total bytes, id, name)."""
+    totals = snapshot.subtree_sizes()
+    best = heapq.nlargest(n, range(len(totals)), key=totals.__getitem__)
+    return [(totals[i], snapshot.ids[i], snapshot.name(i)) for i in best]
+
+
+def diff_names(old, new, n):
+    """The n names whose memory use changed most between two snapshots,
+    as (bytes difference, blocks difference, name)."""
+    old_names = old.by_name()
+    new_names = new.by_name()
+    changes = []
+    for name in set(old_names) | set(new_names):
+        ob, oc = old_names.get(name, (0, 0))
+        nb, nc = new_names.get(name, (0, 0))
+        if ob != nb or oc != nc:
+            changes.append((nb - ob, nc - oc, name))
+    return heapq.nlargest(n, changes, key=lambda c: (abs(c[0]), abs(c[1])))
+
+
+def main(argv):
+    parser = optparse.OptionParser(
+        usage='%prog top|subtrees [-n N] SNAPSHOT\n'
+              '       %prog diff [-n N] OLD NEW',
+        description='Analyze talloc_report_binary() snapshots.')
+    parser.add_option('-n', type='int', default=20,
+                      help='number of lines to show [20]')
+    opts, args = parser.parse_args(argv[1:])
+
+    if len(args) == 2 and args[0] == 'top':
+        s = Snapshot.load(args[1])
+        print('%d bytes in %d blocks' % (s.total_size(), len(s)))
+        for b, c, name in top_names(s, opts.n):
+            print('%12d bytes %9d blocks  %s' % (b, c, name))
+    elif len(args) == 2 and args[0] == 'subtrees':
+        s = Snapshot.load(args[1])
+        for b, id, name in largest_subtrees(s, opts.n):
+            print('%12d bytes  0x%x  %s' % (b, id, name))
+    elif len(args) == 3 and args[0] == 'diff':
+        old = Snapshot.load(args[1])
+        new = Snapshot.load(args[2])
+        print('%+d bytes %+d blocks' % (new.total_size() - old.total_size(),
+                                        len(new) - len(old)))
+        for b, c, name in diff_names(old, new, opts.n):
+            print('%+12d bytes %+9d blocks  %s' % (b, c, name))
+    else:
+        parser.print_usage(sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -76,6 +76,215 @@ static PyObject *testpytalloc_base_reference(PyObject *mod, PyObject *args) {
 	return pytalloc_reference_ex(pytalloc_GetBaseObjectType(), mem_ctx, mem_ctx);
 }
 
+static PyObject *testpytalloc_base_new_direct(PyTypeObject *mod)
+{
+	char *obj = talloc_strdup(NULL, "This is a test string for a BaseObject");
+	return pytalloc_steal_direct(pytalloc_GetBaseObjectType(), obj);
+}
+
+static PyObject *testpytalloc_base_reference_direct(PyObject *mod, PyObject *args) {
+	PyObject *source = NULL;
+	void *mem_ctx;
+
+	if (!PyArg_ParseTuple(args, "O!", pytalloc_GetBaseObjectType(), &source)) {
+		return NULL;
+	}
+	mem_ctx = pytalloc_get_mem_ctx(source);
+	return pytalloc_reference_direct(pytalloc_GetBaseObjectType(), mem_ctx);
+}
+
+static int *testpytalloc_int_array(TALLOC_CTX *mem_ctx, Py_ssize_t count)
+{
+	int *array = talloc_array(mem_ctx, int, count);
+	Py_ssize_t i;
+
+	if (array == NULL) {
+		return NULL;
+	}
+	for (i = 0; i < count; i++) {
+		array[i] = i;
+	}
+	return array;
+}
+
+static PyObject *testpytalloc_array_new(PyObject *mod, PyObject *args)
+{
+	TALLOC_CTX *tmp_ctx;
+	PyObject *ret;
+	Py_ssize_t count;
+	int *array;
+	int buffer = 0;
+
+	if (!PyArg_ParseTuple(args, "n|i", &count, &buffer)) {
+		return NULL;
+	}
+
+	/* the sequence has to keep the array alive on its own */
+	tmp_ctx = talloc_new(NULL);
+	array = testpytalloc_int_array(tmp_ctx, count);
+	if (array == NULL) {
+		talloc_free(tmp_ctx);
+		return PyErr_NoMemory();
+	}
+	ret = pytalloc_Array_reference(buffer ? pytalloc_GetBufferObjectType() :
+					 pytalloc_GetBaseObjectType(),
+				       array);
+	talloc_free(tmp_ctx);
+	return ret;
+}
+
+static PyObject *testpytalloc_array_reference_each(PyObject *mod, PyObject *args)
+{
+	TALLOC_CTX *tmp_ctx;
+	PyObject *ret;
+	Py_ssize_t count, i;
+	int *array;
+
+	if (!PyArg_ParseTuple(args, "n", &count)) {
+		return NULL;
+	}
+
+	tmp_ctx = talloc_new(NULL);
+	array = testpytalloc_int_array(tmp_ctx, count);
+	ret = PyList_New(count);
+	if (array == NULL || ret == NULL) {
+		talloc_free(tmp_ctx);
+		Py_XDECREF(ret);
+		return PyErr_NoMemory();
+	}
+	for (i = 0; i < count; i++) {
+		PyObject *item = pytalloc_reference_ex(
+			pytalloc_GetBaseObjectType(), array, &array[i]);
+		if (item == NULL) {
+			talloc_free(tmp_ctx);
+			Py_DECREF(ret);
+			return NULL;
+		}
+		PyList_SET_ITEM(ret, i, item);
+	}
+	talloc_free(tmp_ctx);
+	return ret;
+}
+
+static PyObject *testpytalloc_base_get_int(PyObject *mod, PyObject *args)
+{
+	PyObject *source = NULL;
+
+	if (!PyArg_ParseTuple(args, "O!", pytalloc_GetBaseObjectType(), &source)) {
+		return NULL;
+	}
+	return PyLong_FromLong(*(int *)pytalloc_get_ptr(source));
+}
+
+static PyObject *testpytalloc_base_blob_new(PyObject *mod, PyObject *args)
+{
+	const char *data;
+	int len, writable = 0;
+	PyObject *ret;
+	char *blob;
+
+#if PY_MAJOR_VERSION >= 3
+	if (!PyArg_ParseTuple(args, "y#|i", &data, &len, &writable)) {
+#else
+	if (!PyArg_ParseTuple(args, "s#|i", &data, &len, &writable)) {
+#endif
+		return NULL;
+	}
+
+	blob = talloc_memdup(NULL, data, len);
+	if (blob == NULL) {
+		return PyErr_NoMemory();
+	}
+	ret = pytalloc_steal(pytalloc_GetBufferObjectType(), blob);
+	if (ret != NULL &&
+	    pytalloc_BaseObject_set_buffer_writable(ret, writable) != 0) {
+		Py_CLEAR(ret);
+	}
+	return ret;
+}
+
+static PyObject *testpytalloc_base_new_int(PyObject *mod)
+{
+	return pytalloc_new(int, pytalloc_GetBaseObjectType());
+}
+
+static PyObject *testpytalloc_pool_offset(PyObject *mod, PyObject *args)
+{
+	PyObject *source = NULL, *pool = NULL;
+
+	if (!PyArg_ParseTuple(args, "O!O!",
+			      pytalloc_GetBaseObjectType(), &source,
+			      pytalloc_GetBaseObjectType(), &pool)) {
+		return NULL;
+	}
+	return PyLong_FromSsize_t((char *)pytalloc_get_ptr(source) -
+				  (char *)pytalloc_get_ptr(pool));
+}
+
+static PyObject *testpytalloc_has_pool(PyObject *mod)
+{
+	return PyBool_FromLong(pytalloc_get_pool() != NULL);
+}
+
+static PyObject *testpytalloc_named_child(PyObject *mod, PyObject *args)
+{
+	PyObject *parent = NULL;
+	const char *name;
+	Py_ssize_t size;
+
+	if (!PyArg_ParseTuple(args, "O!sn", pytalloc_GetBaseObjectType(),
+			      &parent, &name, &size)) {
+		return NULL;
+	}
+	/* the child lives as long as the parent */
+	if (talloc_named(pytalloc_get_mem_ctx(parent), size,
+			 "%s", name) == NULL) {
+		return PyErr_NoMemory();
+	}
+	Py_RETURN_NONE;
+}
+
+static PyObject *testpytalloc_report_binary(PyObject *mod, PyObject *args)
+{
+	PyObject *source = NULL;
+	const char *path;
+	FILE *f;
+	int ret;
+
+	if (!PyArg_ParseTuple(args, "O!s", pytalloc_GetBaseObjectType(),
+			      &source, &path)) {
+		return NULL;
+	}
+	f = fopen(path, "wb");
+	if (f == NULL) {
+		return PyErr_SetFromErrnoWithFilename(PyExc_IOError, path);
+	}
+	ret = talloc_report_binary(pytalloc_get_mem_ctx(source), f);
+	if (fclose(f) != 0 || ret != 0) {
+		PyErr_SetString(PyExc_RuntimeError,
+				"talloc_report_binary failed");
+		return NULL;
+	}
+	Py_RETURN_NONE;
+}
+
+static PyObject *testpytalloc_tree_new(PyObject *mod)
+{
+	void *root = talloc_named_const(NULL, 0, "root");
+	void *a, *other;
+
+	a = talloc_named_const(root, 10, "a");
+	talloc_named_const(a, 20, "b");
+	talloc_named_const(root, 5, "c");
+	other = talloc_named_const(NULL, 7, "other");
+	talloc_reference(root, other);
+	talloc_reference(a, other);
+	talloc_unlink(NULL, other);
+	return pytalloc_steal(pytalloc_GetBaseObjectType(), root);
+}
+
+static PyObject *d_base_object_direct(PyObject *mod, PyObject *args);
+
 static PyMethodDef test_talloc_methods[] = {
 	{ "new", (PyCFunction)testpytalloc_new, METH_NOARGS,
 		"create a talloc Object with a testing string"},
@@ -89,6 +298,32 @@ static PyMethodDef test_talloc_methods[] = {
 		"call pytalloc_reference_ex"},
 	{ "base_reference", (PyCFunction)testpytalloc_base_reference, METH_VARARGS,
 		"call pytalloc_reference_ex"},
+	{ "base_new_direct", (PyCFunction)testpytalloc_base_new_direct, METH_NOARGS,
+		"create a talloc BaseObject with pytalloc_steal_direct"},
+	{ "base_reference_direct", (PyCFunction)testpytalloc_base_reference_direct, METH_VARARGS,
+		"call pytalloc_reference_direct"},
+	{ "DBaseObject_direct", (PyCFunction)d_base_object_direct, METH_VARARGS,
+		"create a DBaseObject (or a BufferObject) with pytalloc_steal_direct"},
+	{ "array_new", (PyCFunction)testpytalloc_array_new, METH_VARARGS,
+		"wrap a talloc array of ints with pytalloc_Array_reference"},
+	{ "array_reference_each", (PyCFunction)testpytalloc_array_reference_each, METH_VARARGS,
+		"wrap every element of a talloc array of ints with pytalloc_reference_ex"},
+	{ "base_get_int", (PyCFunction)testpytalloc_base_get_int, METH_VARARGS,
+		"get the int a BaseObject points to"},
+	{ "base_blob_new", (PyCFunction)testpytalloc_base_blob_new, METH_VARARGS,
+		"create a BufferObject with a copy of some bytes"},
+	{ "base_new_int", (PyCFunction)testpytalloc_base_new_int, METH_NOARGS,
+		"create a BaseObject for an int with pytalloc_new"},
+	{ "named_child", (PyCFunction)testpytalloc_named_child, METH_VARARGS,
+		"allocate a named chunk of some size below a BaseObject"},
+	{ "report_binary", (PyCFunction)testpytalloc_report_binary, METH_VARARGS,
+		"write a talloc_report_binary() snapshot of a BaseObject to a file"},
+	{ "pool_offset", (PyCFunction)testpytalloc_pool_offset, METH_VARARGS,
+		"get the offset of the pointer of a BaseObject from a talloc.Pool"},
+	{ "has_pool", (PyCFunction)testpytalloc_has_pool, METH_NOARGS,
+		"check whether a talloc.Pool is in use"},
+	{ "tree_new", (PyCFunction)testpytalloc_tree_new, METH_NOARGS,
+		"create a BaseObject for a small talloc tree"},
 	{ NULL }
 };
 
@@ -165,6 +400,27 @@ static PyObject *d_base_object_new(PyTypeObject *type, PyObject *args, PyObject
 	return pytalloc_steal(&DBaseObject_Type, obj);
 }
 
+static PyObject *d_base_object_direct(PyObject *mod, PyObject *args)
+{
+	PyObject *destructor_func = NULL;
+	PyObject **obj;
+	int buffer = 0;
+
+	if (!PyArg_ParseTuple(args, "O|i", &destructor_func, &buffer))
+		return NULL;
+	Py_INCREF(destructor_func);
+
+	obj = talloc(NULL, PyObject*);
+	*obj = destructor_func;
+
+	talloc_set_destructor((void*)obj, d_base_object_destructor);
+	if (buffer) {
+		return pytalloc_steal_direct(pytalloc_GetBufferObjectType(),
+					     obj);
+	}
+	return pytalloc_steal_direct(&DBaseObject_Type, obj);
+}
+
 static PyTypeObject DBaseObject_Type = {
 	.tp_name = "_test_pytalloc.DBaseObject",
 	.tp_methods = NULL,
@@ -5,8 +5,11 @@
 import unittest
 import subprocess
 import sys
+import os
 import re
 import gc
+import hashlib
+import threading
 
 import talloc
 import _test_pytalloc
@@ -37,6 +40,40 @@ class TallocTests(unittest.TestCase):
         # Two blocks: the string, and the name
         self.assertEqual(talloc.total_blocks(obj), 2)
 
+    def test_total_size(self):
+        obj = _test_pytalloc.base_new()
+        self.assertEqual(talloc.total_size(obj), 39)
+        obj = _test_pytalloc.tree_new()
+        self.assertEqual(talloc.total_size(obj), 42)
+        self.assertRaises(TypeError, talloc.total_size, 42)
+
+    def test_report(self):
+        obj = _test_pytalloc.base_new()
+        self.assertEqual(talloc.report(obj), [
+            (0, 'This is a test string for a BaseObject', 39, 1, 0)])
+
+        obj = _test_pytalloc.tree_new()
+        report = talloc.report(obj)
+        self.assertEqual(report, [
+            (0, 'root', 42, 6, 0),
+            (1, 'reference to: other', 0, 1, 0),
+            (1, 'c', 5, 1, 0),
+            (1, 'a', 37, 3, 0),
+            (2, 'other', 7, 1, 1),
+            (2, 'b', 20, 1, 0)])
+        self.assertEqual(report[0][2], talloc.total_size(obj))
+        self.assertEqual(report[0][3], talloc.total_blocks(obj))
+
+    def test_report_max_depth(self):
+        obj = _test_pytalloc.tree_new()
+        self.assertEqual(talloc.report(obj, 0), [(0, 'root', 42, 6, 0)])
+        self.assertEqual(talloc.report(obj, 1), [
+            (0, 'root', 42, 6, 0),
+            (1, 'reference to: other', 0, 1, 0),
+            (1, 'c', 5, 1, 0),
+            (1, 'a', 37, 3, 0)])
+        self.assertRaises(TypeError, talloc.report, talloc.Array)
+
     def test_repr(self):
         obj = _test_pytalloc.new()
         prefix = '<talloc.Object talloc object at'
@@ -67,6 +104,24 @@ class TallocTests(unittest.TestCase):
         gc.collect()
         self.assertEqual(lst, ['dead'])
 
+    def test_sampling(self):
+        talloc.sample_reset()
+        talloc.enable_sampling(1)
+        try:
+            objs = [_test_pytalloc.DObject(dummy_func) for i in range(10)]
+        finally:
+            talloc.disable_sampling()
+        report = talloc.sample_report()
+        self.assertTrue('PyObject*' in [r[0] for r in report])
+        for location, samples, count, nbytes in report:
+            self.assertTrue(isinstance(location, str))
+            self.assertTrue(samples > 0)
+            self.assertTrue(count >= samples)
+        self.assertEqual(sorted(report, key=lambda r: -r[3]), report)
+        talloc.sample_reset()
+        self.assertEqual(talloc.sample_report(), [])
+        self.assertRaises(ValueError, talloc.enable_sampling, 0)
+
 
 class TallocComparisonTests(unittest.TestCase):
 
@@ -183,6 +238,279 @@ class TallocUtilTests(unittest.TestCase):
         gc.collect()
         self.assertEqual(lst, ['dead'])
 
+    def test_base_direct_destructor(self):
+        lst = []
+        obj = _test_pytalloc.DBaseObject_direct(lambda: lst.append('dead'))
+        self.assertTrue(isinstance(obj, _test_pytalloc.DBaseObject))
+        self.assertEqual(lst, [])
+        del obj
+        gc.collect()
+        self.assertEqual(lst, ['dead'])
+
+    def test_base_direct_reference(self):
+        # the references from NULL and from wrapper contexts mix
+        for reference in (_test_pytalloc.base_reference_direct,
+                          _test_pytalloc.base_reference):
+            lst = []
+            obj = _test_pytalloc.DBaseObject_direct(lambda: lst.append('dead'))
+            ref1 = reference(obj)
+            ref2 = _test_pytalloc.base_reference_direct(obj)
+            del obj
+            gc.collect()
+            del ref2
+            gc.collect()
+            self.assertEqual(lst, [])
+            del ref1
+            gc.collect()
+            self.assertEqual(lst, ['dead'])
+
+
+class TallocArrayTests(unittest.TestCase):
+
+    def test_sequence(self):
+        arr = _test_pytalloc.array_new(5)
+        self.assertTrue(isinstance(arr, talloc.Array))
+        self.assertEqual(len(arr), 5)
+        self.assertTrue(repr(arr).startswith(
+            '<talloc.Array of 5 talloc.BaseObject at'))
+        self.assertEqual([_test_pytalloc.base_get_int(x) for x in arr],
+                         [0, 1, 2, 3, 4])
+        self.assertEqual(_test_pytalloc.base_get_int(arr[-1]), 4)
+        self.assertRaises(IndexError, lambda: arr[5])
+        self.assertRaises(IndexError, lambda: arr[-6])
+
+    def test_empty(self):
+        arr = _test_pytalloc.array_new(0)
+        self.assertEqual(len(arr), 0)
+        self.assertEqual(list(arr), [])
+
+    def test_items_outlive_array(self):
+        arr = _test_pytalloc.array_new(3)
+        item = arr[2]
+        self.assertTrue(isinstance(item, talloc.BaseObject))
+        self.assertEqual(item, arr[2])
+        del arr
+        gc.collect()
+        self.assertEqual(_test_pytalloc.base_get_int(item), 2)
+
+
+class TallocBufferTests(unittest.TestCase):
+
+    def test_read_only(self):
+        obj = _test_pytalloc.base_blob_new(b'some talloc bytes')
+        view = memoryview(obj)
+        self.assertTrue(view.readonly)
+        self.assertEqual(len(view), 17)
+        self.assertEqual(view.tobytes(), b'some talloc bytes')
+        self.assertEqual(hashlib.sha1(obj).hexdigest(),
+                         hashlib.sha1(b'some talloc bytes').hexdigest())
+
+        def assign():
+            view[0:1] = b'S'
+        self.assertRaises(TypeError, assign)
+
+    def test_writable(self):
+        obj = _test_pytalloc.base_blob_new(b'some talloc bytes', 1)
+        view = memoryview(obj)
+        self.assertFalse(view.readonly)
+        view[0:4] = b'more'
+        self.assertEqual(memoryview(obj).tobytes(), b'more talloc bytes')
+
+    def test_zero_copy(self):
+        obj = _test_pytalloc.base_blob_new(b'some talloc bytes', 1)
+        view1 = memoryview(obj)
+        view2 = memoryview(obj)
+        view1[0:1] = b'S'
+        self.assertEqual(view2[0:1].tobytes(), b'S')
+
+    def test_view_keeps_memory(self):
+        lst = []
+        obj = _test_pytalloc.DBaseObject_direct(lambda: lst.append('dead'), 1)
+        view = memoryview(obj)
+        self.assertEqual(len(view), len(memoryview(obj)))
+        del obj
+        gc.collect()
+        self.assertEqual(lst, [])
+        del view
+        gc.collect()
+        self.assertEqual(lst, ['dead'])
+
+    def test_not_a_chunk(self):
+        arr = _test_pytalloc.array_new(10, 1)
+        self.assertTrue(isinstance(arr[0], talloc.BufferObject))
+        self.assertRaises(BufferError, memoryview, arr[0])
+        self.assertRaises(BufferError, memoryview, arr[1])
+
+    def test_base_object_is_not_a_buffer(self):
+        obj = _test_pytalloc.base_new()
+        self.assertRaises(TypeError, memoryview, obj)
+        obj = _test_pytalloc.DBaseObject_direct(lambda: None)
+        self.assertRaises(TypeError, memoryview, obj)
+        arr = _test_pytalloc.array_new(2)
+        self.assertRaises(TypeError, memoryview, arr[0])
+
+
+class TallocPoolTests(unittest.TestCase):
+
+    def test_allocate_from_pool(self):
+        pool = talloc.Pool(16 * 1024)
+        self.assertTrue(isinstance(pool, talloc.BaseObject))
+        self.assertFalse(_test_pytalloc.has_pool())
+        with pool as p:
+            self.assertTrue(p is pool)
+            self.assertTrue(_test_pytalloc.has_pool())
+            objs = [_test_pytalloc.base_new_int() for i in range(10)]
+        self.assertFalse(_test_pytalloc.has_pool())
+        for obj in objs:
+            offset = _test_pytalloc.pool_offset(obj, pool)
+            self.assertTrue(0 < offset < 16 * 1024)
+        obj = _test_pytalloc.base_new_int()
+        self.assertEqual(_test_pytalloc.base_get_int(obj), 0)
+
+    def test_objects_outlive_pool(self):
+        lst = []
+        with talloc.Pool(16 * 1024):
+            obj = _test_pytalloc.DBaseObject(lambda: lst.append('dead'))
+            ref = _test_pytalloc.base_reference(obj)
+            zero = _test_pytalloc.base_new_int()
+        gc.collect()
+        self.assertEqual(_test_pytalloc.base_get_int(zero), 0)
+        del obj
+        gc.collect()
+        self.assertEqual(lst, [])
+        del ref
+        gc.collect()
+        self.assertEqual(lst, ['dead'])
+
+    def test_nested(self):
+        outer = talloc.Pool(16 * 1024)
+        inner = talloc.Pool(16 * 1024)
+        with outer:
+            with inner:
+                obj = _test_pytalloc.base_new_int()
+            self.assertTrue(0 < _test_pytalloc.pool_offset(obj, inner)
+                            < 16 * 1024)
+            obj = _test_pytalloc.base_new_int()
+            self.assertTrue(0 < _test_pytalloc.pool_offset(obj, outer)
+                            < 16 * 1024)
+        self.assertFalse(_test_pytalloc.has_pool())
+
+    def test_misuse(self):
+        self.assertRaises(ValueError, talloc.Pool, -1)
+        pool = talloc.Pool(1024)
+        with pool:
+            self.assertRaises(RuntimeError, pool.__enter__)
+        self.assertRaises(RuntimeError, pool.__exit__, None, None, None)
+        self.assertFalse(_test_pytalloc.has_pool())
+
+    def test_threads(self):
+        # every thread has "with" blocks of its own
+        entered = threading.Event()
+        done = threading.Event()
+        errors = []
+
+        def worker():
+            try:
+                with talloc.Pool(16 * 1024) as pool:
+                    entered.set()
+                    done.wait(10)
+                    obj = _test_pytalloc.base_new_int()
+                    if not 0 < _test_pytalloc.pool_offset(obj, pool) < 16 * 1024:
+                        errors.append('not allocated from the pool')
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        entered.wait(10)
+        self.assertFalse(_test_pytalloc.has_pool())
+        with talloc.Pool(16 * 1024) as pool:
+            obj = _test_pytalloc.base_new_int()
+            self.assertTrue(0 < _test_pytalloc.pool_offset(obj, pool)
+                            < 16 * 1024)
+        self.assertFalse(_test_pytalloc.has_pool())
+        done.set()
+        thread.join()
+        self.assertEqual(errors, [])
+        self.assertFalse(_test_pytalloc.has_pool())
+
+    def test_exhausted(self):
+        # objects that don't fit come from the heap
+        with talloc.Pool(0):
+            objs = [_test_pytalloc.base_new_int() for i in range(10)]
+        self.assertEqual([_test_pytalloc.base_get_int(o) for o in objs],
+                         [0] * 10)
+
+
+@unittest.skipUnless(os.environ.get('TALLOC_BENCHMARK'),
+                     'set TALLOC_BENCHMARK=1 to run the benchmarks')
+class TallocWrapperBenchmark(unittest.TestCase):
+    """Speed and memory numbers of the wrappers, written to stderr.
+
+    These only check that the measurements run, so they are left out
+    of the test run unless TALLOC_BENCHMARK is set."""
+
+    def measure(self, stmt, n):
+        """Run stmt in a process of its own, so that no run reuses the
+        memory another one freed, and return the items per second and
+        the bytes of RSS per item."""
+        process = subprocess.Popen([
+            sys.executable, '-c',
+            """if True:
+            import gc, os, sys, time, talloc, _test_pytalloc
+            def pooled(size, make):
+                with talloc.Pool(size):
+                    return make()
+            def rss():
+                try:
+                    with open('/proc/self/statm') as f:
+                        pages = int(f.read().split()[1])
+                    return pages * os.sysconf('SC_PAGE_SIZE')
+                except (IOError, OSError, ValueError):
+                    return 0
+            n = %d
+            gc.collect()
+            before = rss()
+            start = time.time()
+            objs = %s
+            elapsed = time.time() - start
+            sys.stdout.write('%%.0f %%.0f' %% (
+                n / max(elapsed, 1e-9), float(rss() - before) / n))
+            """ % (n, stmt)
+        ], stdout=subprocess.PIPE)
+        output, stderr = process.communicate()
+        self.assertEqual(process.returncode, 0)
+        rate, per_item = output.split()
+        return rate.decode(), per_item.decode()
+
+    def test_wrap_speed(self):
+        for name in ('base_new', 'base_new_direct'):
+            wraps, per_object = self.measure(
+                '[_test_pytalloc.%s() for i in range(n)]' % name, 200000)
+            sys.stderr.write('%s: %s wraps/sec, %s bytes RSS per object\n' %
+                             (name, wraps, per_object))
+
+    def test_pool_speed(self):
+        make = '[_test_pytalloc.base_new_int() for i in range(n)]'
+        for name, stmt in (
+                ('pytalloc_new', make),
+                ('pytalloc_new in a talloc.Pool',
+                 'pooled(n * 256, lambda: %s)' % make)):
+            wraps, per_object = self.measure(stmt, 200000)
+            sys.stderr.write('%s: %s objects/sec, %s bytes RSS per object\n' %
+                             (name, wraps, per_object))
+
+    def test_array_speed(self):
+        for name, stmt in (
+                ('array_reference_each',
+                 '_test_pytalloc.array_reference_each(n)'),
+                ('array_new', '_test_pytalloc.array_new(n)'),
+                ('array_new, every item looked up',
+                 'list(_test_pytalloc.array_new(n))')):
+            rate, per_item = self.measure(stmt, 100000)
+            sys.stderr.write('%s: %s items/sec, %s bytes RSS per item\n' %
+                             (name, rate, per_item))
+
 
 if __name__ == '__main__':
     unittest.TestProgram()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# Tests for talloc_snapshot.py on talloc_report_binary() snapshots.
+
+import unittest
+import subprocess
+import sys
+import os
+import shutil
+import tempfile
+
+import _test_pytalloc
+import talloc_snapshot
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'talloc_snapshot.py')
+
+
+class TallocSnapshotTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        # a 39 byte root with three "buf" children of 100 bytes and a
+        # "small" one of 10, talloc_named() gives each a ".name" child
+        self.root = _test_pytalloc.base_new()
+        for i in range(3):
+            _test_pytalloc.named_child(self.root, 'buf', 100)
+        _test_pytalloc.named_child(self.root, 'small', 10)
+        self.old = self.report('old')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def report(self, name):
+        path = os.path.join(self.tmpdir, name)
+        _test_pytalloc.report_binary(self.root, path)
+        return path
+
+    def run_script(self, *args):
+        process = subprocess.Popen([sys.executable, SCRIPT] + list(args),
+                                   stdout=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        self.assertEqual(process.returncode, 0)
+        return stdout.decode('utf-8').splitlines()
+
+    def test_load(self):
+        s = talloc_snapshot.Snapshot.load(self.old)
+        self.assertEqual(len(s), 9)
+        self.assertEqual(s.total_size(), 39 + 300 + 10 + 3 * 4 + 6)
+        self.assertEqual(s.parents[0], 0)
+        self.assertEqual(s.name(0), 'This is a test string for a BaseObject')
+
+    def test_not_a_snapshot(self):
+        path = os.path.join(self.tmpdir, 'text')
+        f = open(path, 'wb')
+        f.write(b'no talloc snapshot in here')
+        f.close()
+        self.assertRaises(talloc_snapshot.SnapshotError,
+                          talloc_snapshot.Snapshot.load, path)
+
+    def test_top(self):
+        s = talloc_snapshot.Snapshot.load(self.old)
+        self.assertEqual(talloc_snapshot.top_names(s, 3), [
+            (300, 3, 'buf'),
+            (39, 1, 'This is a test string for a BaseObject'),
+            (18, 4, '.name')])
+
+        lines = self.run_script('top', '-n', '2', self.old)
+        self.assertEqual(lines[0], '367 bytes in 9 blocks')
+        self.assertEqual(lines[1].split(),
+                         ['300', 'bytes', '3', 'blocks', 'buf'])
+        self.assertEqual(len(lines), 3)
+
+    def test_subtrees(self):
+        s = talloc_snapshot.Snapshot.load(self.old)
+        subtrees = talloc_snapshot.largest_subtrees(s, 2)
+        self.assertEqual(subtrees[0], (367, s.ids[0], s.name(0)))
+        self.assertEqual(subtrees[1][0], 104)
+        self.assertEqual(subtrees[1][2], 'buf')
+
+        lines = self.run_script('subtrees', '-n', '1', self.old)
+        self.assertEqual(lines, ['%12d bytes  0x%x  %s' % (367, s.ids[0],
+                                                           s.name(0))])
+
+    def test_diff(self):
+        for i in range(2):
+            _test_pytalloc.named_child(self.root, 'buf', 100)
+        _test_pytalloc.named_child(self.root, 'big', 1000)
+        new = self.report('new')
+        self.assertEqual(talloc_snapshot.diff_names(
+            talloc_snapshot.Snapshot.load(self.old),
+            talloc_snapshot.Snapshot.load(new), 20), [
+                (1000, 1, 'big'),
+                (200, 2, 'buf'),
+                (12, 3, '.name')])
+
+        lines = self.run_script('diff', self.old, new)
+        self.assertEqual(lines[0], '+1212 bytes +6 blocks')
+        self.assertEqual(lines[1].split(),
+                         ['+1000', 'bytes', '+1', 'blocks', 'big'])
+        self.assertEqual(len(lines), 4)
+
+        lines = self.run_script('diff', self.old, self.old)
+        self.assertEqual(lines, ['+0 bytes +0 blocks'])
+
+
+if __name__ == '__main__':
+    unittest.TestProgram()
@@ -881,6 +881,30 @@ static bool test_speed(void)
 
 	talloc_free(ctx);
 
+	if (talloc_enable_chunk_cache(100) == 0) {
+		ctx = talloc_new(NULL);
+
+		tv = private_timeval_current();
+		count = 0;
+		do {
+			void *p1, *p2, *p3;
+			for (i=0;i<loop;i++) {
+				p1 = talloc_size(ctx, loop % 100);
+				p2 = talloc_strdup(p1, "foo bar");
+				p3 = talloc_size(p1, 300);
+				(void)p2;
+				(void)p3;
+				talloc_free(p1);
+			}
+			count += 3 * loop;
+		} while (private_timeval_elapsed(&tv) < 5.0);
+
+		fprintf(stderr, "talloc_cache: %.0f ops/sec\n", count/private_timeval_elapsed(&tv));
+
+		talloc_free(ctx);
+		talloc_disable_chunk_cache();
+	}
+
 	ctx = talloc_pool(NULL, 1024);
 
 	tv = private_timeval_current();
@@ -902,6 +926,28 @@ static bool test_speed(void)
 
 	fprintf(stderr, "talloc_pool: %.0f ops/sec\n", count/private_timeval_elapsed(&tv));
 
+	ctx = talloc_arena(NULL, 1024);
+
+	tv = private_timeval_current();
+	count = 0;
+	do {
+		void *p1, *p2, *p3;
+		for (i=0;i<loop;i++) {
+			p1 = talloc_size(ctx, loop % 100);
+			p2 = talloc_strdup(ctx, "foo bar");
+			p3 = talloc_size(ctx, 300);
+			(void)p1;
+			(void)p2;
+			(void)p3;
+		}
+		talloc_free_children(ctx);
+		count += 3 * loop;
+	} while (private_timeval_elapsed(&tv) < 5.0);
+
+	talloc_free(ctx);
+
+	fprintf(stderr, "talloc_arena: %.0f ops/sec\n", count/private_timeval_elapsed(&tv));
+
 	tv = private_timeval_current();
 	count = 0;
 	do {
@@ -923,6 +969,465 @@ static bool test_speed(void)
 	return true;
 }
 
+static bool test_pool_reuse_speed(void)
+{
+	const int num_slots = 256;
+	const int loop = 1000000;
+	void *slots[num_slots];
+	int reuse;
+
+	printf("test: pool_reuse_speed\n# TALLOC POOL REUSE UNDER CHURN\n");
+
+	for (reuse = 0; reuse <= 1; reuse++) {
+		void *pool = talloc_growable_pool(NULL, 64 * 1024, 64 * 1024);
+		struct talloc_pool_stats stats;
+		struct timeval tv;
+		unsigned allocs = 0;
+		int i;
+
+		torture_assert("pool_reuse_speed", pool != NULL, "failed");
+		if (reuse) {
+			torture_assert("pool_reuse_speed",
+				       talloc_pool_enable_reuse(pool) == 0,
+				       "failed");
+		}
+
+		memset(slots, 0, sizeof(slots));
+		srand(1);
+
+		tv = private_timeval_current();
+		for (i = 0; i < loop; i++) {
+			int idx = rand() % num_slots;
+
+			if (slots[idx] != NULL) {
+				talloc_free(slots[idx]);
+				slots[idx] = NULL;
+			} else {
+				slots[idx] = talloc_size(pool, 16 + rand() % 240);
+				allocs++;
+			}
+		}
+
+		torture_assert("pool_reuse_speed",
+			       talloc_pool_stats(pool, &stats) == 0, "failed");
+
+		fprintf(stderr, "talloc_pool%s: %.0f ops/sec, %.1f%% hit rate\n",
+			reuse ? "_reuse" : "",
+			loop/private_timeval_elapsed(&tv),
+			100.0 * (allocs - stats.fallbacks) / allocs);
+
+		talloc_free(pool);
+	}
+
+	printf("success: pool_reuse_speed\n");
+	return true;
+}
+
+static bool test_strbuf_speed(void)
+{
+	const size_t target = 1024 * 1024;
+	const char *piece = "0123456789";
+	int builder;
+
+	printf("test: strbuf_speed\n# TALLOC STRING BUILDER SPEED\n");
+
+	for (builder = 0; builder <= 1; builder++) {
+		void *ctx = talloc_new(NULL);
+		struct timeval tv;
+		unsigned count = 0;
+
+		tv = private_timeval_current();
+		do {
+			char *s;
+			size_t len = 0;
+
+			if (builder) {
+				s = talloc_strbuf_new(ctx, 0);
+			} else {
+				s = talloc_strdup(ctx, "");
+			}
+			while (len < target) {
+				s = talloc_strdup_append_buffer(s, piece);
+				len += 10;
+			}
+			torture_assert("strbuf_speed", s != NULL, "failed");
+			if (builder) {
+				s = talloc_strbuf_finish(s);
+			}
+			torture_assert("strbuf_speed",
+				       talloc_get_size(s) == len + 1, "failed");
+			talloc_free(s);
+			count++;
+		} while (private_timeval_elapsed(&tv) < 2.0);
+
+		fprintf(stderr, "%s: %.1f MB/sec\n",
+			builder ? "talloc_strbuf" : "talloc_strdup_append_buffer",
+			count/private_timeval_elapsed(&tv));
+
+		talloc_free(ctx);
+	}
+
+	printf("success: strbuf_speed\n");
+	return true;
+}
+
+static char *asprintf_via_stack(const void *ctx, const char *fmt, ...)
+	PRINTF_ATTRIBUTE(2,3);
+
+/* the stack buffer path talloc_asprintf() takes outside of pools */
+static char *asprintf_via_stack(const void *ctx, const char *fmt, ...)
+{
+	char buf[1024];
+	va_list ap;
+	char *ret;
+	int len;
+
+	va_start(ap, fmt);
+	len = vsnprintf(buf, sizeof(buf), fmt, ap);
+	va_end(ap);
+	if (len < 0) {
+		return NULL;
+	}
+
+	ret = talloc_array(ctx, char, len + 1);
+	if (ret == NULL) {
+		return NULL;
+	}
+
+	if ((size_t)len < sizeof(buf)) {
+		memcpy(ret, buf, len + 1);
+	} else {
+		va_start(ap, fmt);
+		vsnprintf(ret, len + 1, fmt, ap);
+		va_end(ap);
+	}
+	return ret;
+}
+
+static bool test_asprintf_speed(void)
+{
+	const int loop = 1000000;
+	const char *sizes[] = { "short", "long" };
+	char arg[2000];
+	int direct, size;
+
+	printf("test: asprintf_speed\n# TALLOC_ASPRINTF SPEED IN A POOL\n");
+
+	memset(arg, 'x', sizeof(arg) - 1);
+	arg[sizeof(arg) - 1] = '\0';
+
+	for (size = 0; size <= 1; size++) {
+		const char *a = size ? arg : "request";
+
+		for (direct = 0; direct <= 1; direct++) {
+			void *pool = talloc_pool(NULL, 64 * 1024);
+			struct timeval tv;
+			int i;
+
+			torture_assert("asprintf_speed", pool != NULL,
+				       "failed");
+
+			tv = private_timeval_current();
+			for (i = 0; i < loop; i++) {
+				char *s;
+
+				if (direct) {
+					s = talloc_asprintf(pool,
+						"%s %d from %s took %u usec",
+						a, i, "client", 17);
+				} else {
+					s = asprintf_via_stack(pool,
+						"%s %d from %s took %u usec",
+						a, i, "client", 17);
+				}
+				torture_assert("asprintf_speed", s != NULL,
+					       "failed");
+				talloc_free(s);
+			}
+
+			fprintf(stderr, "talloc_asprintf %s%s: "
+				"%.0f ops/sec\n",
+				sizes[size], direct ? "" : " via stack",
+				loop/private_timeval_elapsed(&tv));
+
+			talloc_free(pool);
+		}
+	}
+
+	printf("success: asprintf_speed\n");
+	return true;
+}
+
+static bool test_parent_links_speed(void)
+{
+	const unsigned num_children = 200000;
+	const unsigned loop = 1000;
+	const unsigned step = num_children / loop;
+	void **children;
+	int links;
+
+	printf("test: parent_links_speed\n# TALLOC PARENT LINKS ON A WIDE TREE\n");
+
+	children = talloc_array(NULL, void *, num_children);
+	torture_assert("parent_links_speed", children != NULL, "failed");
+
+	for (links = 0; links <= 1; links++) {
+		const char *suffix = links ? " (parent links)" : "";
+		void *ctx = talloc_new(NULL);
+		void *other = talloc_new(NULL);
+		struct timeval tv;
+		unsigned i;
+
+		if (links) {
+			talloc_enable_parent_links(ctx);
+		}
+		for (i = 0; i < num_children; i++) {
+			children[i] = talloc_size(ctx, 16);
+		}
+
+		tv = private_timeval_current();
+		for (i = 0; i < loop; i++) {
+			torture_assert("parent_links_speed",
+				       talloc_parent(children[i * step]) == ctx,
+				       "failed");
+		}
+		fprintf(stderr, "talloc_parent%s: %.0f ops/sec\n",
+			suffix, loop/private_timeval_elapsed(&tv));
+
+		tv = private_timeval_current();
+		for (i = 0; i < loop; i++) {
+			talloc_steal(other, children[i * step]);
+		}
+		fprintf(stderr, "talloc_steal%s: %.0f ops/sec\n",
+			suffix, loop/private_timeval_elapsed(&tv));
+
+		tv = private_timeval_current();
+		for (i = 0; i < loop; i++) {
+			torture_assert("parent_links_speed",
+				       talloc_unlink(ctx,
+						     children[i * step + 1]) == 0,
+				       "failed");
+		}
+		fprintf(stderr, "talloc_unlink%s: %.0f ops/sec\n",
+			suffix, loop/private_timeval_elapsed(&tv));
+
+		talloc_free(other);
+		talloc_free(ctx);
+	}
+
+	talloc_free(children);
+
+	printf("success: parent_links_speed\n");
+	return true;
+}
+
+static bool test_realloc_speed(void)
+{
+	const size_t step = 4096;
+	const size_t max_size = 64 * 1024 * 1024;
+	const unsigned loop = 1000;
+	void *ctx = talloc_new(NULL);
+	void *pool;
+	struct timeval tv;
+	char *buf, *p;
+	size_t size, count, moved;
+	int mmapped;
+	unsigned i;
+
+	printf("test: realloc_speed\n# TALLOC REALLOC IN PLACE\n");
+
+	/*
+	 * A buffer growing page by page. realloc(3) has to copy it
+	 * whenever it moves, a mapping is moved by remapping its pages.
+	 */
+	for (mmapped = 0; mmapped <= 1; mmapped++) {
+		const char *suffix = mmapped ? " (mmap)" : "";
+
+		if (mmapped &&
+		    talloc_set_mmap_threshold(128 * 1024) != 0) {
+			continue;
+		}
+
+		buf = NULL;
+		count = moved = 0;
+		tv = private_timeval_current();
+		for (size = step; size <= max_size; size += step) {
+			p = talloc_realloc(ctx, buf, char, size);
+			torture_assert("realloc_speed", p != NULL, "failed");
+			p[size - 1] = 1;
+			if (buf != NULL && p != buf) {
+				moved++;
+			}
+			buf = p;
+			count++;
+		}
+		fprintf(stderr, "grow to %zu MB%s: %zu of %zu reallocs "
+			"moved, %.2f sec\n", max_size / (1024 * 1024), suffix,
+			moved, count, private_timeval_elapsed(&tv));
+		talloc_free(buf);
+	}
+	talloc_set_mmap_threshold(0);
+
+	/*
+	 * A buffer in a pool that grows while short lived chunks are
+	 * allocated behind it. Unless it takes over the freed chunks
+	 * behind it, every one of these reallocs copies the buffer.
+	 */
+	pool = talloc_pool(ctx, 1024 * 1024);
+	buf = talloc_size(pool, 16);
+	torture_assert("realloc_speed", buf != NULL, "failed");
+
+	size = 16;
+	moved = 0;
+	tv = private_timeval_current();
+	for (i = 0; i < loop; i++) {
+		char *scratch = talloc_size(pool, 256);
+
+		talloc_size(pool, 16);
+		talloc_free(scratch);
+
+		size += 16;
+		p = talloc_realloc(pool, buf, char, size);
+		torture_assert("realloc_speed", p != NULL, "failed");
+		if (p != buf) {
+			moved++;
+		}
+		buf = p;
+	}
+	fprintf(stderr, "grow in a pool: %zu of %u reallocs moved, %.2f sec\n",
+		moved, loop, private_timeval_elapsed(&tv));
+
+	talloc_free(ctx);
+
+	printf("success: realloc_speed\n");
+	return true;
+}
+
+static bool test_type_check_speed(void)
+{
+	/* the name of the type as another module would set it */
+	static const char other_name[] = "struct type_check_speed";
+	const unsigned loop = 10000000;
+	void *ctx = talloc_new(NULL);
+	void *same, *other;
+	struct timeval tv;
+	double elapsed;
+	unsigned i, pass;
+
+	printf("test: type_check_speed\n# TALLOC TYPE CHECK SPEED\n");
+
+	same = talloc_named_const(ctx, 10, "struct type_check_speed");
+	other = talloc_named_const(ctx, 10, other_name);
+
+	for (pass = 0; pass < 3; pass++) {
+		void *p = pass == 0 ? same : other;
+		const char *what = pass == 0 ? "same literal" :
+			pass == 1 ? "other module" :
+			"other module, registered";
+
+		if (pass == 2 &&
+		    (talloc_register_type(struct type_check_speed) != 0 ||
+		     talloc_register_type_name(other_name) != 0)) {
+			continue;
+		}
+
+		tv = private_timeval_current();
+		for (i = 0; i < loop; i++) {
+			torture_assert("type_check_speed",
+				talloc_get_type_abort(p, struct type_check_speed) == p,
+				"type check failed\n");
+		}
+		elapsed = private_timeval_elapsed(&tv);
+		fprintf(stderr, "type checks, %s: %.0f checks/sec\n",
+			what, loop / elapsed);
+	}
+
+	talloc_free(ctx);
+
+	printf("success: type_check_speed\n");
+	return true;
+}
+
+struct pool_node {
+	struct pool_node *next;
+	unsigned long value;
+	char payload[48];
+};
+
+static bool test_pool_hugepage_speed(void)
+{
+	const unsigned num_nodes = 512 * 1024;
+	const unsigned steps = 8 * 1024 * 1024;
+	struct pool_node **nodes;
+	int hugepages;
+
+	printf("test: pool_hugepage_speed\n# TALLOC POOLS ON HUGEPAGES\n");
+
+	nodes = malloc(num_nodes * sizeof(nodes[0]));
+	torture_assert("pool_hugepage_speed", nodes != NULL, "malloc failed");
+
+	/*
+	 * Build a large object graph in a pool and follow its links in a
+	 * random order, which touches a different page on almost every
+	 * step.
+	 */
+	for (hugepages = 0; hugepages <= 1; hugepages++) {
+		struct pool_node *n;
+		struct timeval tv;
+		double alloc_time;
+		unsigned long sum = 0;
+		void *pool;
+		unsigned i;
+
+		if (talloc_set_pool_hugepage_threshold(
+			    hugepages ? 4 * 1024 * 1024 : 0) != 0) {
+			continue;
+		}
+
+		tv = private_timeval_current();
+		pool = talloc_pool(NULL, num_nodes * 192);
+		torture_assert("pool_hugepage_speed", pool != NULL, "failed");
+		for (i = 0; i < num_nodes; i++) {
+			nodes[i] = talloc(pool, struct pool_node);
+			torture_assert("pool_hugepage_speed", nodes[i] != NULL,
+				       "failed");
+			nodes[i]->value = i;
+		}
+		alloc_time = private_timeval_elapsed(&tv);
+
+		srand(1);
+		for (i = num_nodes - 1; i > 0; i--) {
+			unsigned j = rand() % (i + 1);
+
+			n = nodes[i];
+			nodes[i] = nodes[j];
+			nodes[j] = n;
+		}
+		for (i = 0; i < num_nodes; i++) {
+			nodes[i]->next = nodes[(i + 1) % num_nodes];
+		}
+
+		tv = private_timeval_current();
+		n = nodes[0];
+		for (i = 0; i < steps; i++) {
+			sum += n->value;
+			n = n->next;
+		}
+		fprintf(stderr, "%u pooled objects%s: allocated in %.3f sec, "
+			"%.0f random steps/sec (%lu)\n", num_nodes,
+			hugepages ? " on hugepages" : "", alloc_time,
+			steps / private_timeval_elapsed(&tv), sum % 10);
+
+		talloc_free(pool);
+	}
+	talloc_set_pool_hugepage_threshold(0);
+
+	free(nodes);
+
+	printf("success: pool_hugepage_speed\n");
+	return true;
+}
+
 static bool test_lifeless(void)
 {
 	void *top = talloc_new(NULL);
@@ -1441,6 +1946,350 @@ static bool test_pool_steal(void)
 	return true;
 }
 
+static bool test_pool_asprintf(void)
+{
+	void *root;
+	void *pool, *p1, *p2;
+	char *s1, *s2, *s3;
+	char big[3000];
+	int i;
+
+	printf("test: pool_asprintf\n# TALLOC_ASPRINTF IN A POOL\n");
+
+	root = talloc_new(NULL);
+	pool = talloc_pool(root, 1024);
+
+	s1 = talloc_asprintf(pool, "%s-%d", "hello", 42);
+	torture_assert("pool_asprintf", strcmp(s1, "hello-42") == 0,
+		       "wrong content\n");
+	torture_assert("pool_asprintf", talloc_get_size(s1) == 9,
+		       "speculative size not given back\n");
+	torture_assert("pool_asprintf",
+		       strcmp(talloc_get_name(s1), "hello-42") == 0,
+		       "wrong name\n");
+
+	/* the unused pool space is available again */
+	s2 = talloc_asprintf(pool, "%s", "world");
+	torture_assert("pool_asprintf", s2 > s1, "not allocated from pool\n");
+	torture_assert("pool_asprintf", PTR_DIFF(s2, s1) < 128,
+		       "pool space not reclaimed\n");
+	CHECK_BLOCKS("pool_asprintf", pool, 3);
+
+	/* a result too large for the pool is formatted again */
+	memset(big, 'x', sizeof(big) - 1);
+	big[sizeof(big) - 1] = '\0';
+	s3 = talloc_asprintf(pool, "<%s>", big);
+	torture_assert("pool_asprintf", s3 != NULL, "failed\n");
+	torture_assert("pool_asprintf", strlen(s3) == sizeof(big) + 1,
+		       "wrong length\n");
+	torture_assert("pool_asprintf",
+		       s3[0] == '<' && s3[sizeof(big)] == '>',
+		       "wrong content\n");
+	torture_assert("pool_asprintf", talloc_parent(s3) == pool,
+		       "wrong parent\n");
+	CHECK_BLOCKS("pool_asprintf", pool, 4);
+
+	/* the pool space is still usable after the overflow */
+	talloc_free(s3);
+	s3 = talloc_asprintf(s2, "%d", 7);
+	torture_assert("pool_asprintf", s3 > s2 && PTR_DIFF(s3, s2) < 128,
+		       "pool space not reclaimed after overflow\n");
+	torture_assert("pool_asprintf", strcmp(s3, "7") == 0,
+		       "wrong content\n");
+
+	/* strings formatted under an arena stay unlinked */
+	pool = talloc_arena(root, 1024);
+	for (i = 0; i < 5; i++) {
+		s1 = talloc_asprintf(pool, "%s-%d", "hello", i);
+		torture_assert("pool_asprintf",
+			       strncmp(s1, "hello-", 6) == 0 &&
+			       s1[6] == '0' + i && s1[7] == '\0',
+			       "wrong content\n");
+	}
+	CHECK_BLOCKS("pool_asprintf", pool, 1);
+	CHECK_PARENT("pool_asprintf", s1, pool);
+
+	/*
+	 * a growable pool whose second slab has more free space than a
+	 * chunk may have
+	 */
+	pool = talloc_growable_pool(root, 150*1024*1024, 0);
+	torture_assert("pool_asprintf", pool != NULL,
+		       "talloc_growable_pool failed\n");
+	p1 = talloc_size(pool, 150*1024*1024 - 4096);
+	p2 = talloc_size(pool, 8192);
+	torture_assert("pool_asprintf", p1 != NULL && p2 != NULL,
+		       "growing the pool failed\n");
+	s1 = talloc_asprintf(pool, "%s-%d", "hello", 42);
+	torture_assert("pool_asprintf", s1 != NULL && strcmp(s1, "hello-42") == 0,
+		       "asprintf in a large pool failed\n");
+	s2 = talloc_asprintf(pool, "<%s>", big);
+	torture_assert("pool_asprintf",
+		       s2 != NULL && strlen(s2) == sizeof(big) + 1,
+		       "long asprintf in a large pool failed\n");
+	s3 = talloc_asprintf(pool, "%s", "world");
+	torture_assert("pool_asprintf", s3 > s2 && PTR_DIFF(s3, s2) < 4096,
+		       "pool space not reclaimed\n");
+	CHECK_BLOCKS("pool_asprintf", pool, 6);
+
+	talloc_free(root);
+
+	printf("success: pool_asprintf\n");
+	return true;
+}
+
+static bool test_growable_pool(void)
+{
+	void *root;
+	void *pool;
+	void *p1, *p2, *p3;
+	struct talloc_pool_stats stats;
+	int i;
+
+	root = talloc_new(NULL);
+
+	torture_assert("growable pool stats", talloc_pool_stats(root, &stats) == -1,
+		       "failed: stats for a normal chunk");
+
+	pool = talloc_growable_pool(root, 1024, 8 * 1024);
+	torture_assert("growable pool", pool != NULL, "failed");
+
+	torture_assert("growable pool stats", talloc_pool_stats(pool, &stats) == 0,
+		       "failed");
+	torture_assert("growable pool stats", stats.num_slabs == 1, "failed");
+	torture_assert("growable pool stats", stats.size == 1024, "failed");
+	torture_assert("growable pool stats", stats.used == 0, "failed");
+
+	/* the second slab is twice the size of the first one */
+	p1 = NULL;
+	for (i = 0; i < 20; i++) {
+		p2 = talloc_size(pool, 32);
+		torture_assert("growable pool allocate", p2 != NULL, "failed");
+		memset(p2, 0x11, talloc_get_size(p2));
+		if (p1 == NULL) {
+			p1 = p2;
+		}
+	}
+	torture_assert("growable pool stats", talloc_pool_stats(pool, &stats) == 0,
+		       "failed");
+	torture_assert("growable pool stats", stats.num_slabs == 2, "failed");
+	torture_assert("growable pool stats", stats.size == 3 * 1024, "failed");
+	torture_assert("growable pool stats", stats.wasted < 1024, "failed");
+	torture_assert("growable pool stats", stats.fallbacks == 0, "failed");
+	CHECK_BLOCKS("growable pool", pool, 21);
+
+	/* grandchildren of chunks in a slab come from the pool as well */
+	p3 = talloc_size(p2, 32);
+	torture_assert("growable pool allocate", p3 != NULL, "failed");
+	CHECK_PARENT("growable pool", p3, p2);
+
+	/* until max_size is reached */
+	p3 = talloc_size(pool, 8 * 1024);
+	torture_assert("growable pool allocate", p3 != NULL, "failed");
+	memset(p3, 0x11, talloc_get_size(p3));
+	torture_assert("growable pool stats", talloc_pool_stats(pool, &stats) == 0,
+		       "failed");
+	torture_assert("growable pool stats", stats.size <= 8 * 1024, "failed");
+	torture_assert("growable pool stats", stats.fallbacks == 1, "failed");
+
+	/* realloc can move a chunk between slabs */
+	p3 = talloc_realloc_size(pool, p1, 2 * 1024);
+	torture_assert("growable pool realloc", p3 != NULL, "failed");
+	memset(p3, 0x11, talloc_get_size(p3));
+	p3 = talloc_size(p3, 32);
+	torture_assert("growable pool allocate", p3 != NULL, "failed");
+
+	/* a stolen chunk keeps its slab alive */
+	talloc_steal(root, p2);
+	talloc_free(pool);
+	memset(p2, 0x11, talloc_get_size(p2));
+	p3 = talloc_size(p2, 16);
+	torture_assert("growable pool allocate", p3 != NULL, "failed");
+	talloc_free(p2);
+
+	/* slabs are part of the memory limit of the pool */
+	torture_assert("growable pool memlimit",
+		       talloc_set_memlimit(root, 16 * 1024) == 0, "failed");
+	pool = talloc_growable_pool(root, 1024, 0);
+	torture_assert("growable pool", pool != NULL, "failed");
+	for (i = 0; i < 30; i++) {
+		talloc_size(pool, 128);
+	}
+	torture_assert("growable pool memlimit",
+		       talloc_size(root, 12 * 1024) == NULL, "failed");
+	talloc_free(pool);
+	p1 = talloc_size(root, 12 * 1024);
+	torture_assert("growable pool memlimit", p1 != NULL, "failed");
+
+	talloc_free(root);
+
+	return true;
+}
+
+static bool test_pool_reuse(void)
+{
+	void *root;
+	void *pool;
+	void *p1, *p2, *p3, *p4;
+	struct talloc_pool_stats stats;
+
+	root = talloc_new(NULL);
+
+	torture_assert("pool reuse", talloc_pool_enable_reuse(root) == -1,
+		       "failed: reuse for a normal chunk");
+
+	pool = talloc_pool(root, 1024);
+	torture_assert("pool reuse", talloc_pool_enable_reuse(pool) == 0,
+		       "failed");
+
+	p1 = talloc_size(pool, 32);
+	p2 = talloc_size(pool, 32);
+	p3 = talloc_size(pool, 32);
+	torture_assert("pool reuse", p3 != NULL, "failed");
+
+	/* an interior hole is reused for a chunk of the same size */
+	talloc_free(p2);
+	p4 = talloc_size(pool, 64);
+	torture_assert("pool reuse", p4 > p3, "failed: hole used for wrong size");
+	p2 = talloc_size(pool, 20);
+	torture_assert("pool reuse", p2 != p4, "failed: hole not reused");
+	torture_assert("pool reuse", p2 < p3, "failed: hole not reused");
+	memset(p2, 0x11, talloc_get_size(p2));
+	CHECK_PARENT("pool reuse", p2, pool);
+
+	torture_assert("pool reuse", talloc_pool_stats(pool, &stats) == 0,
+		       "failed");
+	torture_assert("pool reuse", stats.reused == 1, "failed");
+
+	/* the pool is still limited to its own memory */
+	talloc_free(p4);
+	p4 = talloc_size(pool, 2048);
+	torture_assert("pool reuse", p4 != NULL, "failed");
+	torture_assert("pool reuse", talloc_pool_stats(pool, &stats) == 0,
+		       "failed");
+	torture_assert("pool reuse", stats.num_slabs == 1, "failed");
+	torture_assert("pool reuse", stats.fallbacks == 1, "failed");
+	talloc_free(p4);
+
+	/* holes are forgotten when the pool is reset */
+	talloc_free(p1);
+	talloc_free(p2);
+	talloc_free(p3);
+	CHECK_BLOCKS("pool reuse", pool, 1);
+	p1 = talloc_size(pool, 512);
+	p2 = talloc_size(pool, 32);
+	torture_assert("pool reuse", p2 > p1, "failed: stale hole reused");
+	memset(p1, 0x11, talloc_get_size(p1));
+	memset(p2, 0x11, talloc_get_size(p2));
+
+	/* a chunk moved out of the pool can still go back to a bin */
+	p3 = talloc_size(pool, 32);
+	talloc_steal(root, p1);
+	talloc_free(pool);
+	talloc_free(p1);
+	talloc_free(root);
+
+	return true;
+}
+
+static int arena_destructor_count;
+
+static int arena_destructor(void *ptr)
+{
+	arena_destructor_count++;
+	return 0;
+}
+
+static bool test_arena(void)
+{
+	void *root;
+	void *arena;
+	void *p1, *p2, *p3, *p4;
+	struct talloc_pool_stats stats;
+	int i;
+
+	root = talloc_new(NULL);
+
+	arena = talloc_arena(root, 1024);
+	torture_assert("arena", arena != NULL, "failed");
+
+	/* direct children are not linked */
+	p1 = talloc_size(arena, 32);
+	torture_assert("arena", p1 != NULL, "failed");
+	CHECK_PARENT("arena", p1, arena);
+	CHECK_BLOCKS("arena", arena, 1);
+
+	/* freeing the last child gives its memory back */
+	p2 = talloc_size(arena, 32);
+	talloc_free(p2);
+	p3 = talloc_size(arena, 32);
+	torture_assert("arena", p3 == p2, "failed: memory not reused");
+
+	/* a child of its own links a chunk */
+	p2 = talloc_strdup(p1, "child");
+	CHECK_PARENT("arena", p2, p1);
+	CHECK_BLOCKS("arena", arena, 3);
+
+	/* so does a destructor */
+	arena_destructor_count = 0;
+	talloc_set_destructor(p3, arena_destructor);
+	CHECK_BLOCKS("arena", arena, 4);
+
+	/* and a reference */
+	p4 = talloc_strdup(arena, "referenced");
+	torture_assert("arena", talloc_reference(root, p4) == p4, "failed");
+
+	/* and a move to another parent */
+	p1 = talloc_size(arena, 64);
+	memset(p1, 0x11, 64);
+	talloc_steal(root, p1);
+	CHECK_PARENT("arena", p1, root);
+
+	/* the arena grows as needed */
+	for (i = 0; i < 100; i++) {
+		p2 = talloc_size(arena, 64);
+		torture_assert("arena", p2 != NULL, "failed");
+		memset(p2, 0x11, 64);
+	}
+	torture_assert("arena", talloc_pool_stats(arena, &stats) == 0,
+		       "failed");
+	torture_assert("arena", stats.num_slabs > 1, "failed: no slabs");
+	torture_assert("arena", stats.fallbacks == 0, "failed");
+
+	/* realloc links a chunk that may leave the arena */
+	p2 = talloc_realloc_size(arena, p2, 4096);
+	torture_assert("arena", p2 != NULL, "failed");
+	memset(p2, 0x11, 4096);
+	CHECK_PARENT("arena", p2, arena);
+
+	talloc_free(arena);
+	torture_assert("arena", arena_destructor_count == 1,
+		       "failed: destructor not called");
+	CHECK_PARENT("arena", p1, root);
+	torture_assert("arena", strcmp((char *)p4, "referenced") == 0,
+		       "failed: referenced chunk lost");
+	memset(p1, 0x11, 64);
+	talloc_free(p1);
+	CHECK_PARENT("arena", p4, root);
+	CHECK_BLOCKS("arena", root, 2);
+	talloc_unlink(root, p4);
+	CHECK_BLOCKS("arena", root, 1);
+
+	/* talloc_free_children() releases unlinked children as well */
+	arena = talloc_arena(root, 1024);
+	p1 = talloc_size(arena, 32);
+	for (i = 0; i < 5; i++) {
+		talloc_size(arena, 32);
+	}
+	talloc_free_children(arena);
+	p2 = talloc_size(arena, 32);
+	torture_assert("arena", p2 == p1, "failed: arena not reset");
+
+	talloc_free(root);
+
+	return true;
+}
+
 static bool test_pool_nest(void)
 {
 	void *p1, *p2, *p3;
@@ -1589,7 +2438,158 @@ static bool test_free_children(void)
 	return true;
 }
 
-static bool test_memlimit(void)
+static int free_tree_destructor_count;
+
+static int free_tree_destructor(void *ptr)
+{
+	free_tree_destructor_count++;
+	return 0;
+}
+
+static bool test_free_tree(void)
+{
+	void *root, *pool;
+	void *p1, *p2, *p3, *p4;
+	int i, j;
+
+	printf("test: free_tree\n# FREE TREE\n");
+
+	root = talloc_new(NULL);
+
+	/* a plain tree without destructors */
+	p1 = talloc_new(root);
+	for (i = 0; i < 10; i++) {
+		p2 = talloc_array(p1, char, i + 1);
+		for (j = 0; j < 10; j++) {
+			p3 = talloc_strdup(p2, "child");
+			p3 = talloc_strdup(p3, "grandchild");
+		}
+	}
+	CHECK_BLOCKS("free_tree", p1, 211);
+	talloc_free(p1);
+	CHECK_BLOCKS("free_tree", root, 1);
+
+	/* a destructor deep down in the tree must still run */
+	free_tree_destructor_count = 0;
+	p1 = talloc_new(root);
+	p2 = talloc_new(p1);
+	p3 = talloc_new(p2);
+	for (i = 0; i < 10; i++) {
+		talloc_new(p2);
+	}
+	talloc_set_destructor(p3, free_tree_destructor);
+	talloc_free(p1);
+	torture_assert("free_tree", free_tree_destructor_count == 1,
+		"destructor not called\n");
+
+	/* ... also if the chunk was moved into a plain tree */
+	free_tree_destructor_count = 0;
+	p1 = talloc_new(root);
+	p2 = talloc_new(p1);
+	p3 = talloc_new(root);
+	talloc_set_destructor(p3, free_tree_destructor);
+	talloc_steal(p2, p3);
+	talloc_free(p1);
+	torture_assert("free_tree", free_tree_destructor_count == 1,
+		"destructor not called after steal\n");
+
+	/* references keep their chunk alive */
+	p1 = talloc_new(root);
+	p2 = talloc_new(p1);
+	p3 = talloc_strdup(p2, "referenced");
+	p4 = talloc_new(root);
+	torture_assert("free_tree", talloc_reference(p4, p3) == p3,
+		"reference failed\n");
+	talloc_free(p1);
+	CHECK_PARENT("free_tree", p3, p4);
+	torture_assert("free_tree", strcmp((char *)p3, "referenced") == 0,
+		"referenced chunk was freed\n");
+	talloc_free(p4);
+
+	/* pool members in a plain tree go back to their pool */
+	pool = talloc_pool(root, 1024);
+	p1 = talloc_new(root);
+	p2 = talloc_size(pool, 16);
+	p3 = talloc_size(p2, 16);
+	talloc_size(p3, 16);
+	talloc_steal(p1, p2);
+	talloc_free(p1);
+	CHECK_BLOCKS("free_tree", pool, 1);
+	p2 = talloc_size(pool, 1024);
+	torture_assert("free_tree", p2 != NULL, "pool space not reclaimed\n");
+	talloc_free(pool);
+
+	/* the memory limit is kept up to date */
+	torture_assert("free_tree", talloc_set_memlimit(root, 2048) == 0,
+		"set_memlimit failed\n");
+	p1 = talloc_new(root);
+	for (i = 0; i < 5; i++) {
+		talloc_size(talloc_size(p1, 100), 100);
+	}
+	torture_assert("free_tree", talloc_size(root, 1024) == NULL,
+		"memlimit not enforced\n");
+	talloc_free(p1);
+	p1 = talloc_size(root, 1024);
+	torture_assert("free_tree", p1 != NULL, "memlimit not released\n");
+
+	talloc_free(root);
+
+	printf("success: free_tree\n");
+	return true;
+}
+
+static bool test_chunk_cache(void)
+{
+	void *root;
+	char *p1, *p2, *p3;
+
+	printf("test: chunk_cache\n# CHUNK CACHE\n");
+
+	if (talloc_enable_chunk_cache(2) != 0) {
+		printf("skip: chunk_cache not available\n");
+		return true;
+	}
+
+	root = talloc_new(NULL);
+
+	p1 = talloc_size(root, 40);
+	torture_assert("chunk_cache", p1 != NULL, "failed: alloc failed\n");
+	talloc_free(p1);
+
+	/* 33 bytes are in the same size class as 40 bytes */
+	p2 = talloc_size(root, 33);
+	torture_assert("chunk_cache", p2 == p1,
+		"failed: cached chunk was not reused\n");
+	CHECK_SIZE("chunk_cache", p2, 33);
+	CHECK_PARENT("chunk_cache", p2, root);
+
+	/* a different size class must not get the same block */
+	talloc_free(p2);
+	p3 = talloc_size(root, 100);
+	torture_assert("chunk_cache", p3 != p1,
+		"failed: chunk reused for the wrong size class\n");
+
+	/* growing a cached chunk must keep it usable */
+	p2 = talloc_size(root, 40);
+	torture_assert("chunk_cache", p2 == p1,
+		"failed: cached chunk was not reused\n");
+	p2 = talloc_realloc(root, p2, char, 200);
+	torture_assert("chunk_cache", p2 != NULL, "failed: realloc failed\n");
+	memset(p2, 0x11, 200);
+	talloc_free(p2);
+	p3 = talloc_size(root, 195);
+	torture_assert("chunk_cache", p3 == p2,
+		"failed: grown chunk was not reused\n");
+	memset(p3, 0x11, 195);
+
+	talloc_free(root);
+	talloc_disable_chunk_cache();
+
+	printf("success: chunk_cache\n");
+	return true;
+}
+
+static bool test_memlimit(void)
 {
 	void *root;
 	char *l1, *l2, *l3, *l4, *l5, *t;
@@ -1655,134 +2655,1804 @@ static bool test_memlimit(void)
 	printf("==== talloc_steal(l1, l2)\n");
 	talloc_steal(l1, l2);
 
-	talloc_report_full(root, stdout);
+	talloc_report_full(root, stdout);
+
+	printf("==== talloc_strdup(l2, level 3)\n");
+	l3 = talloc_strdup(l2, "level 3");
+	torture_assert("memlimit", l3 == NULL,
+		"failed: alloc should fail due to memory limit\n");
+
+	talloc_report_full(root, stdout);
+
+	printf("==== talloc_free(l2)\n");
+	talloc_free(l2);
+
+	talloc_report_full(root, stdout);
+
+	printf("==== talloc_strdup(NULL, level 2)\n");
+	l2 = talloc_strdup(NULL, "level 2");
+	talloc_steal(l1, l2);
+
+	talloc_report_full(root, stdout);
+
+	printf("==== talloc_strdup(l2, level 3)\n");
+	l3 = talloc_strdup(l2, "level 3");
+	torture_assert("memlimit", l3 != NULL,
+		"failed: alloc should not fail due to memory limit\n");
+
+	talloc_report_full(root, stdout);
+
+	printf("==== talloc_set_memlimit(l3, 1024)\n");
+	torture_assert("memlimit", talloc_set_memlimit(l3, 1024) == 0,
+		"failed: setting memlimit should never fail\n");
+
+	talloc_report_full(root, stdout);
+
+	printf("==== talloc_strdup(l3, level 4)\n");
+	l4 = talloc_strdup(l3, "level 4");
+	torture_assert("memlimit", l4 != NULL,
+		"failed: alloc should not fail due to memory limit\n");
+
+	talloc_report_full(root, stdout);
+
+	printf("==== talloc_set_memlimit(l4, 512)\n");
+	torture_assert("memlimit", talloc_set_memlimit(l4, 512) == 0,
+		"failed: setting memlimit should never fail\n");
+
+	talloc_report_full(root, stdout);
+
+	printf("==== talloc_strdup(l4, level 5)\n");
+	l5 = talloc_strdup(l4, "level 5");
+	torture_assert("memlimit", l5 != NULL,
+		"failed: alloc should not fail due to memory limit\n");
+
+	talloc_report_full(root, stdout);
+
+	printf("==== talloc_realloc(NULL, l5, char, 600)\n");
+	t = talloc_realloc(NULL, l5, char, 600);
+	torture_assert("memlimit", t == NULL,
+		"failed: alloc should fail due to memory limit\n");
+
+	talloc_report_full(root, stdout);
+
+	printf("==== talloc_realloc(NULL, l5, char, 5)\n");
+	l5 = talloc_realloc(NULL, l5, char, 5);
+	torture_assert("memlimit", l5 != NULL,
+		"failed: alloc should not fail due to memory limit\n");
+
+	talloc_report_full(root, stdout);
+
+	printf("==== talloc_strdup(l3, level 4)\n");
+	l4 = talloc_strdup(l3, "level 4");
+	torture_assert("memlimit", l4 != NULL,
+		"failed: alloc should not fail due to memory limit\n");
+
+	talloc_report_full(root, stdout);
+
+	printf("==== talloc_set_memlimit(l4, 512)\n");
+	torture_assert("memlimit", talloc_set_memlimit(l4, 512) == 0,
+		"failed: setting memlimit should never fail\n");
+
+	talloc_report_full(root, stdout);
+
+	printf("==== talloc_strdup(l4, level 5)\n");
+	l5 = talloc_strdup(l4, "level 5");
+	torture_assert("memlimit", l5 != NULL,
+		"failed: alloc should not fail due to memory limit\n");
+
+	talloc_report_full(root, stdout);
+
+	printf("==== Make new temp context and steal l5\n");
+	t = talloc_new(root);
+	talloc_steal(t, l5);
+
+	talloc_report_full(root, stdout);
+
+	printf("==== talloc_size(t, 2048)\n");
+	l1 = talloc_size(t, 2048);
+	torture_assert("memlimit", l1 != NULL,
+		"failed: alloc should not fail due to memory limit\n");
+
+	talloc_report_full(root, stdout);
+	talloc_free(root);
+
+	/* Test memlimits with pools. */
+	pool = talloc_pool(NULL, 10*1024);
+	torture_assert("memlimit", pool != NULL,
+		"failed: alloc should not fail due to memory limit\n");
+	talloc_set_memlimit(pool, 10*1024);
+	for (i = 0; i < 9; i++) {
+		l1 = talloc_size(pool, 1024);
+		torture_assert("memlimit", l1 != NULL,
+			"failed: alloc should not fail due to memory limit\n");
+	}
+	/* The next alloc should fail. */
+	l2 = talloc_size(pool, 1024);
+	torture_assert("memlimit", l2 == NULL,
+			"failed: alloc should fail due to memory limit\n");
+
+	/* Moving one of the children shouldn't change the limit,
+	   as it's still inside the pool. */
+	root = talloc_new(NULL);
+	talloc_steal(root, l1);
+	l2 = talloc_size(pool, 1024);
+	torture_assert("memlimit", l2 == NULL,
+			"failed: alloc should fail due to memory limit\n");
+
+	talloc_free(pool);
+	talloc_free(root);
+	printf("success: memlimit\n");
+
+	return true;
+}
+
+/*
+  allocate 1k chunks from a context until its memory limit is reached,
+  after a sibling below the limit allocated and freed a lot of memory
+*/
+static int memlimit_credit_count(bool churn)
+{
+	void *root = talloc_new(NULL);
+	void *a, *b;
+	void *chunks[40];
+	int i, count;
+
+	talloc_set_memlimit(root, 64*1024);
+
+	/* five nested limits on each side */
+	a = b = root;
+	for (i = 0; i < 5; i++) {
+		a = talloc_new(a);
+		b = talloc_new(b);
+		talloc_set_memlimit(a, 0);
+		talloc_set_memlimit(b, (5 - i) * 1024*1024);
+	}
+
+	if (churn) {
+		for (i = 0; i < 40; i++) {
+			chunks[i] = talloc_size(b, 1024);
+		}
+		for (i = 0; i < 40; i++) {
+			talloc_free(chunks[i]);
+		}
+	}
+
+	for (count = 0; count < 100; count++) {
+		if (talloc_size(a, 1024) == NULL) {
+			break;
+		}
+	}
+
+	talloc_free(root);
+	return count;
+}
+
+static bool test_memlimit_credit(void)
+{
+	void *root, *l1, *l2, *p;
+	int count, count_churn;
+	int i;
+
+	printf("test: memlimit_credit\n# NESTED MEMORY LIMITS\n");
+
+	/* credit held by other limits never makes an allocation fail */
+	count = memlimit_credit_count(false);
+	count_churn = memlimit_credit_count(true);
+	torture_assert("memlimit_credit", count > 50 && count < 64,
+		       "failed: wrong number of allocations\n");
+	torture_assert("memlimit_credit", count_churn == count,
+		       "failed: credit of a sibling limit was not reclaimed\n");
+
+	/* a nested limit still enforces its own maximum exactly */
+	root = talloc_new(NULL);
+	l1 = talloc_new(root);
+	l2 = talloc_new(l1);
+	talloc_set_memlimit(root, 1024*1024);
+	talloc_set_memlimit(l1, 0);
+	talloc_set_memlimit(l2, 4096);
+
+	p = talloc_size(l2, 2048);
+	torture_assert("memlimit_credit", p != NULL,
+		"failed: alloc should not fail due to memory limit\n");
+	torture_assert("memlimit_credit", talloc_size(l2, 2048) == NULL,
+		"failed: alloc should fail due to memory limit\n");
+	talloc_free(p);
+	p = talloc_size(l2, 2048);
+	torture_assert("memlimit_credit", p != NULL,
+		"failed: alloc should not fail due to memory limit\n");
+
+	/* moving a nested limit takes its credit along */
+	talloc_steal(NULL, l2);
+	talloc_free(l1);
+	torture_assert("memlimit_credit", talloc_size(root, 1000*1024) != NULL,
+		"failed: alloc should not fail due to memory limit\n");
+	talloc_free(root);
+	talloc_free(l2);
+
+	/* credit is found through a limit that holds none itself */
+	root = talloc_new(NULL);
+	l1 = talloc_new(root);
+	l2 = talloc_new(talloc_new(l1));
+	talloc_set_memlimit(root, 64*1024);
+	talloc_set_memlimit(l1, 0);
+	talloc_set_memlimit(l2, 0);
+	talloc_free(talloc_size(l2, 1000));
+	torture_assert("memlimit_credit", talloc_size(root, 60*1024) != NULL,
+		"failed: credit of a nested limit was not reclaimed\n");
+	talloc_free(root);
+
+	/* the totals of a nested limit reach the limits above it */
+	root = talloc_new(NULL);
+	l1 = talloc_new(root);
+	l2 = talloc_new(l1);
+	talloc_enable_accounting(root);
+	talloc_enable_accounting(l1);
+	talloc_enable_accounting(l2);
+	for (i = 0; i < 100; i++) {
+		talloc_size(l2, 10);
+	}
+	talloc_free(talloc_size(l2, 5));
+	CHECK_SIZE("memlimit_credit", l2, 1000);
+	CHECK_SIZE("memlimit_credit", root, 1000);
+	CHECK_BLOCKS("memlimit_credit", root, 103);
+	talloc_steal(root, l2);
+	CHECK_SIZE("memlimit_credit", l1, 0);
+	CHECK_BLOCKS("memlimit_credit", l1, 1);
+	CHECK_SIZE("memlimit_credit", root, 1000);
+	talloc_free(talloc_size(l2, 5));
+	talloc_free(l2);
+	CHECK_SIZE("memlimit_credit", root, 0);
+	CHECK_BLOCKS("memlimit_credit", root, 2);
+	talloc_free(root);
+
+	/* refusing an allocation does not walk a deep tree */
+	root = talloc_new(NULL);
+	talloc_set_memlimit(root, 64*1024*1024);
+	p = root;
+	for (i = 0; i < 100000; i++) {
+		p = talloc_new(p);
+		torture_assert("memlimit_credit", p != NULL,
+			"failed: alloc should not fail due to memory limit\n");
+	}
+	for (i = 0; i < 100000; i++) {
+		torture_assert("memlimit_credit",
+			talloc_size(p, 64*1024*1024) == NULL,
+			"failed: alloc should fail due to memory limit\n");
+	}
+	talloc_free(root);
+
+	printf("success: memlimit_credit\n");
+	return true;
+}
+
+struct accounting_tree {
+	void *ctx;
+	void *sub;
+	void *pool;
+	void *arena;
+	void *slots[64];
+};
+
+static bool accounting_tree_init(struct accounting_tree *t, void *root)
+{
+	memset(t, 0, sizeof(*t));
+	t->ctx = talloc_new(root);
+	t->sub = talloc_new(t->ctx);
+	t->pool = talloc_pool(t->ctx, 4096);
+	t->arena = talloc_arena(t->ctx, 4096);
+	return t->ctx && t->sub && t->pool && t->arena;
+}
+
+static void accounting_step(struct accounting_tree *t, void *root,
+			    unsigned r)
+{
+	void *parents[] = { t->ctx, t->sub, t->pool, t->arena };
+	unsigned idx = r % 64;
+	void *p = t->slots[idx];
+	void *q;
+
+	r /= 64;
+
+	if (p == NULL) {
+		p = talloc_size(parents[r % 4], r % 200);
+		if (r & 4) {
+			talloc_strdup(p, "child");
+		}
+		t->slots[idx] = p;
+		return;
+	}
+
+	switch (r % 5) {
+	case 0:
+		talloc_unlink(talloc_parent(p), p);
+		t->slots[idx] = NULL;
+		break;
+	case 1:
+		q = talloc_realloc_size(NULL, p, 1 + (r / 5) % 300);
+		if (q != NULL) {
+			t->slots[idx] = q;
+		}
+		break;
+	case 2:
+		if (talloc_reference_count(p) == 0) {
+			talloc_steal(root, p);
+			talloc_steal(parents[(r / 5) % 4], p);
+		}
+		break;
+	case 3:
+		talloc_reference(parents[(r / 5) % 4], p);
+		break;
+	default:
+		talloc_free_children(p);
+		break;
+	}
+}
+
+struct accounting_totals {
+	size_t size;
+	size_t blocks;
+};
+
+static void accounting_walk_cb(const void *ptr, int depth, int max_depth,
+			       int is_ref, void *private_data)
+{
+	struct accounting_totals *totals = private_data;
+
+	if (depth == 0) {
+		totals->size += talloc_get_size(ptr);
+		totals->blocks += 1;
+	} else if (is_ref) {
+		totals->blocks += 1;
+	} else {
+		totals->size += talloc_total_size(ptr);
+		totals->blocks += talloc_total_blocks(ptr);
+	}
+}
+
+/* compare the counters of ctx against its direct children */
+static bool accounting_check(void *ctx)
+{
+	struct accounting_totals totals = { 0, 0 };
+
+	talloc_report_depth_cb(ctx, 0, 1, accounting_walk_cb, &totals);
+
+	torture_assert("accounting", talloc_total_size(ctx) == totals.size,
+		       "total size differs\n");
+	torture_assert("accounting", talloc_total_blocks(ctx) == totals.blocks,
+		       "total blocks differ\n");
+	return true;
+}
+
+static bool test_accounting(void)
+{
+	void *root = talloc_new(NULL);
+	struct accounting_tree t;
+	void *p;
+	int i;
+
+	printf("test: accounting\n# TALLOC ACCOUNTING\n");
+
+	torture_assert("accounting", accounting_tree_init(&t, root),
+		       "failed to create tree\n");
+
+	/* accounting on a tree that already has children */
+	torture_assert("accounting", talloc_enable_accounting(t.sub) == 0,
+		       "failed to enable accounting\n");
+	torture_assert("accounting", talloc_enable_accounting(t.ctx) == 0,
+		       "failed to enable accounting\n");
+	torture_assert("accounting", talloc_enable_accounting(t.ctx) == 0,
+		       "failed to enable accounting twice\n");
+	CHECK_SIZE("accounting", t.ctx, 0);
+	CHECK_BLOCKS("accounting", t.ctx, 4);
+
+	p = talloc_size(t.sub, 100);
+	CHECK_SIZE("accounting", t.sub, 100);
+	CHECK_SIZE("accounting", t.ctx, 100);
+	p = talloc_realloc_size(NULL, p, 50);
+	CHECK_SIZE("accounting", t.sub, 50);
+	talloc_steal(root, p);
+	CHECK_SIZE("accounting", t.sub, 0);
+	CHECK_BLOCKS("accounting", t.sub, 1);
+	talloc_steal(t.sub, p);
+	CHECK_SIZE("accounting", t.sub, 50);
+	CHECK_BLOCKS("accounting", t.sub, 2);
+	talloc_reference(t.sub, p);
+	CHECK_SIZE("accounting", t.sub, 50);
+	CHECK_BLOCKS("accounting", t.sub, 3);
+	talloc_unlink(t.sub, p);
+	talloc_free(p);
+	CHECK_SIZE("accounting", t.ctx, 0);
+	CHECK_BLOCKS("accounting", t.ctx, 4);
+
+	/* the counters must always match a walk of the tree */
+	srand(1);
+	for (i = 0; i < 20000; i++) {
+		accounting_step(&t, root, rand());
+
+		if (!accounting_check(t.ctx) || !accounting_check(t.sub)) {
+			return false;
+		}
+	}
+
+	talloc_free(root);
+
+	printf("success: accounting\n");
+	return true;
+}
+
+static bool test_strbuf(void)
+{
+	void *root;
+	char *s, *s2;
+	size_t i;
+
+	printf("test: strbuf\n# TALLOC STRING BUILDER\n");
+
+	root = talloc_new(NULL);
+
+	s = talloc_strbuf_new(root, 0);
+	torture_assert("strbuf", s != NULL, "talloc_strbuf_new failed\n");
+	torture_assert("strbuf", s[0] == '\0' && talloc_strbuf_len(s) == 0,
+		       "new string builder not empty\n");
+
+	s = talloc_strdup_append_buffer(s, "hello");
+	s = talloc_asprintf_append_buffer(s, " %s", "world");
+	s = talloc_strndup_append_buffer(s, ", hello", 3);
+	torture_assert("strbuf", strcmp(s, "hello world, h") == 0,
+		       "appending to a string builder failed\n");
+	torture_assert("strbuf", talloc_strbuf_len(s) == 14,
+		       "wrong string builder length\n");
+	torture_assert("strbuf", talloc_get_size(s) > 15,
+		       "string builder has no spare capacity\n");
+
+	/* the buffer variants append after embedded \0s */
+	s = talloc_asprintf_append_buffer(s, "%c", '\0');
+	s = talloc_strdup_append_buffer(s, "y");
+	torture_assert("strbuf", talloc_strbuf_len(s) == 16,
+		       "wrong string builder length\n");
+	torture_assert("strbuf", memcmp(s, "hello world, h\0y", 17) == 0,
+		       "appending after \\0 failed\n");
+	s = talloc_strdup_append(s, "z");
+	torture_assert("strbuf", strcmp(s, "hello world, hz") == 0,
+		       "talloc_strdup_append on a string builder failed\n");
+	torture_assert("strbuf", talloc_strbuf_len(s) == 15,
+		       "wrong string builder length\n");
+
+	for (i = 0; i < 10000; i++) {
+		s = talloc_asprintf_append_buffer(s, "%03zu", i % 1000);
+		torture_assert("strbuf", s != NULL, "append failed\n");
+	}
+	torture_assert("strbuf", talloc_strbuf_len(s) == 30015,
+		       "wrong string builder length\n");
+	torture_assert("strbuf", strlen(s) == 30015,
+		       "string builder not terminated\n");
+	torture_assert("strbuf", talloc_get_size(s) < 2 * 30016 + 64,
+		       "string builder grew too much\n");
+	torture_assert("strbuf", talloc_parent(s) == root,
+		       "string builder lost its parent\n");
+	CHECK_BLOCKS("strbuf", root, 2);
+
+	s = talloc_strbuf_finish(s);
+	torture_assert("strbuf", talloc_get_size(s) == 30016,
+		       "talloc_strbuf_finish did not shrink to fit\n");
+	torture_assert("strbuf", talloc_strbuf_len(s) == 30015,
+		       "wrong length after talloc_strbuf_finish\n");
+	torture_assert("strbuf", strncmp(s, "hello world, hz000001", 21) == 0,
+		       "wrong content after talloc_strbuf_finish\n");
+	torture_assert("strbuf", strcmp(s + 30012, "999") == 0,
+		       "wrong content after talloc_strbuf_finish\n");
+	torture_assert("strbuf", talloc_strbuf_finish(s) == s,
+		       "talloc_strbuf_finish on a plain string moved it\n");
+
+	/* a plain string appended to after finishing grows exactly */
+	s = talloc_strdup_append_buffer(s, "!");
+	torture_assert("strbuf", talloc_get_size(s) == 30017,
+		       "plain string did not grow exactly\n");
+	talloc_free(s);
+
+	/* opt an existing string into the amortized mode */
+	s2 = talloc_strdup(root, "abc");
+	s2 = talloc_strbuf(s2);
+	torture_assert("strbuf", s2 != NULL, "talloc_strbuf failed\n");
+	torture_assert("strbuf", talloc_strbuf(s2) == s2,
+		       "talloc_strbuf on a string builder moved it\n");
+	torture_assert("strbuf", talloc_strbuf_len(s2) == 3,
+		       "wrong length after talloc_strbuf\n");
+	s2 = talloc_strdup_append_buffer(s2, "def");
+	s2 = talloc_strbuf_finish(s2);
+	torture_assert("strbuf", strcmp(s2, "abcdef") == 0,
+		       "wrong content after talloc_strbuf\n");
+	CHECK_SIZE("strbuf", root, 7);
+
+	/* talloc_realloc() turns a string builder into a plain buffer */
+	s = talloc_strbuf_new(root, 0);
+	s = talloc_strdup_append(s, "abc");
+	s = talloc_realloc(root, s, char, 6);
+	torture_assert("strbuf", s != NULL, "talloc_realloc failed\n");
+	memcpy(s + 3, "de", 3);
+	torture_assert("strbuf", talloc_strbuf_len(s) == 5,
+		       "wrong length after talloc_realloc\n");
+	s = talloc_strdup_append_buffer(s, "f");
+	torture_assert("strbuf", strcmp(s, "abcdef") == 0,
+		       "appending after talloc_realloc failed\n");
+	torture_assert("strbuf", talloc_get_size(s) == 7,
+		       "plain buffer did not grow exactly\n");
+	s = talloc_strdup_append(s, "g");
+	torture_assert("strbuf", strcmp(s, "abcdefg") == 0,
+		       "appending after talloc_realloc failed\n");
+	talloc_free(s);
+
+	/* string builders count their capacity against memory limits */
+	torture_assert("strbuf", talloc_set_memlimit(root, 1000) == 0,
+		       "failed to set memlimit\n");
+	s = talloc_strbuf_new(root, 100);
+	torture_assert("strbuf", s != NULL, "talloc_strbuf_new failed\n");
+	for (i = 0; i < 1000; i++) {
+		s2 = talloc_strdup_append_buffer(s, "x");
+		if (s2 == NULL) {
+			break;
+		}
+		s = s2;
+	}
+	torture_assert("strbuf", i < 1000,
+		       "string builder exceeded the memory limit\n");
+	torture_assert("strbuf", talloc_strbuf_len(s) == i,
+		       "failed append changed the string builder\n");
+
+	talloc_free(root);
+
+	printf("success: strbuf\n");
+	return true;
+}
+
+static bool test_parent_links(void)
+{
+	void *root, *ctx, *other;
+	void *c[8];
+	char *name;
+	int i;
+
+	printf("test: parent_links\n# TALLOC PARENT LINKS\n");
+
+	root = talloc_new(NULL);
+	other = talloc_new(root);
+	ctx = talloc_size(root, 16);
+
+	for (i = 0; i < 4; i++) {
+		c[i] = talloc_size(ctx, 16);
+	}
+	torture_assert("parent_links", talloc_enable_parent_links(ctx) == 0,
+		       "failed to enable parent links\n");
+	for (i = 4; i < 8; i++) {
+		c[i] = talloc_size(ctx, 16);
+	}
+	torture_assert("parent_links", talloc_enable_parent_links(ctx) == 0,
+		       "enabling parent links twice failed\n");
+	for (i = 0; i < 8; i++) {
+		CHECK_PARENT("parent_links", c[i], ctx);
+	}
+
+	/* take children out of the middle and from the ends */
+	talloc_steal(other, c[3]);
+	talloc_free(c[5]);
+	talloc_steal(other, c[7]);
+	talloc_free(c[0]);
+	CHECK_PARENT("parent_links", c[3], other);
+	CHECK_PARENT("parent_links", c[7], other);
+	CHECK_PARENT("parent_links", c[1], ctx);
+	CHECK_PARENT("parent_links", c[2], ctx);
+	CHECK_PARENT("parent_links", c[4], ctx);
+	CHECK_PARENT("parent_links", c[6], ctx);
+	CHECK_BLOCKS("parent_links", ctx, 5);
+
+	talloc_steal(ctx, c[3]);
+	CHECK_PARENT("parent_links", c[3], ctx);
+	CHECK_PARENT("parent_links", c[6], ctx);
+	torture_assert("parent_links", talloc_is_parent(c[2], ctx),
+		       "talloc_is_parent failed\n");
+	torture_assert("parent_links", talloc_unlink(ctx, c[4]) == 0,
+		       "talloc_unlink failed\n");
+
+	/* children follow ctx when it moves */
+	ctx = talloc_realloc_size(root, ctx, 64 * 1024);
+	torture_assert("parent_links", ctx != NULL, "realloc failed\n");
+	CHECK_PARENT("parent_links", c[1], ctx);
+	CHECK_PARENT("parent_links", c[2], ctx);
+	CHECK_PARENT("parent_links", c[3], ctx);
+	CHECK_PARENT("parent_links", c[6], ctx);
+
+	/* the name survives talloc_free_children() */
+	talloc_set_name(ctx, "%s", "wide context");
+	talloc_free_children(ctx);
+	CHECK_BLOCKS("parent_links", ctx, 2);
+	name = talloc_size(ctx, 1);
+	CHECK_PARENT("parent_links", name, ctx);
+	torture_assert("parent_links",
+		       strcmp(talloc_get_name(ctx), "wide context") == 0,
+		       "name lost\n");
+
+	torture_assert("parent_links",
+		       talloc_enable_parent_links(NULL) == -1,
+		       "parent links on NULL should fail\n");
+
+	talloc_free(root);
+
+	printf("success: parent_links\n");
+	return true;
+}
+
+static bool test_reference_index(void)
+{
+	const int num_ctx = 5000;
+	const int num_null_refs = 40;
+	void *root, *shared;
+	void **ctx;
+	int *refs;
+	int *order;
+	size_t total;
+	int i;
+
+	printf("test: reference_index\n# TALLOC MANY REFERENCES\n");
+
+	root = talloc_new(NULL);
+	shared = talloc_named_const(root, 16, "shared");
+	ctx = talloc_array(root, void *, num_ctx);
+	refs = talloc_array(root, int, num_ctx);
+	order = talloc_array(root, int, num_ctx);
+	torture_assert("reference_index",
+		       ctx != NULL && refs != NULL && order != NULL,
+		       "allocation failed\n");
+
+	for (i = 0; i < num_ctx; i++) {
+		ctx[i] = talloc_named_const(root, 16, "ctx");
+		torture_assert("reference_index",
+			       talloc_reference(ctx[i], shared) == shared,
+			       "talloc_reference failed\n");
+		talloc_size(ctx[i], 8);
+		torture_assert("reference_index",
+			       talloc_reference(ctx[i], shared) == shared,
+			       "talloc_reference failed\n");
+		refs[i] = 2;
+	}
+	for (i = 0; i < num_null_refs; i++) {
+		torture_assert("reference_index",
+			       talloc_reference(NULL, shared) == shared,
+			       "talloc_reference failed\n");
+	}
+	total = 2 * num_ctx + num_null_refs;
+	torture_assert("reference_index",
+		       talloc_reference_count(shared) == total,
+		       "wrong reference count\n");
+
+	/* move references between contexts */
+	for (i = 3; i < num_ctx; i += 11) {
+		torture_assert("reference_index",
+			       talloc_reparent(ctx[i], ctx[i-1], shared) == shared,
+			       "talloc_reparent failed\n");
+		refs[i]--;
+		refs[i-1]++;
+	}
+
+	/* move contexts holding references */
+	for (i = 0; i < num_ctx; i += 7) {
+		ctx[i] = talloc_realloc_size(root, ctx[i], 4096);
+		torture_assert("reference_index", ctx[i] != NULL,
+			       "realloc failed\n");
+	}
+	for (i = 0; i < num_ctx; i += 7) {
+		torture_assert("reference_index",
+			       talloc_unlink(ctx[i], shared) == 0,
+			       "talloc_unlink after realloc failed\n");
+		refs[i]--;
+		total--;
+	}
+
+	/* the references of the null_context lose their parent */
+	for (i = 0; i < num_null_refs / 2; i++) {
+		torture_assert("reference_index",
+			       talloc_unlink(NULL, shared) == 0,
+			       "talloc_unlink failed\n");
+		total--;
+	}
+	talloc_disable_null_tracking();
+	for (i = 0; i < num_null_refs / 2; i++) {
+		torture_assert("reference_index",
+			       talloc_unlink(NULL, shared) == 0,
+			       "talloc_unlink failed\n");
+		total--;
+	}
+	torture_assert("reference_index", talloc_unlink(NULL, shared) == -1,
+		       "talloc_unlink of a missing reference succeeded\n");
+	talloc_enable_null_tracking_no_autofree();
+
+	/* an owner that moved before there was an index */
+	{
+		void *other = talloc_named_const(root, 16, "other");
+		void *owner = talloc_named_const(root, 16, "owner");
+
+		talloc_reference(owner, other);
+		owner = talloc_realloc_size(root, owner, 4096);
+		torture_assert("reference_index", owner != NULL,
+			       "realloc failed\n");
+		for (i = 0; i < 100; i++) {
+			talloc_reference(ctx[1], other);
+		}
+		torture_assert("reference_index",
+			       talloc_unlink(owner, other) == 0,
+			       "talloc_unlink of an older reference failed\n");
+		torture_assert("reference_index",
+			       talloc_reference_count(other) == 100,
+			       "wrong reference count\n");
+		talloc_free(owner);
+	}
+
+	srand(1);
+	for (i = 0; i < num_ctx; i++) {
+		order[i] = i;
+	}
+	for (i = num_ctx - 1; i > 0; i--) {
+		int j = rand() % (i + 1);
+		int tmp = order[i];
+		order[i] = order[j];
+		order[j] = tmp;
+	}
+
+	/* drop all but the references of the last context */
+	for (i = 0; i < num_ctx - 1; i++) {
+		int c = order[i];
+
+		if (c % 5 == 0) {
+			talloc_free(ctx[c]);
+			total -= refs[c];
+			continue;
+		}
+		while (refs[c] > 0) {
+			torture_assert("reference_index",
+				       talloc_unlink(ctx[c], shared) == 0,
+				       "talloc_unlink failed\n");
+			refs[c]--;
+			total--;
+		}
+		torture_assert("reference_index",
+			       talloc_unlink(ctx[c], shared) == -1,
+			       "talloc_unlink of a missing reference succeeded\n");
+		if (i % 100 == 0) {
+			torture_assert("reference_index",
+				       talloc_reference_count(shared) == total,
+				       "wrong reference count\n");
+		}
+	}
+	torture_assert("reference_index",
+		       talloc_reference_count(shared) == total &&
+		       total == refs[order[num_ctx - 1]],
+		       "wrong reference count\n");
+
+	/* unlinking the owner hands shared to the remaining reference */
+	CHECK_PARENT("reference_index", shared, root);
+	torture_assert("reference_index", talloc_unlink(root, shared) == 0,
+		       "talloc_unlink of the parent failed\n");
+	CHECK_PARENT("reference_index", shared, ctx[order[num_ctx - 1]]);
+	torture_assert("reference_index",
+		       talloc_reference_count(shared) == total - 1,
+		       "wrong reference count\n");
+
+	talloc_free(root);
+
+	printf("success: reference_index\n");
+	return true;
+}
+
+struct report_walk {
+	size_t count;
+	int max_depth;
+	const void *ptrs[64];
+	int depths[64];
+};
+
+static void report_walk_cb(const void *ptr, int depth, int max_depth,
+			   int is_ref, void *private_data)
+{
+	struct report_walk *w = (struct report_walk *)private_data;
+
+	if (w->count < 64) {
+		w->ptrs[w->count] = ptr;
+		w->depths[w->count] = is_ref ? -depth : depth;
+	}
+	if (depth > w->max_depth) {
+		w->max_depth = depth;
+	}
+	w->count++;
+}
+
+/*
+  tree
+    x
+      x2
+      x1
+    y
+*/
+struct report_tree {
+	void *tree, *x, *x1, *x2, *y;
+};
+
+static struct talloc_report_cursor *report_tree_start(struct report_tree *t,
+						       struct report_walk *w,
+						       size_t first)
+{
+	struct talloc_report_cursor *cursor;
+
+	t->tree = talloc_named_const(NULL, 0, "tree");
+	t->y = talloc_named_const(t->tree, 1, "y");
+	t->x = talloc_named_const(t->tree, 1, "x");
+	t->x1 = talloc_named_const(t->x, 1, "x1");
+	t->x2 = talloc_named_const(t->x, 1, "x2");
+
+	ZERO_STRUCTP(w);
+	cursor = talloc_report_cursor(NULL, t->tree, 0, -1);
+	if (cursor != NULL &&
+	    talloc_report_cursor_next(cursor, first, report_walk_cb,
+				      w) != first) {
+		talloc_free(cursor);
+		return NULL;
+	}
+	return cursor;
+}
+
+static void report_tree_finish(struct talloc_report_cursor *cursor,
+			       struct report_walk *w)
+{
+	while (talloc_report_cursor_next(cursor, 1, report_walk_cb, w) > 0) {
+	}
+	talloc_free(cursor);
+}
+
+static bool test_report_cursor_changes(void)
+{
+	struct talloc_report_cursor *cursor, *other;
+	struct report_tree t;
+	struct report_walk w, ow;
+	void *p;
+
+	printf("test: report_cursor_changes\n# TALLOC REPORT CURSOR CHANGES\n");
+
+	/* the chunk the cursor stands on is freed */
+	cursor = report_tree_start(&t, &w, 1);
+	torture_assert("report_cursor_changes", cursor != NULL,
+		       "failed to start the walk\n");
+	talloc_free(t.x);
+	report_tree_finish(cursor, &w);
+	torture_assert("report_cursor_changes",
+		       w.count == 2 && w.ptrs[1] == t.y && w.depths[1] == 1,
+		       "wrong chunks after freeing the cursor chunk\n");
+	talloc_free(t.tree);
+
+	/* a parent of the chunk the cursor stands on is freed */
+	cursor = report_tree_start(&t, &w, 2);
+	torture_assert("report_cursor_changes", cursor != NULL,
+		       "failed to start the walk\n");
+	talloc_free(t.x);
+	report_tree_finish(cursor, &w);
+	torture_assert("report_cursor_changes",
+		       w.count == 3 && w.ptrs[2] == t.y && w.depths[2] == 1,
+		       "wrong chunks after freeing a parent\n");
+	talloc_free(t.tree);
+
+	/* the children of a parent are freed */
+	cursor = report_tree_start(&t, &w, 3);
+	torture_assert("report_cursor_changes", cursor != NULL,
+		       "failed to start the walk\n");
+	talloc_free_children(t.x);
+	report_tree_finish(cursor, &w);
+	torture_assert("report_cursor_changes",
+		       w.count == 4 && w.ptrs[3] == t.y,
+		       "wrong chunks after freeing the children\n");
+	talloc_free(t.tree);
+
+	/* a parent of the chunk the cursor stands on is stolen */
+	cursor = report_tree_start(&t, &w, 2);
+	torture_assert("report_cursor_changes", cursor != NULL,
+		       "failed to start the walk\n");
+	talloc_steal(NULL, t.x);
+	report_tree_finish(cursor, &w);
+	torture_assert("report_cursor_changes",
+		       w.count == 3 && w.ptrs[2] == t.y,
+		       "wrong chunks after stealing a parent\n");
+	talloc_free(t.x);
+	talloc_free(t.tree);
+
+	/* the chunk the cursor stands on is moved by realloc */
+	cursor = report_tree_start(&t, &w, 2);
+	torture_assert("report_cursor_changes", cursor != NULL,
+		       "failed to start the walk\n");
+	p = talloc_realloc_size(NULL, t.x2, 100000);
+	torture_assert("report_cursor_changes", p != NULL,
+		       "talloc_realloc_size failed\n");
+	report_tree_finish(cursor, &w);
+	torture_assert("report_cursor_changes",
+		       w.count == 5 && w.ptrs[2] == p && w.ptrs[3] == t.x1,
+		       "wrong chunks after realloc\n");
+	talloc_free(t.tree);
+
+	/* the root of the walk is freed */
+	cursor = report_tree_start(&t, &w, 2);
+	torture_assert("report_cursor_changes", cursor != NULL,
+		       "failed to start the walk\n");
+	talloc_free(t.tree);
+	report_tree_finish(cursor, &w);
+	torture_assert("report_cursor_changes", w.count == 2,
+		       "chunks reported after freeing the root\n");
+
+	/* two cursors sharing a path */
+	cursor = report_tree_start(&t, &w, 3);
+	torture_assert("report_cursor_changes", cursor != NULL,
+		       "failed to start the walk\n");
+	ZERO_STRUCT(ow);
+	other = talloc_report_cursor(NULL, t.x, 1, -1);
+	torture_assert("report_cursor_changes",
+		       talloc_report_cursor_next(other, 1, report_walk_cb,
+						 &ow) == 1,
+		       "wrong batch\n");
+	talloc_free(t.x2);
+	talloc_free(t.x1);
+	report_tree_finish(cursor, &w);
+	report_tree_finish(other, &ow);
+	torture_assert("report_cursor_changes",
+		       w.count == 4 && w.ptrs[3] == t.y,
+		       "wrong chunks with two cursors\n");
+	torture_assert("report_cursor_changes",
+		       ow.count == 1 && ow.ptrs[0] == t.x,
+		       "wrong chunks for the second cursor\n");
+	talloc_free(t.tree);
+
+	printf("success: report_cursor_changes\n");
+	return true;
+}
+
+static bool test_report_cursor(void)
+{
+	const int deep = 200000;
+	void *root, *p, *a, *b, *shared;
+	struct talloc_report_cursor *cursor;
+	struct report_walk full, batched;
+	size_t n;
+	int i;
+
+	printf("test: report_cursor\n# TALLOC REPORT CURSOR\n");
+
+	root = talloc_named_const(NULL, 0, "root");
+	shared = talloc_named_const(NULL, 0, "shared");
+	a = talloc_named_const(root, 1, "a");
+	b = talloc_named_const(root, 2, "b");
+	for (i = 0; i < 10; i++) {
+		p = talloc_named_const(a, 3, "a child");
+		talloc_named_const(p, 4, "a grandchild");
+	}
+	talloc_reference(b, shared);
+	talloc_named_const(b, 5, "b child");
+
+	ZERO_STRUCT(full);
+	talloc_report_depth_cb(root, 0, -1, report_walk_cb, &full);
+	torture_assert("report_cursor", full.count == 25,
+		       "wrong number of chunks reported\n");
+	torture_assert("report_cursor", full.max_depth == 3,
+		       "wrong depth reported\n");
+
+	for (n = 1; n <= 26; n++) {
+		size_t got, total = 0;
+
+		ZERO_STRUCT(batched);
+		cursor = talloc_report_cursor(NULL, root, 0, -1);
+		torture_assert("report_cursor", cursor != NULL,
+			       "talloc_report_cursor failed\n");
+		do {
+			got = talloc_report_cursor_next(cursor, n,
+							report_walk_cb,
+							&batched);
+			torture_assert("report_cursor", got <= n,
+				       "batch too large\n");
+			total += got;
+		} while (got > 0);
+		torture_assert("report_cursor", total == full.count,
+			       "wrong number of chunks reported\n");
+		torture_assert("report_cursor",
+			       memcmp(full.ptrs, batched.ptrs,
+				      sizeof(full.ptrs)) == 0 &&
+			       memcmp(full.depths, batched.depths,
+				      sizeof(full.depths)) == 0,
+			       "batches differ from talloc_report_depth_cb\n");
+		torture_assert("report_cursor",
+			       talloc_report_cursor_next(cursor, n,
+							 report_walk_cb,
+							 &batched) == 0,
+			       "finished cursor reported more\n");
+		talloc_free(cursor);
+	}
+
+	/* max_depth is honoured */
+	ZERO_STRUCT(batched);
+	cursor = talloc_report_cursor(NULL, root, 0, 1);
+	while (talloc_report_cursor_next(cursor, 2, report_walk_cb,
+					 &batched) > 0) {
+	}
+	torture_assert("report_cursor", batched.count == 3,
+		       "max_depth not honoured\n");
+	talloc_free(cursor);
+
+	/* the tree may change outside the path of the cursor */
+	ZERO_STRUCT(batched);
+	cursor = talloc_report_cursor(NULL, root, 0, -1);
+	torture_assert("report_cursor",
+		       talloc_report_cursor_next(cursor, 3, report_walk_cb,
+						 &batched) == 3,
+		       "wrong batch\n");
+	torture_assert("report_cursor", batched.ptrs[1] == b,
+		       "wrong order\n");
+	talloc_free(a);
+	talloc_named_const(root, 6, "new child");
+	while (talloc_report_cursor_next(cursor, 3, report_walk_cb,
+					 &batched) > 0) {
+	}
+	torture_assert("report_cursor", batched.count == 4 &&
+		       batched.ptrs[3] == shared,
+		       "wrong chunks after changes\n");
+	talloc_free(cursor);
+
+	/* a chain deeper than the C stack would allow recursing into */
+	p = root;
+	for (i = 0; i < deep; i++) {
+		p = talloc_named_const(p, 1, "link");
+		torture_assert("report_cursor", p != NULL,
+			       "allocation failed\n");
+	}
+	ZERO_STRUCT(full);
+	talloc_report_depth_cb(root, 0, -1, report_walk_cb, &full);
+	torture_assert("report_cursor", full.max_depth == deep,
+		       "wrong depth reported\n");
+	torture_assert("report_cursor", full.count == deep + 5,
+		       "wrong number of chunks reported\n");
+	torture_assert("report_cursor",
+		       talloc_total_blocks(root) == deep + 5,
+		       "wrong talloc_total_blocks\n");
+	torture_assert("report_cursor",
+		       talloc_total_size(root) == deep + 13,
+		       "wrong talloc_total_size\n");
+
+	talloc_free(root);
+	talloc_free(shared);
+
+	printf("success: report_cursor\n");
+	return true;
+}
+
+static uint32_t snapshot_u32(const uint8_t *p)
+{
+	return p[0] | (p[1] << 8) | (p[2] << 16) | ((uint32_t)p[3] << 24);
+}
+
+static uint64_t snapshot_u64(const uint8_t *p)
+{
+	return snapshot_u32(p) | ((uint64_t)snapshot_u32(p + 4) << 32);
+}
+
+static int snapshot_destructor(void *ptr)
+{
+	return 0;
+}
+
+static bool test_report_binary(void)
+{
+	const char *node_name = "node";
+	void *root, *pool, *first = NULL, *p;
+	uint64_t ids[32], names[8];
+	size_t num_ids = 0, num_names = 0, num_refs = 0, total_size = 0;
+	size_t num_destructors = 0, num_pooled = 0;
+	uint8_t buf[4096];
+	size_t len, ofs, i;
+	FILE *f;
+	int j;
+
+	printf("test: report_binary\n# TALLOC REPORT BINARY\n");
+
+	root = talloc_named_const(NULL, 0, "root");
+	for (j = 0; j < 3; j++) {
+		p = talloc_named_const(root, 10, node_name);
+		talloc_named_const(p, 20, node_name);
+		if (first == NULL) {
+			first = p;
+		}
+	}
+	talloc_set_destructor(p, snapshot_destructor);
+	pool = talloc_pool(root, 1024);
+	talloc_named_const(pool, 30, "pooled");
+	talloc_named_const(pool, 40, "pooled");
+	talloc_reference(p, first);
+
+	f = tmpfile();
+	torture_assert("report_binary", f != NULL, "tmpfile failed\n");
+	torture_assert("report_binary", talloc_report_binary(root, f) == 0,
+		       "talloc_report_binary failed\n");
+	rewind(f);
+	len = fread(buf, 1, sizeof(buf), f);
+	fclose(f);
+
+	torture_assert("report_binary",
+		       len >= 16 && memcmp(buf, "TALLOCSN", 8) == 0 &&
+		       snapshot_u32(buf + 8) == 1,
+		       "bad snapshot header\n");
+
+	for (ofs = 16; ofs < len; ) {
+		uint32_t type, rlen;
+		const uint8_t *r;
+
+		torture_assert("report_binary", ofs + 8 <= len,
+			       "truncated record\n");
+		type = snapshot_u32(buf + ofs);
+		rlen = snapshot_u32(buf + ofs + 4);
+		r = buf + ofs + 8;
+		ofs += 8 + rlen;
+		torture_assert("report_binary", ofs <= len,
+			       "truncated record\n");
+
+		switch (type) {
+		case 1:
+			/* every name is written once */
+			for (i = 0; i < num_names; i++) {
+				torture_assert("report_binary",
+					       names[i] != snapshot_u64(r),
+					       "name written twice\n");
+			}
+			torture_assert("report_binary", num_names < 8,
+				       "too many names\n");
+			names[num_names++] = snapshot_u64(r);
+			break;
+		case 2: {
+			uint64_t parent = snapshot_u64(r + 8);
+			uint64_t name = snapshot_u64(r + 16);
+			uint32_t flags = snapshot_u32(r + 32);
+			bool found;
+
+			torture_assert("report_binary", rlen == 40,
+				       "bad chunk record\n");
+			if (num_ids == 0) {
+				torture_assert("report_binary",
+					       snapshot_u64(r) ==
+					       (uintptr_t)root &&
+					       parent == 0,
+					       "root must come first\n");
+			} else {
+				/* parents come before their children */
+				found = false;
+				for (i = 0; i < num_ids; i++) {
+					found |= ids[i] == parent;
+				}
+				torture_assert("report_binary", found,
+					       "unknown parent\n");
+			}
+			found = false;
+			for (i = 0; i < num_names; i++) {
+				found |= names[i] == name;
+			}
+			torture_assert("report_binary", found,
+				       "name not written before use\n");
+			if (snapshot_u64(r) == (uintptr_t)first) {
+				torture_assert("report_binary",
+					       snapshot_u32(r + 36) == 1,
+					       "wrong reference count\n");
+			}
+			torture_assert("report_binary", num_ids < 32,
+				       "too many chunks\n");
+			ids[num_ids++] = snapshot_u64(r);
+			total_size += snapshot_u64(r + 24);
+			num_destructors += (flags & 0x04) ? 1 : 0;
+			num_pooled += (flags & 0x02) ? 1 : 0;
+			break;
+		}
+		case 3:
+			torture_assert("report_binary",
+				       rlen == 24 &&
+				       snapshot_u64(r + 8) == (uintptr_t)p &&
+				       snapshot_u64(r + 16) ==
+				       (uintptr_t)first,
+				       "bad reference record\n");
+			num_refs++;
+			break;
+		default:
+			torture_assert("report_binary", false,
+				       "unknown record type\n");
+		}
+	}
+
+	torture_assert("report_binary",
+		       num_ids + num_refs == talloc_total_blocks(root),
+		       "wrong number of chunks\n");
+	torture_assert("report_binary",
+		       total_size == talloc_total_size(root),
+		       "wrong sizes\n");
+	torture_assert("report_binary", num_refs == 1,
+		       "wrong number of references\n");
+	/* root, node, pooled and the name of the pool */
+	torture_assert("report_binary", num_names == 4,
+		       "names not interned\n");
+	torture_assert("report_binary", num_destructors == 1 &&
+		       num_pooled == 2,
+		       "wrong flags\n");
+
+	talloc_free(root);
+
+	printf("success: report_binary\n");
+	return true;
+}
+
+static bool test_realloc_in_place(void)
+{
+	void *pool, *ctx, *child;
+	char *a, *b, *c, *p;
+	size_t i;
+
+	printf("test: realloc_in_place\n# TALLOC REALLOC IN PLACE\n");
+
+	pool = talloc_pool(NULL, 4096);
+
+	/* a pool member grows into the freed chunk behind it */
+	a = talloc_size(pool, 16);
+	b = talloc_size(pool, 200);
+	c = talloc_size(pool, 16);
+	memset(a, 'a', 16);
+	memset(c, 'c', 16);
+	talloc_free(b);
+
+	p = talloc_realloc(pool, a, char, 64);
+	torture_assert("realloc_in_place", p == a,
+		       "did not grow into the freed chunk\n");
+	memset(a + 16, 'a', 48);
+
+	/* ... and again into what is left of it */
+	p = talloc_realloc(pool, a, char, 128);
+	torture_assert("realloc_in_place", p == a,
+		       "did not grow into the rest of the freed chunk\n");
+	for (i = 0; i < 16; i++) {
+		torture_assert("realloc_in_place", a[i] == 'a' && c[i] == 'c',
+			       "contents changed\n");
+	}
+
+	/* a live chunk behind it is not touched */
+	p = talloc_realloc(pool, a, char, 1024);
+	torture_assert("realloc_in_place", p != NULL && p != a,
+		       "grew over a live chunk\n");
+	a = p;
+	for (i = 0; i < 16; i++) {
+		torture_assert("realloc_in_place", a[i] == 'a' && c[i] == 'c',
+			       "contents changed\n");
+	}
+
+	/* the last chunk grows over freed chunks into the space left */
+	b = talloc_size(pool, 32);
+	p = talloc_size(pool, 32);
+	talloc_free(b);
+	talloc_free(p);
+	p = talloc_realloc(pool, a, char, 1500);
+	torture_assert("realloc_in_place", p == a,
+		       "did not grow into the space left\n");
+
+	/* a member shrunk in place does not grow over its gap */
+	b = talloc_size(c, 500);
+	talloc_size(pool, 16);
+	p = talloc_realloc(c, b, char, 10);
+	torture_assert("realloc_in_place", p == b, "did not shrink\n");
+	p = talloc_realloc(c, b, char, 400);
+	torture_assert("realloc_in_place", p != NULL && p != b,
+		       "grew over its gap\n");
+	CHECK_BLOCKS("realloc_in_place", pool, 5);
+
+	talloc_free(pool);
+
+	/* chunks in memory mappings */
+	if (talloc_set_mmap_threshold(64 * 1024) != 0) {
+		printf("success: realloc_in_place\n");
+		return true;
+	}
+
+	ctx = talloc_new(NULL);
+	p = talloc_size(ctx, 100000);
+	torture_assert("realloc_in_place", p != NULL, "allocation failed\n");
+	child = talloc_size(p, 10);
+	for (i = 0; i < 100000; i++) {
+		p[i] = i & 0xff;
+	}
+	p = talloc_realloc(ctx, p, char, 10 * 1024 * 1024);
+	torture_assert("realloc_in_place", p != NULL, "realloc failed\n");
+	p[10 * 1024 * 1024 - 1] = 1;
+	p = talloc_realloc(ctx, p, char, 100001);
+	torture_assert("realloc_in_place", p != NULL, "realloc failed\n");
+	p = talloc_realloc(ctx, p, char, 100002);
+	torture_assert("realloc_in_place", p != NULL, "realloc failed\n");
+	for (i = 0; i < 100000; i++) {
+		torture_assert("realloc_in_place", p[i] == (char)(i & 0xff),
+			       "contents changed\n");
+	}
+	torture_assert("realloc_in_place", talloc_parent(child) == p,
+		       "child lost its parent\n");
+	CHECK_SIZE("realloc_in_place", ctx, 100012);
+
+	/* a chunk from malloc(3) moves into a mapping */
+	b = talloc_size(ctx, 1000);
+	memset(b, 'b', 1000);
+	b = talloc_realloc(ctx, b, char, 1000000);
+	torture_assert("realloc_in_place", b != NULL, "realloc failed\n");
+	for (i = 0; i < 1000; i++) {
+		torture_assert("realloc_in_place", b[i] == 'b',
+			       "contents changed\n");
+	}
+	CHECK_SIZE("realloc_in_place", ctx, 1100012);
+
+	/* memory limits see the mappings */
+	torture_assert("realloc_in_place",
+		       talloc_set_memlimit(ctx, 2000000) == 0,
+		       "talloc_set_memlimit failed\n");
+	a = talloc_size(ctx, 200000);
+	torture_assert("realloc_in_place", a != NULL, "allocation failed\n");
+	torture_assert("realloc_in_place",
+		       talloc_realloc(ctx, a, char, 1000000) == NULL,
+		       "memory limit not honoured\n");
+	talloc_free(b);
+	a = talloc_realloc(ctx, a, char, 1000000);
+	torture_assert("realloc_in_place", a != NULL, "realloc failed\n");
+
+	talloc_free(ctx);
+	talloc_set_mmap_threshold(0);
+
+	printf("success: realloc_in_place\n");
+	return true;
+}
+
+static bool test_sampling(void)
+{
+	const unsigned loop = 100000;
+	struct talloc_sample samples[4];
+	const char *small_site, *large_site;
+	void *ctx = talloc_new(NULL);
+	void *pool;
+	size_t n, i;
+	unsigned j;
+
+	printf("test: sampling\n# TALLOC SAMPLING PROFILER\n");
+
+	talloc_sample_reset();
+	talloc_enable_sampling(4096);
+
+	for (j = 0; j < loop; j++) {
+		void *small = talloc_size(ctx, 100);
+		void *large = talloc_zero_size(ctx, 1000);
+
+		small_site = talloc_get_name(small);
+		large_site = talloc_get_name(large);
+		talloc_free(small);
+		talloc_free(large);
+	}
+	/* strings are not sampled, nor are they formatted in a pool */
+	for (j = 0; j < 1000; j++) {
+		talloc_free(talloc_asprintf(ctx, "%0*u", 1000, j));
+	}
+	pool = talloc_pool(ctx, 4096);
+	for (j = 0; j < 1000; j++) {
+		talloc_free(talloc_asprintf(pool, "%0*u", 1000, j));
+	}
+	talloc_free(pool);
+
+	talloc_disable_sampling();
+	for (j = 0; j < loop; j++) {
+		talloc_free(talloc_size(ctx, 100));
+	}
 
-	printf("==== talloc_strdup(l2, level 3)\n");
-	l3 = talloc_strdup(l2, "level 3");
-	torture_assert("memlimit", l3 == NULL,
-		"failed: alloc should fail due to memory limit\n");
+	n = talloc_sample_report(samples, 4);
+	torture_assert("sampling", n == 2, "wrong number of sites\n");
+	torture_assert("sampling",
+		       samples[0].location == large_site &&
+		       samples[1].location == small_site,
+		       "sites not ordered by bytes\n");
+	for (i = 0; i < 2; i++) {
+		size_t size = i == 0 ? 1000 : 100;
+
+		/* about 1% off on average with this many samples */
+		torture_assert("sampling",
+			       samples[i].samples > 0 &&
+			       samples[i].samples < loop,
+			       "wrong number of samples\n");
+		torture_assert("sampling",
+			       samples[i].bytes > loop * size * 9 / 10 &&
+			       samples[i].bytes < loop * size * 11 / 10,
+			       "bytes estimate too far off\n");
+		torture_assert("sampling",
+			       samples[i].count > loop * 9 / 10 &&
+			       samples[i].count < loop * 11 / 10,
+			       "count estimate too far off\n");
+	}
 
-	talloc_report_full(root, stdout);
+	talloc_sample_reset();
+	torture_assert("sampling", talloc_sample_report(NULL, 0) == 0,
+		       "reset did not clear the samples\n");
 
-	printf("==== talloc_free(l2)\n");
-	talloc_free(l2);
+	/* the children of an arena are sampled too */
+	pool = talloc_arena(ctx, 1024*1024);
+	torture_assert("sampling", pool != NULL, "talloc_arena failed\n");
+	talloc_enable_sampling(4096);
+	for (j = 0; j < 1000; j++) {
+		small_site = talloc_get_name(talloc_size(pool, 100));
+	}
+	talloc_disable_sampling();
+	n = talloc_sample_report(samples, 4);
+	torture_assert("sampling",
+		       n == 1 && samples[0].location == small_site &&
+		       samples[0].samples > 0,
+		       "arena children not sampled\n");
+	talloc_sample_reset();
+
+	/* a talloc_realloc() that is refused is not sampled */
+	talloc_enable_sampling(1);
+	torture_assert("sampling", talloc_realloc_size(ctx, pool, 100) == NULL,
+		       "talloc_realloc of an arena succeeded\n");
+	talloc_disable_sampling();
+	torture_assert("sampling", talloc_sample_report(NULL, 0) == 0,
+		       "refused talloc_realloc sampled\n");
 
-	talloc_report_full(root, stdout);
+	talloc_free(ctx);
 
-	printf("==== talloc_strdup(NULL, level 2)\n");
-	l2 = talloc_strdup(NULL, "level 2");
-	talloc_steal(l1, l2);
+	printf("success: sampling\n");
+	return true;
+}
 
-	talloc_report_full(root, stdout);
+static bool test_type_registry(void)
+{
+	/* the same names as another module's string literals would be */
+	static const char foo_name[] = "struct type_registry_foo";
+	static const char foo_copy[] = "struct type_registry_foo";
+	static const char bar_name[] = "struct type_registry_bar";
+	void *ctx = talloc_new(NULL);
+	void *foo, *bar;
+
+	printf("test: type_registry\n# TALLOC TYPE REGISTRY\n");
+
+	foo = talloc_named_const(ctx, 10, foo_name);
+	bar = talloc_named_const(ctx, 10, bar_name);
+
+	torture_assert("type_registry",
+		       talloc_get_type(foo, struct type_registry_foo) == foo,
+		       "unregistered name did not match\n");
+
+	torture_assert("type_registry",
+		       talloc_register_type_name(foo_name) == 0 &&
+		       talloc_register_type_name(bar_name) == 0,
+		       "registering failed\n");
+	torture_assert("type_registry",
+		       talloc_register_type_name(foo_name) == 0,
+		       "registering twice failed\n");
+
+	/* one side registered */
+	torture_assert("type_registry",
+		       talloc_get_type(foo, struct type_registry_foo) == foo,
+		       "registered name did not match a literal\n");
+	torture_assert("type_registry",
+		       talloc_check_name(foo, foo_copy) == foo,
+		       "registered name did not match a copy\n");
+
+	/* both sides registered */
+	torture_assert("type_registry",
+		       talloc_register_type(struct type_registry_foo) == 0 &&
+		       talloc_register_type_name(foo_copy) == 0,
+		       "registering failed\n");
+	torture_assert("type_registry",
+		       talloc_get_type(foo, struct type_registry_foo) == foo &&
+		       talloc_get_type_abort(foo, struct type_registry_foo) == foo &&
+		       talloc_check_name(foo, foo_copy) == foo,
+		       "registered names did not match\n");
+	torture_assert("type_registry",
+		       talloc_check_name(foo, bar_name) == NULL &&
+		       talloc_check_name(bar, foo_copy) == NULL &&
+		       talloc_get_type(bar, struct type_registry_foo) == NULL,
+		       "different registered names matched\n");
+	torture_assert("type_registry",
+		       talloc_check_name(foo, "struct type_registry") == NULL &&
+		       talloc_check_name(bar, "struct type_registry_bar") == bar,
+		       "registered name against a literal\n");
+
+	torture_assert("type_registry",
+		       talloc_register_type_name(NULL) == -1 &&
+		       errno == EINVAL,
+		       "registered NULL\n");
 
-	printf("==== talloc_strdup(l2, level 3)\n");
-	l3 = talloc_strdup(l2, "level 3");
-	torture_assert("memlimit", l3 != NULL,
-		"failed: alloc should not fail due to memory limit\n");
+	talloc_free(ctx);
 
-	talloc_report_full(root, stdout);
+	printf("success: type_registry\n");
+	return true;
+}
 
-	printf("==== talloc_set_memlimit(l3, 1024)\n");
-	torture_assert("memlimit", talloc_set_memlimit(l3, 1024) == 0,
-		"failed: setting memlimit should never fail\n");
+static bool test_pool_hugepages(void)
+{
+	const size_t hugepage = 2 * 1024 * 1024;
+	void *ctx = talloc_new(NULL);
+	struct talloc_pool_stats stats;
+	void *pool, *small, *p, *obj;
+	char *buf;
+	unsigned i;
 
-	talloc_report_full(root, stdout);
+	printf("test: pool_hugepages\n# TALLOC POOLS ON HUGEPAGES\n");
 
-	printf("==== talloc_strdup(l3, level 4)\n");
-	l4 = talloc_strdup(l3, "level 4");
-	torture_assert("memlimit", l4 != NULL,
-		"failed: alloc should not fail due to memory limit\n");
+	if (talloc_set_pool_hugepage_threshold(4 * 1024 * 1024) != 0) {
+		printf("success: pool_hugepages\n");
+		return true;
+	}
 
-	talloc_report_full(root, stdout);
+	pool = talloc_pool(ctx, 8 * 1024 * 1024);
+	small = talloc_pool(ctx, 1024 * 1024);
+	torture_assert("pool_hugepages", pool != NULL && small != NULL,
+		       "pool failed\n");
+	/* the pool header starts the aligned mapping */
+	torture_assert("pool_hugepages",
+		       ((uintptr_t)pool & (hugepage - 1)) < 4096,
+		       "pool not aligned to a hugepage\n");
+	CHECK_BLOCKS("pool_hugepages", pool, 1);
+
+	for (i = 0; i < 1000; i++) {
+		buf = talloc_array(pool, char, 8000);
+		torture_assert("pool_hugepages", buf != NULL, "alloc failed\n");
+		memset(buf, i, 8000);
+	}
+	CHECK_BLOCKS("pool_hugepages", pool, 1001);
+	torture_assert("pool_hugepages", talloc_pool_stats(pool, &stats) == 0 &&
+		       stats.size == 8 * 1024 * 1024,
+		       "wrong pool size\n");
+
+	/* the mapping outlives the pool chunk while objects are left */
+	p = talloc_size(pool, 100);
+	talloc_steal(ctx, p);
+	talloc_free(pool);
+	memset(p, 0, 100);
+	talloc_free(p);
 
-	printf("==== talloc_set_memlimit(l4, 512)\n");
-	torture_assert("memlimit", talloc_set_memlimit(l4, 512) == 0,
-		"failed: setting memlimit should never fail\n");
+	obj = talloc_pooled_object(ctx, struct pool_node, 1000, 8 * 1024 * 1000);
+	torture_assert("pool_hugepages", obj != NULL, "pooled object failed\n");
+	torture_assert("pool_hugepages",
+		       ((uintptr_t)obj & (hugepage - 1)) < 4096,
+		       "pooled object not aligned to a hugepage\n");
+	for (i = 0; i < 1000; i++) {
+		torture_assert("pool_hugepages",
+			       talloc_size(obj, 8 * 1024) != NULL,
+			       "alloc failed\n");
+	}
+	CHECK_BLOCKS("pool_hugepages", obj, 1001);
+
+	/* growable pools put their large slabs on hugepages too */
+	pool = talloc_growable_pool(ctx, 1024 * 1024, 64 * 1024 * 1024);
+	torture_assert("pool_hugepages", pool != NULL, "pool failed\n");
+	for (i = 0; i < 2000; i++) {
+		buf = talloc_array(pool, char, 8000);
+		torture_assert("pool_hugepages", buf != NULL, "alloc failed\n");
+		memset(buf, i, 8000);
+	}
+	torture_assert("pool_hugepages", talloc_pool_stats(pool, &stats) == 0 &&
+		       stats.num_slabs > 1 && stats.fallbacks == 0,
+		       "pool did not grow\n");
 
-	talloc_report_full(root, stdout);
+	torture_assert("pool_hugepages",
+		       talloc_set_pool_hugepage_threshold(0) == 0,
+		       "disabling failed\n");
 
-	printf("==== talloc_strdup(l4, level 5)\n");
-	l5 = talloc_strdup(l4, "level 5");
-	torture_assert("memlimit", l5 != NULL,
-		"failed: alloc should not fail due to memory limit\n");
+	talloc_free(ctx);
 
-	talloc_report_full(root, stdout);
+	printf("success: pool_hugepages\n");
+	return true;
+}
 
-	printf("==== talloc_realloc(NULL, l5, char, 600)\n");
-	t = talloc_realloc(NULL, l5, char, 600);
-	torture_assert("memlimit", t == NULL,
-		"failed: alloc should fail due to memory limit\n");
+static int chunk_destructor_count;
 
-	talloc_report_full(root, stdout);
+static int chunk_destructor(int *ptr)
+{
+	chunk_destructor_count++;
+	return 0;
+}
 
-	printf("==== talloc_realloc(NULL, l5, char, 5)\n");
-	l5 = talloc_realloc(NULL, l5, char, 5);
-	torture_assert("memlimit", l5 != NULL,
-		"failed: alloc should not fail due to memory limit\n");
+static bool test_array_of_chunks(void)
+{
+	const unsigned num = 100;
+	void *root = talloc_new(NULL);
+	void *ctx, *other;
+	int **chunks;
+	unsigned i;
+
+	printf("test: array_of_chunks\n# TALLOC ARRAY OF CHUNKS\n");
+
+	ctx = talloc_new(root);
+	other = talloc_new(root);
+
+	chunks = talloc_array_of_chunks(ctx, int, num);
+	torture_assert("array_of_chunks", chunks != NULL, "alloc failed\n");
+	torture_assert("array_of_chunks", talloc_array_length(chunks) == num,
+		       "wrong array length\n");
+	CHECK_BLOCKS("array_of_chunks", ctx, num + 2);
+	CHECK_SIZE("array_of_chunks", ctx,
+		   (unsigned)(num * (sizeof(int) + sizeof(int *))));
+
+	for (i = 0; i < num; i++) {
+		torture_assert("array_of_chunks",
+			       talloc_get_type(chunks[i], int) == chunks[i],
+			       "wrong chunk name\n");
+		CHECK_PARENT("array_of_chunks", chunks[i], ctx);
+		*chunks[i] = i;
+	}
 
-	talloc_report_full(root, stdout);
+	/* every chunk is on its own */
+	talloc_set_destructor(chunks[0], chunk_destructor);
+	talloc_steal(other, chunks[1]);
+	talloc_free(chunks[2]);
+	CHECK_PARENT("array_of_chunks", chunks[1], other);
+	torture_assert("array_of_chunks",
+		       talloc_realloc(ctx, chunks[3], int, 1000) != NULL,
+		       "realloc failed\n");
+	talloc_free(chunks);
+	CHECK_BLOCKS("array_of_chunks", ctx, num - 2 + 1);
+
+	/* the block outlives the parent */
+	chunk_destructor_count = 0;
+	talloc_free(ctx);
+	torture_assert("array_of_chunks", chunk_destructor_count == 1,
+		       "destructor not called\n");
+	CHECK_BLOCKS("array_of_chunks", other, 2);
+	talloc_free(other);
+
+	/* plain children, freed with the fast path, release the block */
+	ctx = talloc_new(root);
+	chunks = talloc_array_of_chunks(ctx, int, num);
+	torture_assert("array_of_chunks", chunks != NULL, "alloc failed\n");
+	talloc_free_children(ctx);
+	CHECK_BLOCKS("array_of_chunks", ctx, 1);
+	chunks = talloc_array_of_chunks(ctx, int, num);
+	torture_assert("array_of_chunks", chunks != NULL, "alloc failed\n");
+	talloc_free(ctx);
 
-	printf("==== talloc_strdup(l3, level 4)\n");
-	l4 = talloc_strdup(l3, "level 4");
-	torture_assert("memlimit", l4 != NULL,
-		"failed: alloc should not fail due to memory limit\n");
+	/* the whole block counts against a memory limit */
+	ctx = talloc_new(root);
+	talloc_set_memlimit(ctx, 1000);
+	torture_assert("array_of_chunks",
+		       talloc_array_of_chunks(ctx, int, num) == NULL,
+		       "memory limit not applied\n");
+	talloc_set_memlimit(ctx, 100000);
+	chunks = talloc_array_of_chunks(ctx, int, num);
+	torture_assert("array_of_chunks", chunks != NULL, "alloc failed\n");
+	talloc_free(chunks[0]);
+	talloc_free(chunks);
+	CHECK_SIZE("array_of_chunks", ctx, (unsigned)((num - 1) * sizeof(int)));
+	talloc_free(ctx);
 
-	talloc_report_full(root, stdout);
+	/* under a pool they come from the pool */
+	ctx = talloc_pool(root, 4096);
+	chunks = talloc_array_of_chunks(ctx, int, 10);
+	torture_assert("array_of_chunks", chunks != NULL, "alloc failed\n");
+	CHECK_BLOCKS("array_of_chunks", ctx, 12);
 
-	printf("==== talloc_set_memlimit(l4, 512)\n");
-	torture_assert("memlimit", talloc_set_memlimit(l4, 512) == 0,
-		"failed: setting memlimit should never fail\n");
+	torture_assert("array_of_chunks",
+		       talloc_array_of_chunks(root, int, 0) != NULL,
+		       "empty array failed\n");
+	torture_assert("array_of_chunks",
+		       talloc_array_of_chunks(root, char, UINT_MAX / 2) == NULL,
+		       "overflow not detected\n");
 
-	talloc_report_full(root, stdout);
+	talloc_free(root);
 
-	printf("==== talloc_strdup(l4, level 5)\n");
-	l5 = talloc_strdup(l4, "level 5");
-	torture_assert("memlimit", l5 != NULL,
-		"failed: alloc should not fail due to memory limit\n");
+	printf("success: array_of_chunks\n");
+	return true;
+}
 
-	talloc_report_full(root, stdout);
+static int deferred_calls;
+static int deferred_executor_calls;
 
-	printf("==== Make new temp context and steal l5\n");
-	t = talloc_new(root);
-	talloc_steal(t, l5);
+static int deferred_destructor(char *ptr)
+{
+	deferred_calls++;
+	return 0;
+}
 
-	talloc_report_full(root, stdout);
+static int deferred_refuse(char *ptr)
+{
+	deferred_calls++;
+	return -1;
+}
 
-	printf("==== talloc_size(t, 2048)\n");
-	l1 = talloc_size(t, 2048);
-	torture_assert("memlimit", l1 != NULL,
-		"failed: alloc should not fail due to memory limit\n");
+static void deferred_executor(void *private_data)
+{
+	int *calls = (int *)private_data;
 
-	talloc_report_full(root, stdout);
-	talloc_free(root);
+	(*calls)++;
+}
 
-	/* Test memlimits with pools. */
-	pool = talloc_pool(NULL, 10*1024);
-	torture_assert("memlimit", pool != NULL,
-		"failed: alloc should not fail due to memory limit\n");
-	talloc_set_memlimit(pool, 10*1024);
-	for (i = 0; i < 9; i++) {
-		l1 = talloc_size(pool, 1024);
-		torture_assert("memlimit", l1 != NULL,
-			"failed: alloc should not fail due to memory limit\n");
-	}
-	/* The next alloc should fail. */
-	l2 = talloc_size(pool, 1024);
-	torture_assert("memlimit", l2 == NULL,
-			"failed: alloc should fail due to memory limit\n");
+static bool test_deferred_destructor(void)
+{
+	void *root = talloc_new(NULL);
+	void *ctx, *limited;
+	char *d, *c, *g, *p;
+
+	printf("test: deferred_destructor\n# TALLOC DEFERRED DESTRUCTORS\n");
+
+	deferred_calls = 0;
+	deferred_executor_calls = 0;
+	talloc_set_deferred_executor(deferred_executor,
+				     &deferred_executor_calls);
+
+	ctx = talloc_named_const(root, 0, "ctx");
+	d = talloc_named_const(ctx, 100, "d");
+	c = talloc_named_const(d, 100, "c");
+	g = talloc_named_const(c, 100, "g");
+	talloc_set_deferred_destructor(d, deferred_destructor);
+	talloc_set_destructor(c, deferred_destructor);
+	talloc_set_deferred_destructor(g, deferred_destructor);
+	talloc_named_const(ctx, 10, "other");
+
+	/* the subtree of d leaves the tree, nothing runs yet */
+	torture_assert("deferred_destructor", talloc_free(ctx) == 0,
+		       "free failed\n");
+	torture_assert("deferred_destructor", deferred_calls == 0,
+		       "destructor ran from talloc_free()\n");
+	torture_assert("deferred_destructor", deferred_executor_calls == 1,
+		       "executor not called\n");
+	CHECK_BLOCKS("deferred_destructor", root, 1);
+	CHECK_BLOCKS("deferred_destructor", d, 3);
+	torture_assert("deferred_destructor", talloc_parent(d) == NULL,
+		       "queued chunk still has a parent\n");
+
+	/* g is queued again when d is freed and run by the same call */
+	torture_assert("deferred_destructor", talloc_run_deferred() == 2,
+		       "wrong number of chunks freed\n");
+	torture_assert("deferred_destructor", deferred_calls == 3,
+		       "destructors not run\n");
+	torture_assert("deferred_destructor", deferred_executor_calls == 2,
+		       "executor not called for the requeued chunk\n");
+	torture_assert("deferred_destructor", talloc_run_deferred() == 0,
+		       "queue not empty\n");
+
+	/* a queued chunk no longer counts against a memory limit */
+	limited = talloc_new(root);
+	talloc_set_memlimit(limited, 1000);
+	d = talloc_size(limited, 800);
+	torture_assert("deferred_destructor", d != NULL, "alloc failed\n");
+	talloc_set_deferred_destructor(d, deferred_destructor);
+	torture_assert("deferred_destructor",
+		       talloc_size(limited, 800) == NULL,
+		       "memory limit not applied\n");
+	talloc_free(d);
+	torture_assert("deferred_destructor",
+		       talloc_size(limited, 800) != NULL,
+		       "queued chunk still counted\n");
+	talloc_free(limited);
+	torture_assert("deferred_destructor", talloc_run_deferred() == 1,
+		       "wrong number of chunks freed\n");
+
+	/* a failing destructor leaves the chunk without a parent */
+	deferred_calls = 0;
+	d = talloc_named_const(root, 100, "refuse");
+	talloc_set_deferred_destructor(d, deferred_refuse);
+	talloc_free(d);
+	torture_assert("deferred_destructor", talloc_run_deferred() == 0 &&
+		       deferred_calls == 1,
+		       "failing destructor not run\n");
+	torture_assert("deferred_destructor", talloc_parent(d) == NULL,
+		       "refused chunk has a parent\n");
+	talloc_set_destructor(d, NULL);
+	talloc_free(d);
+
+	/* talloc_set_destructor() makes it run right away again */
+	p = talloc_named_const(root, 100, "p");
+	talloc_set_deferred_destructor(p, deferred_destructor);
+	talloc_set_destructor(p, deferred_destructor);
+	talloc_free(p);
+	torture_assert("deferred_destructor", deferred_calls == 2,
+		       "destructor not run right away\n");
 
-	/* Moving one of the children shouldn't change the limit,
-	   as it's still inside the pool. */
-	root = talloc_new(NULL);
-	talloc_steal(root, l1);
-	l2 = talloc_size(pool, 1024);
-	torture_assert("memlimit", l2 == NULL,
-			"failed: alloc should fail due to memory limit\n");
+	talloc_set_deferred_executor(NULL, NULL);
+	torture_assert("deferred_destructor", talloc_run_deferred() == 0,
+		       "queue not empty\n");
 
-	talloc_free(pool);
 	talloc_free(root);
-	printf("success: memlimit\n");
 
+	printf("success: deferred_destructor\n");
 	return true;
 }
 
@@ -1934,6 +4604,242 @@ static bool test_pthread_talloc_passing(void)
 	printf("success: pthread_talloc_passing\n");
 	return true;
 }
+
+#define TS_NUM_THREADS 8
+#define TS_NUM_SLOTS 16
+
+static void *threadsafe_fn(void *arg)
+{
+	void *ctx = arg;
+	void *own = talloc_new(NULL);
+	void *slots[TS_NUM_SLOTS] = { NULL };
+	unsigned seed = (unsigned)pthread_self();
+	int i;
+
+	for (i = 0; i < 20000; i++) {
+		int idx = rand_r(&seed) % TS_NUM_SLOTS;
+		void *p = slots[idx];
+
+		if (p == NULL) {
+			slots[idx] = talloc_size(ctx, 16);
+			continue;
+		}
+		if (talloc_parent(p) != ctx) {
+			return NULL;
+		}
+		switch (rand_r(&seed) % 4) {
+		case 0:
+			talloc_free(p);
+			slots[idx] = NULL;
+			break;
+		case 1:
+			slots[idx] = talloc_realloc_size(ctx, p, 16 + rand_r(&seed) % 2048);
+			break;
+		case 2:
+			talloc_steal(own, p);
+			talloc_steal(ctx, p);
+			break;
+		default:
+			talloc_strdup(p, "child");
+			break;
+		}
+	}
+
+	talloc_free(own);
+
+	for (i = 0; i < TS_NUM_SLOTS; i++) {
+		talloc_free(slots[i]);
+	}
+
+	/* leave a fixed number of children behind */
+	for (i = 0; i < 10; i++) {
+		talloc_size(ctx, 16);
+	}
+
+	return ctx;
+}
+
+static bool test_threadsafe_context(void)
+{
+	pthread_t threads[TS_NUM_THREADS];
+	void *root, *ctx, *p, *limited;
+	int i, ret;
+
+	talloc_disable_null_tracking();
+
+	printf("test: threadsafe_context\n# THREAD-SAFE CONTEXT\n");
+
+	root = talloc_new(NULL);
+	ctx = talloc_threadsafe_context(root);
+	if (ctx == NULL && errno == ENOSYS) {
+		talloc_free(root);
+		printf("skip: threadsafe_context\n");
+		return true;
+	}
+	torture_assert("threadsafe_context", ctx != NULL,
+		       "failed to create context\n");
+	torture_assert("threadsafe_context",
+		       talloc_realloc_size(root, ctx, 100) == NULL,
+		       "thread-safe context should not be reallocated\n");
+	torture_assert("threadsafe_context",
+		       talloc_set_memlimit(ctx, 1024) != 0,
+		       "thread-safe context should not take a memlimit\n");
+
+	for (i = 0; i < TS_NUM_THREADS; i++) {
+		ret = pthread_create(&threads[i], NULL, threadsafe_fn, ctx);
+		torture_assert("threadsafe_context", ret == 0,
+			       "failed to create thread\n");
+	}
+	for (i = 0; i < TS_NUM_THREADS; i++) {
+		void *result = NULL;
+		ret = pthread_join(threads[i], &result);
+		torture_assert("threadsafe_context", ret == 0,
+			       "failed to join thread\n");
+		torture_assert("threadsafe_context", result == ctx,
+			       "thread saw a wrong parent\n");
+	}
+
+	CHECK_BLOCKS("threadsafe_context", ctx, 1 + TS_NUM_THREADS * 10);
+	CHECK_SIZE("threadsafe_context", ctx, TS_NUM_THREADS * 10 * 16);
+	CHECK_PARENT("threadsafe_context", ctx, root);
+
+	p = talloc_named_const(ctx, 16, "p");
+	CHECK_PARENT("threadsafe_context", p, ctx);
+	talloc_steal(root, p);
+	CHECK_PARENT("threadsafe_context", p, root);
+	talloc_steal(ctx, p);
+	CHECK_PARENT("threadsafe_context", p, ctx);
+
+	talloc_free_children(ctx);
+	CHECK_BLOCKS("threadsafe_context", ctx, 1);
+
+	/* no memory limit may end up above a thread-safe context */
+	torture_assert("threadsafe_context",
+		       talloc_enable_accounting(root) != 0,
+		       "accounting enabled above a thread-safe context\n");
+	torture_assert("threadsafe_context",
+		       talloc_set_memlimit(root, 1024 * 1024) != 0,
+		       "memlimit set above a thread-safe context\n");
+	limited = talloc_new(NULL);
+	torture_assert("threadsafe_context",
+		       talloc_set_memlimit(limited, 1024 * 1024) == 0,
+		       "failed to set memlimit\n");
+	torture_assert("threadsafe_context",
+		       talloc_steal(limited, ctx) == NULL,
+		       "thread-safe context moved under a memlimit\n");
+	CHECK_PARENT("threadsafe_context", ctx, root);
+	p = talloc_named_const(NULL, 0, "p");
+	talloc_steal(p, ctx);
+	torture_assert("threadsafe_context",
+		       talloc_steal(limited, p) == NULL,
+		       "thread-safe context moved under a memlimit\n");
+	CHECK_PARENT("threadsafe_context", p, NULL);
+	talloc_steal(root, p);
+	CHECK_BLOCKS("threadsafe_context", limited, 1);
+	talloc_free(limited);
+
+	talloc_free(root);
+
+	printf("success: threadsafe_context\n");
+	return true;
+}
+
+struct threadsafe_speed_state {
+	void *ctx;
+	unsigned count;
+};
+
+static void *threadsafe_speed_fn(void *arg)
+{
+	struct threadsafe_speed_state *state = arg;
+	const int loop = 1000;
+	struct timeval tv;
+	int i;
+
+	tv = private_timeval_current();
+	do {
+		void *p1, *p2, *p3;
+		for (i=0;i<loop;i++) {
+			p1 = talloc_size(state->ctx, loop % 100);
+			p2 = talloc_strdup(p1, "foo bar");
+			p3 = talloc_size(p1, 300);
+			(void)p2;
+			(void)p3;
+			talloc_free(p1);
+		}
+		state->count += 3 * loop;
+	} while (private_timeval_elapsed(&tv) < 2.0);
+
+	return NULL;
+}
+
+static bool threadsafe_speed_run(void *ctx, int nthreads)
+{
+	pthread_t threads[nthreads];
+	struct threadsafe_speed_state state[nthreads];
+	struct timeval tv;
+	unsigned count = 0;
+	int i, ret;
+
+	tv = private_timeval_current();
+	for (i = 0; i < nthreads; i++) {
+		state[i].ctx = ctx;
+		state[i].count = 0;
+		ret = pthread_create(&threads[i], NULL,
+				     threadsafe_speed_fn, &state[i]);
+		torture_assert("threadsafe_speed", ret == 0,
+			       "failed to create thread\n");
+	}
+	for (i = 0; i < nthreads; i++) {
+		pthread_join(threads[i], NULL);
+		count += state[i].count;
+	}
+
+	fprintf(stderr, "talloc_threadsafe %d threads: %.0f ops/sec\n",
+		nthreads, count/private_timeval_elapsed(&tv));
+	return true;
+}
+
+static bool test_threadsafe_speed(void)
+{
+	long ncpus = sysconf(_SC_NPROCESSORS_ONLN);
+	void *ctx;
+	int nthreads;
+
+	talloc_disable_null_tracking();
+
+	printf("test: threadsafe_speed\n# THREAD-SAFE CONTEXT SCALING\n");
+
+	ctx = talloc_threadsafe_context(NULL);
+	if (ctx == NULL) {
+		printf("skip: threadsafe_speed\n");
+		return true;
+	}
+
+	if (ncpus < 1) {
+		ncpus = 1;
+	}
+
+	/* 1, 2, 4, ... threads, up to one per core */
+	for (nthreads = 1; ; nthreads *= 2) {
+		if (nthreads > ncpus) {
+			nthreads = ncpus;
+		}
+		if (!threadsafe_speed_run(ctx, nthreads)) {
+			talloc_free(ctx);
+			return false;
+		}
+		if (nthreads == ncpus) {
+			break;
+		}
+	}
+
+	CHECK_BLOCKS("threadsafe_speed", ctx, 1);
+	talloc_free(ctx);
+
+	printf("success: threadsafe_speed\n");
+	return true;
+}
 #endif
 
 static void test_magic_protection_abort(const char *reason)
@@ -2137,22 +5043,82 @@ bool torture_local_talloc(struct torture_context *tctx)
 	test_reset();
 	ret &= test_pool_steal();
 	test_reset();
+	ret &= test_pool_asprintf();
+	test_reset();
+	ret &= test_growable_pool();
+	test_reset();
+	ret &= test_pool_reuse();
+	test_reset();
+	ret &= test_arena();
+	test_reset();
 	ret &= test_free_ref_null_context();
 	test_reset();
 	ret &= test_rusty();
 	test_reset();
 	ret &= test_free_children();
 	test_reset();
+	ret &= test_free_tree();
+	test_reset();
+	ret &= test_chunk_cache();
+	test_reset();
 	ret &= test_memlimit();
+	test_reset();
+	ret &= test_memlimit_credit();
+	test_reset();
+	ret &= test_accounting();
+	test_reset();
+	ret &= test_strbuf();
+	test_reset();
+	ret &= test_parent_links();
+	test_reset();
+	ret &= test_reference_index();
+	test_reset();
+	ret &= test_report_cursor();
+	test_reset();
+	ret &= test_report_cursor_changes();
+	test_reset();
+	ret &= test_report_binary();
+	test_reset();
+	ret &= test_realloc_in_place();
+	test_reset();
+	ret &= test_sampling();
+	test_reset();
+	ret &= test_type_registry();
+	test_reset();
+	ret &= test_pool_hugepages();
+	test_reset();
+	ret &= test_array_of_chunks();
+	test_reset();
+	ret &= test_deferred_destructor();
 #ifdef HAVE_PTHREAD
 	test_reset();
 	ret &= test_pthread_talloc_passing();
+	test_reset();
+	ret &= test_threadsafe_context();
 #endif
 
 
 	if (ret) {
 		test_reset();
 		ret &= test_speed();
+		test_reset();
+		ret &= test_pool_reuse_speed();
+		test_reset();
+		ret &= test_strbuf_speed();
+		test_reset();
+		ret &= test_asprintf_speed();
+		test_reset();
+		ret &= test_parent_links_speed();
+		test_reset();
+		ret &= test_realloc_speed();
+		test_reset();
+		ret &= test_type_check_speed();
+		test_reset();
+		ret &= test_pool_hugepage_speed();
+#ifdef HAVE_PTHREAD
+		test_reset();
+		ret &= test_threadsafe_speed();
+#endif
 	}
 	test_reset();
 	ret &= test_autofree();